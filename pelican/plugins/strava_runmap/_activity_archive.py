@@ -0,0 +1,250 @@
+"""Keep the activities of the last build with their routes already decoded.
+
+Rebuilding from the activity store or from Strava means decoding every route's
+    polyline again, for every SVG that isn't cached and for every heatmap. With
+    `ARCHIVE`, the activities drawn by a build are written to one file in the
+    plugin's cache dir:
+
+- a header, of `MAGIC`, `VERSION`, the number of activities and the metadata size
+- the metadata, as JSON columns of ids, dates, distances, times, names and routes
+- `count + 1` offsets in to the coordinates, as unsigned 64 bit integers
+- every route's `lat, lon` coordinates, as one buffer of 32 bit floats
+
+Later builds memory-map the file, so a route's coordinates are a `memoryview` slice
+    of it, read without being decoded or copied. Only routes that are new or have
+    changed since are decoded, and the file is only written again once an activity
+    has been added, removed or edited. The file is in native byte order, as it is a
+    cache of this machine's builds rather than something to share.
+"""
+
+from array import array
+import contextlib
+import dataclasses
+from itertools import chain
+import json
+import logging
+import mmap
+import os
+from pathlib import Path
+import struct
+import tempfile
+import threading
+
+import polyline
+
+from . import _strava_interface, _svg_interface
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_FILENAME = "activities.archive"
+MAGIC = b"SRMA"
+# Bump whenever the layout or the metadata columns change.
+VERSION = 1
+# Magic, version, activity count and metadata size.
+HEADER = struct.Struct("=4sIQQ")
+OFFSET_TYPECODE = "Q"
+COORD_TYPECODE = "f"
+# The offsets and coordinates start on a multiple of this, so reads are aligned.
+ALIGNMENT = 8
+
+
+def decode_coords(encoded_polyline: str) -> array:
+    """Decode a route in to a flat `lat, lon, lat, lon, ...` buffer of floats."""
+    if np is not None:
+        lat_lon = _svg_interface.decode_polyline_array(encoded_polyline)
+        return array(COORD_TYPECODE, lat_lon.astype(np.float32).tobytes())
+    return array(
+        COORD_TYPECODE,
+        chain.from_iterable(
+            polyline.decode(encoded_polyline, _svg_interface.POLYLINE_PRECISION)
+        ),
+    )
+
+
+def _metadata(activities: list[_strava_interface.StravaRouteData]) -> dict[str, list]:
+    """Lay out everything but the coordinates of the activities, a column a field."""
+    return {
+        "id": [activity.id for activity in activities],
+        "name": [activity.name for activity in activities],
+        "distance": [float(activity.distance) for activity in activities],
+        "moving_time": [activity.moving_time for activity in activities],
+        "start_date": [activity.start_date.isoformat() for activity in activities],
+        "start_date_local": [
+            activity.start_date_local.isoformat() for activity in activities
+        ],
+        "timezone": [activity.timezone.key for activity in activities],
+        "map_id": [activity.map.id for activity in activities],
+        "summary_polyline": [activity.map.summary_polyline for activity in activities],
+        "polyline": [activity.map.polyline for activity in activities],
+        "resource_state": [activity.map.resource_state for activity in activities],
+    }
+
+
+def _padding(size: int) -> bytes:
+    return b"\0" * (-size % ALIGNMENT)
+
+
+@dataclasses.dataclass(frozen=True)
+class _Mapping:
+    """One loaded archive, replaced as a whole so readers never see half of one."""
+
+    metadata: dict[str, list]
+    indices: dict[int, int]
+    offsets: memoryview | None = None
+    coords: memoryview | None = None
+
+    def coords_at(self, index: int) -> memoryview:
+        return self.coords[self.offsets[index] : self.offsets[index + 1]]
+
+
+_NO_MAPPING = _Mapping({}, {})
+
+
+def _map(path: Path) -> _Mapping | None:
+    """Memory-map the archive at `path`, if there is one that this version can read."""
+    try:
+        with open(path, "rb") as file:
+            mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+    try:
+        magic, version, count, metadata_size = HEADER.unpack_from(mapped)
+    except struct.error:
+        return None
+    if magic != MAGIC or version != VERSION:
+        return None
+    start = HEADER.size
+    metadata_end = start + metadata_size
+    try:
+        metadata = json.loads(mapped[start:metadata_end])
+    except ValueError:
+        logger.warning(f"Could not read activity archive {path}")
+        return None
+    offsets_start = metadata_end + len(_padding(metadata_end))
+    coords_start = offsets_start + (count + 1) * array(OFFSET_TYPECODE).itemsize
+    view = memoryview(mapped)
+    return _Mapping(
+        metadata=metadata,
+        indices={
+            activity_id: index for index, activity_id in enumerate(metadata["id"])
+        },
+        offsets=view[offsets_start:coords_start].cast(OFFSET_TYPECODE),
+        coords=view[coords_start:].cast(COORD_TYPECODE),
+    )
+
+
+class ActivityArchive:
+    """The activities of the last build, and their routes' coordinates.
+
+    Builds can run on the prefetch thread and the main thread at once, so the
+        loaded archive is swapped out whole, and only one thread writes it at a time.
+        Slices handed out keep the mapping they came from alive until dropped.
+    """
+
+    path: Path | None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.configure(None)
+
+    def configure(self, cache_dir: str | os.PathLike | None):
+        with self._lock:
+            self.path = Path(cache_dir) / ARCHIVE_FILENAME if cache_dir else None
+            self._mapping = _NO_MAPPING
+            self._decoded: dict[int, array] = {}
+        if self.path is not None:
+            self.load()
+
+    @property
+    def metadata(self) -> dict[str, list]:
+        return self._mapping.metadata
+
+    def __len__(self) -> int:
+        return len(self._mapping.metadata.get("id", []))
+
+    def load(self) -> bool:
+        """Memory-map the archive, if there is one that this version can read."""
+        with self._lock:
+            mapping = _map(self.path) if self.path is not None else None
+            self._mapping = mapping or _NO_MAPPING
+        return mapping is not None
+
+    def coords(self, index: int) -> memoryview:
+        """Slice out the archive's `index`th route, without copying it."""
+        return self._mapping.coords_at(index)
+
+    def route_coords(
+        self, activity: _strava_interface.StravaRouteData
+    ) -> memoryview | array:
+        """Get the coordinates of an activity's route, decoding it only if it's new."""
+        return self._route_coords(self._mapping, activity)
+
+    def _route_coords(
+        self, mapping: _Mapping, activity: _strava_interface.StravaRouteData
+    ) -> memoryview | array:
+        index = mapping.indices.get(activity.id)
+        if (
+            index is not None
+            and mapping.metadata["polyline"][index] == activity.map.polyline
+            and mapping.metadata["summary_polyline"][index]
+            == activity.map.summary_polyline
+        ):
+            return mapping.coords_at(index)
+        decoded = self._decoded
+        route = decoded.get(activity.id)
+        if route is None:
+            route = decoded[activity.id] = decode_coords(activity.map.route_polyline)
+        return route
+
+    def save(self, activities: list[_strava_interface.StravaRouteData]):
+        """Write `activities` over the archive, unless it has them all already."""
+        if self.path is None:
+            return
+        metadata = _metadata(activities)
+        with self._lock:
+            mapping = self._mapping
+            if metadata != mapping.metadata:
+                self._write(mapping, activities, metadata)
+            self._decoded = {}
+
+    def _write(
+        self,
+        mapping: _Mapping,
+        activities: list[_strava_interface.StravaRouteData],
+        metadata: dict[str, list],
+    ):
+        routes = [self._route_coords(mapping, activity) for activity in activities]
+        offsets = array(OFFSET_TYPECODE, [0])
+        for route in routes:
+            offsets.append(offsets[-1] + len(route))
+        encoded_metadata = json.dumps(metadata).encode("utf-8")
+        tmp_path = None
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(
+                dir=self.path.parent, prefix=f"{ARCHIVE_FILENAME}.", suffix=".tmp"
+            )
+            with open(fd, "wb") as file:
+                file.write(
+                    HEADER.pack(MAGIC, VERSION, len(activities), len(encoded_metadata))
+                )
+                file.write(encoded_metadata)
+                file.write(_padding(HEADER.size + len(encoded_metadata)))
+                file.write(offsets)
+                for route in routes:
+                    file.write(route)
+            os.replace(tmp_path, self.path)
+        except OSError:
+            logger.warning(
+                f"Could not write activity archive {self.path}", exc_info=True
+            )
+            if tmp_path is not None:
+                with contextlib.suppress(OSError):
+                    os.unlink(tmp_path)
+            return
+        self._mapping = _map(self.path) or _NO_MAPPING
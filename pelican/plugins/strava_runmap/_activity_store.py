@@ -0,0 +1,168 @@
+"""Persist raw Strava activities between builds so we only fetch what is new.
+
+Activities are stored as JSON lines (one trimmed activity response per line) in the
+plugin's cache directory, newest first.
+Pages fetched from Strava are trimmed while they are parsed, with orjson if it is
+    installed.
+"""
+
+from calendar import timegm
+from datetime import datetime
+import json
+import logging
+import os
+from pathlib import Path
+
+try:
+    import orjson
+except ImportError:
+    # Optional, the standard library's json is used otherwise.
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+STORE_FILENAME = "activities.jsonl"
+# Present while the store holds only the newest part of the history, because the
+#     full download that filled it was interrupted part way through.
+BACKFILL_MARKER_FILENAME = "activities.backfill"
+STRAVA_DT_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+# The only parts of the Strava response that `StravaRouteData` needs.
+STORED_FIELDS = (
+    "id",
+    "name",
+    "distance",
+    "moving_time",
+    "start_date",
+    "start_date_local",
+    "timezone",
+    "map",
+)
+
+
+def trim_activity(strava_response: dict) -> dict:
+    """Drop every field of an activity response that we don't store."""
+    return {
+        field: strava_response[field]
+        for field in STORED_FIELDS
+        if field in strava_response
+    }
+
+
+def _trim_parsed(pairs: list[tuple[str, object]]) -> dict:
+    """Trim activities as soon as they are parsed, and pass nested objects through."""
+    fields = dict(pairs)
+    return trim_activity(fields) if "start_date_local" in fields else fields
+
+
+# Only one activity's worth of unused fields is ever held at once.
+_TRIMMING_DECODER = json.JSONDecoder(object_pairs_hook=_trim_parsed)
+
+
+def parse_activities(content: bytes) -> list[dict]:
+    """Parse a page of activity responses, keeping only the `STORED_FIELDS`.
+
+    orjson parses the page several times faster than the standard library, even
+        though it builds every field of every activity before they are trimmed.
+        Without it, activities are trimmed as the decoder finishes each one.
+    """
+    if orjson is not None:
+        return [trim_activity(activity) for activity in orjson.loads(content)]
+    return _TRIMMING_DECODER.decode(content.decode("utf-8"))
+
+
+def parse_datetime(value: str) -> datetime:
+    """Parse a `STRAVA_DT_FORMAT` date, many times faster than `strptime` does."""
+    return datetime.fromisoformat(value.removesuffix("Z"))
+
+
+def start_timestamp(activity: dict) -> int:
+    """Epoch seconds of an activity's (UTC) start date, as used by `after=`."""
+    return timegm(parse_datetime(activity["start_date"]).utctimetuple())
+
+
+def latest_timestamp(activities: list[dict]) -> int | None:
+    if not activities:
+        return None
+    return max(start_timestamp(activity) for activity in activities)
+
+
+def oldest_timestamp(activities: list[dict]) -> int | None:
+    if not activities:
+        return None
+    return min(start_timestamp(activity) for activity in activities)
+
+
+class ActivityStore:
+    path: Path
+    backfill_marker_path: Path
+
+    def __init__(self, cache_dir: str | os.PathLike):
+        self.path = Path(cache_dir) / STORE_FILENAME
+        self.backfill_marker_path = Path(cache_dir) / BACKFILL_MARKER_FILENAME
+
+    def exists(self) -> bool:
+        return self.path.is_file()
+
+    @property
+    def backfill_pending(self) -> bool:
+        return self.backfill_marker_path.is_file()
+
+    def load(self) -> list[dict]:
+        """Read every stored activity, newest first."""
+        if not self.exists():
+            return []
+        with self.path.open(encoding="utf-8") as store_file:
+            return [json.loads(line) for line in store_file if line.strip()]
+
+    def save(
+        self, activities: list[dict], backfill_pending: bool = False
+    ) -> list[dict]:
+        """Replace the store contents with `activities`, sorted newest first.
+
+        `backfill_pending` records that activities older than the oldest stored one
+            still need to be fetched.
+        """
+        activities = sorted(
+            (trim_activity(activity) for activity in activities),
+            key=start_timestamp,
+            reverse=True,
+        )
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # Write to a sibling file and swap it in so a failed build can't leave
+        #     a half-written store behind.
+        tmp_path = self.path.with_suffix(".tmp")
+        with tmp_path.open("w", encoding="utf-8") as store_file:
+            for activity in activities:
+                store_file.write(json.dumps(activity) + "\n")
+        os.replace(tmp_path, self.path)
+        if backfill_pending:
+            self.backfill_marker_path.touch()
+        else:
+            self.backfill_marker_path.unlink(missing_ok=True)
+        return activities
+
+    def merge(
+        self, stored: list[dict], fetched: list[dict], after: int | None = None
+    ) -> list[dict]:
+        """Merge freshly fetched activities into the stored ones.
+
+        Fetched activities replace stored activities with the same id, so edits made
+            on Strava are picked up. If `after` is given, the fetch is assumed to
+            cover everything that started after it, so stored activities in that
+            range that Strava no longer returned have been deleted and are evicted.
+        """
+        fetched_by_id = {activity["id"]: activity for activity in fetched}
+        merged = []
+        evicted = 0
+        for activity in stored:
+            if activity["id"] in fetched_by_id:
+                continue
+            if after is not None and start_timestamp(activity) > after:
+                evicted += 1
+                continue
+            merged.append(activity)
+        if evicted:
+            logger.info(f"Evicted {evicted} deleted activities from the cache")
+        merged.extend(fetched_by_id.values())
+        return merged
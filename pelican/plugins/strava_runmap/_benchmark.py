@@ -0,0 +1,224 @@
+"""Time each stage of building the runmap over synthetic histories of several sizes.
+
+Run with `invoke benchmark`, or
+    `python -m pelican.plugins.strava_runmap._benchmark --output benchmark.json`.
+Each stage is timed on its own, then run again under `tracemalloc` for its peak
+    memory, since tracing slows everything down. Results are saved as JSON to be
+    compared between commits.
+"""
+
+import argparse
+from array import array
+from collections import defaultdict
+from collections.abc import Callable
+import json
+import logging
+import platform
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+import polyline
+
+from . import (
+    _activity_archive,
+    _activity_store,
+    _strava_interface,
+    _svg_interface,
+    _synthetic,
+    strava_runmap,
+)
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SIZES = (100, 1_000, 10_000, 50_000)
+
+
+def _measure(stage: Callable[[], object]) -> tuple[float, int]:
+    """Run a stage twice, for the seconds it takes and the peak bytes it allocates."""
+    start = time.perf_counter()
+    stage()
+    seconds = time.perf_counter() - start
+    tracemalloc.start()
+    try:
+        stage()
+        _, peak_bytes = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return seconds, peak_bytes
+
+
+def _stages(raw_activities: list[dict]) -> dict[str, Callable[[], object]]:
+    """Split a build in to stages, each of which runs on the output of the last."""
+    render_options = strava_runmap._render_options()
+    outputs = {}
+    # As Strava would send them, a page of `DEFAULT_PER_PAGE` at a time.
+    pages = [
+        json.dumps(
+            raw_activities[start : start + _strava_interface.DEFAULT_PER_PAGE]
+        ).encode("utf-8")
+        for start in range(0, len(raw_activities), _strava_interface.DEFAULT_PER_PAGE)
+    ]
+
+    def _parse_activities():
+        outputs["parsed"] = [
+            activity
+            for page in pages
+            for activity in _activity_store.parse_activities(page)
+        ]
+        return outputs["parsed"]
+
+    def _from_strava_data():
+        outputs["activities"] = [
+            _strava_interface.StravaRouteData.from_strava_data(raw)
+            for raw in outputs["parsed"]
+        ]
+        return outputs["activities"]
+
+    def _decode():
+        return [
+            polyline.decode(
+                activity.map.route_polyline, _svg_interface.POLYLINE_PRECISION
+            )
+            for activity in outputs["activities"]
+        ]
+
+    def _archive_save():
+        outputs["archive_dir"] = tempfile.TemporaryDirectory()
+        archive = _activity_archive.ActivityArchive()
+        archive.configure(outputs["archive_dir"].name)
+        archive.save(outputs["activities"])
+
+    def _archive_load():
+        archive = _activity_archive.ActivityArchive()
+        archive.configure(outputs["archive_dir"].name)
+        routes = [archive.route_coords(activity) for activity in outputs["activities"]]
+        if _svg_interface.np is None:
+            return [array("d", route) for route in routes]
+        return [_svg_interface.route_array(route) for route in routes]
+
+    def _extract_svg_data():
+        outputs["activity_svgs"] = [
+            _svg_interface.extract_svg_data(
+                activity,
+                render_options.width,
+                render_options.height,
+                render_options.padding,
+                simplify=render_options.simplify,
+                tolerance=render_options.tolerance,
+            )
+            for activity in outputs["activities"]
+        ]
+        return outputs["activity_svgs"]
+
+    def _convert_to_svg():
+        outputs["svgs"] = [
+            _svg_interface.convert_to_svg(activity_svg)
+            for activity_svg in outputs["activity_svgs"]
+        ]
+        return outputs["svgs"]
+
+    def _add_run_images():
+        run_history = defaultdict(list)
+        for activity, svg_content in zip(outputs["activities"], outputs["svgs"]):
+            strava_runmap._add_run_image(
+                run_history,
+                str(activity.start_date_local.year),
+                activity,
+                svg_content,
+            )
+        outputs["run_history"] = run_history
+        return run_history
+
+    def _build_runmap_page():
+        return strava_runmap._build_runmap_page(outputs["run_history"])
+
+    return {
+        "parse_activities": _parse_activities,
+        "from_strava_data": _from_strava_data,
+        "polyline.decode": _decode,
+        "archive.save": _archive_save,
+        "archive.load": _archive_load,
+        "extract_svg_data": _extract_svg_data,
+        "convert_to_svg": _convert_to_svg,
+        "_add_run_image": _add_run_images,
+        "_build_runmap_page": _build_runmap_page,
+    }
+
+
+def _commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(
+    sizes: tuple[int, ...] = DEFAULT_SIZES,
+    points: tuple[int, int] = _synthetic.DEFAULT_POINTS,
+    seed: int = _synthetic.DEFAULT_SEED,
+) -> dict:
+    """Benchmark every stage at every size, as a JSON-able dict of results."""
+    results = []
+    for size in sizes:
+        raw_activities = _synthetic.synthetic_activities(size, points, seed)
+        for stage, run_stage in _stages(raw_activities).items():
+            seconds, peak_bytes = _measure(run_stage)
+            results.append(
+                {
+                    "stage": stage,
+                    "activities": size,
+                    "seconds": seconds,
+                    "activities_per_second": size / seconds if seconds else None,
+                    "peak_bytes": peak_bytes,
+                }
+            )
+            logger.info(
+                f"{stage:>20} x {size:>6}: {seconds:8.3f}s, "
+                f"{size / max(seconds, 1e-9):10.0f}/s, "
+                f"peak {peak_bytes / 1024 / 1024:8.1f}MB"
+            )
+    return {
+        "commit": _commit(),
+        "python": platform.python_version(),
+        "numpy": _svg_interface.np is not None,
+        "orjson": _activity_store.orjson is not None,
+        "points": list(points),
+        "seed": seed,
+        "results": results,
+    }
+
+
+def main(argv: list[str] | None = None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=DEFAULT_SIZES, metavar="N"
+    )
+    parser.add_argument(
+        "--points",
+        type=int,
+        nargs=2,
+        default=_synthetic.DEFAULT_POINTS,
+        metavar=("MIN", "MAX"),
+        help="How many points each synthetic route has",
+    )
+    parser.add_argument("--seed", type=int, default=_synthetic.DEFAULT_SEED)
+    parser.add_argument("--output", help="Save the results as JSON to this file")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    report = run(tuple(args.sizes), tuple(args.points), args.seed)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output_file:
+            json.dump(report, output_file, indent=2)
+        logger.info(f"Saved results to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
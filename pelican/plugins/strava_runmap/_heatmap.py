@@ -0,0 +1,176 @@
+"""Draw every activity on to one density grid, rather than one SVG per activity.
+
+Tracks are projected to Mercator, rasterized on to a fixed size grid of counts, and
+    the grid is written out as a small PNG with log-scaled intensity. The grid never
+    grows with the number of activities, and work is linear in the number of points.
+Requires numpy.
+"""
+
+import base64
+import logging
+import math
+import struct
+import zlib
+
+from . import _spatial_index, _svg_interface
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_RESOLUTION = 512
+# Rasterized cells are buffered and added to the grid in bulk once there are this
+#     many, which bounds the memory used no matter how many tracks there are.
+FLUSH_SAMPLES = 1_000_000
+HEAT_COLOR = (220, 40, 40)
+
+
+def _project(lat_lon):
+    """Unscaled Mercator `x, y` of `[lat, lon]` points."""
+    x = np.radians(lat_lon[:, 1])
+    y = np.log(np.tan(math.pi / 4 + np.radians(lat_lon[:, 0]) / 2))
+    return x, y
+
+
+def _png(rgba) -> bytes:
+    """Encode an (height, width, 4) uint8 array as a PNG."""
+    height, width, _ = rgba.shape
+    # Every row starts with a filter type byte, 0 being no filter.
+    rows = np.zeros((height, width * 4 + 1), dtype=np.uint8)
+    rows[:, 1:] = rgba.reshape(height, -1)
+
+    def _chunk(tag: bytes, data: bytes) -> bytes:
+        checksum = zlib.crc32(tag + data) & 0xFFFFFFFF
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", checksum)
+
+    return b"".join(
+        [
+            b"\x89PNG\r\n\x1a\n",
+            _chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0)),
+            _chunk(b"IDAT", zlib.compress(rows.tobytes(), 9)),
+            _chunk(b"IEND", b""),
+        ]
+    )
+
+
+class Heatmap:
+    bounds: _spatial_index.Bounds
+    rows: int
+    cols: int
+
+    def __init__(
+        self, bounds: _spatial_index.Bounds, resolution: int = DEFAULT_RESOLUTION
+    ):
+        self.bounds = bounds
+        south, west, north, east = bounds
+        (min_x, max_x), (min_y, max_y) = _project(
+            np.array([[south, west], [north, east]], dtype=np.float64)
+        )
+        self.min_x, self.max_y = min_x, max_y
+        # Square cells, with the longer side of the region `resolution` cells long.
+        self.cell_size = max(max_x - min_x, max_y - min_y) / resolution or 1.0
+        self.cols = max(math.ceil((max_x - min_x) / self.cell_size), 1)
+        self.rows = max(math.ceil((max_y - min_y) / self.cell_size), 1)
+        self.counts = np.zeros(self.rows * self.cols, dtype=np.float32)
+        self._pending = []
+        self._pending_samples = 0
+
+    def add_track(self, lat_lon):
+        """Rasterize a track of `[lat, lon]` points on to the grid.
+
+        Every segment is sampled at least once per cell it passes through, all
+            segments of the track at once.
+        """
+        if not len(lat_lon) or not _spatial_index.intersects(
+            self.bounds, _spatial_index.array_bounds(lat_lon)
+        ):
+            return
+        x, y = _project(lat_lon)
+        cols = (x - self.min_x) / self.cell_size
+        rows = (self.max_y - y) / self.cell_size
+        col_steps, row_steps = np.diff(cols), np.diff(rows)
+        # GPS glitches can jump across the world, no need to sample past the grid.
+        samples_per_step = np.clip(
+            np.ceil(np.maximum(np.abs(col_steps), np.abs(row_steps))),
+            1,
+            self.rows + self.cols,
+        ).astype(np.int64)
+        step = np.repeat(np.arange(len(samples_per_step)), samples_per_step)
+        step_starts = np.repeat(
+            np.cumsum(samples_per_step) - samples_per_step, samples_per_step
+        )
+        fraction = (np.arange(len(step)) - step_starts) / samples_per_step[step]
+        sample_cols = np.append(cols[step] + col_steps[step] * fraction, cols[-1:])
+        sample_rows = np.append(rows[step] + row_steps[step] * fraction, rows[-1:])
+
+        sample_cols = np.floor(sample_cols).astype(np.int64)
+        sample_rows = np.floor(sample_rows).astype(np.int64)
+        inside = (
+            (sample_cols >= 0)
+            & (sample_cols < self.cols)
+            & (sample_rows >= 0)
+            & (sample_rows < self.rows)
+        )
+        cells = sample_rows[inside] * self.cols + sample_cols[inside]
+        self._pending.append(cells)
+        self._pending_samples += len(cells)
+        if self._pending_samples >= FLUSH_SAMPLES:
+            self._flush()
+
+    def _flush(self):
+        if self._pending:
+            self.counts += np.bincount(
+                np.concatenate(self._pending), minlength=len(self.counts)
+            )
+        self._pending = []
+        self._pending_samples = 0
+
+    def to_png(self) -> bytes:
+        """Draw the grid with intensity scaled by the log of each cell's count."""
+        self._flush()
+        intensity = np.log1p(self.counts)
+        if intensity.max() > 0:
+            intensity /= intensity.max()
+        rgba = np.empty((self.rows * self.cols, 4), dtype=np.uint8)
+        rgba[:, :3] = HEAT_COLOR
+        rgba[:, 3] = np.rint(intensity * 255)
+        return _png(rgba.reshape(self.rows, self.cols, 4))
+
+    def to_html(self, name: str) -> str:
+        data = base64.b64encode(self.to_png()).decode("ascii")
+        return (
+            f'<img src="data:image/png;base64,{data}" alt="Heatmap of {name}" '
+            f'width="{self.cols}" height="{self.rows}" '
+            'style="max-width: 100%; height: auto;">'
+        )
+
+
+def build_heatmaps(
+    tracks: _spatial_index.SpatialIndex,
+    regions: dict[str, _spatial_index.Bounds] | None = None,
+    resolution: int = DEFAULT_RESOLUTION,
+) -> dict[str, str]:
+    """Draw a heatmap for each region, as HTML `<img>`s by name.
+
+    `tracks` indexes routes (encoded polylines, or their coordinates) by their
+        bounds, so each region only decodes the routes that pass through it.
+        Without any `regions`, a single heatmap covers every route.
+    """
+    if np is None:
+        logger.warning("The strava runmap HEATMAP requires numpy, skipping it")
+        return {}
+    if not regions:
+        if not len(tracks):
+            return {}
+        regions = {"All Activities": tracks.bounds}
+
+    heatmaps = {}
+    for name, bounds in regions.items():
+        heatmap = Heatmap(tuple(bounds), resolution)
+        for route in tracks.query(heatmap.bounds):
+            heatmap.add_track(_svg_interface.route_array(route))
+        heatmaps[name] = heatmap.to_html(name)
+    return heatmaps
@@ -0,0 +1,97 @@
+"""Time the stages of a build and count what went through them.
+
+Spans record how often and for how long a stage ran, and counters add up things like
+    requests, bytes and activities. Both do next to nothing unless enabled, so they
+    can stay in the hot paths. Work done in `RENDER_WORKERS` processes isn't counted.
+"""
+
+from collections import Counter, defaultdict
+from contextlib import nullcontext
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+_DISABLED_SPAN = nullcontext()
+
+
+class _Span:
+    __slots__ = ("metrics", "name", "start")
+
+    def __init__(self, metrics: "Metrics", name: str):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        self.metrics.record(self.name, time.perf_counter() - self.start)
+
+
+class Metrics:
+    enabled: bool
+    spans: dict[str, list]
+    counters: Counter
+
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            # Each span is `[calls, seconds]`.
+            self.spans = defaultdict(lambda: [0, 0.0])
+            self.counters = Counter()
+
+    def span(self, name: str):
+        """Time a `with` block under `name`."""
+        if not self.enabled:
+            return _DISABLED_SPAN
+        return _Span(self, name)
+
+    def record(self, name: str, seconds: float):
+        with self._lock:
+            span = self.spans[name]
+            span[0] += 1
+            span[1] += seconds
+
+    def count(self, name: str, amount: int = 1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] += amount
+
+    def report(self) -> dict:
+        with self._lock:
+            return {
+                "spans": {
+                    name: {"calls": calls, "seconds": seconds}
+                    for name, (calls, seconds) in self.spans.items()
+                },
+                "counters": dict(self.counters),
+            }
+
+    def log_report(self):
+        report = self.report()
+        lines = [
+            f"  {name}: {span['seconds']:.3f}s over {span['calls']} calls"
+            for name, span in report["spans"].items()
+        ]
+        lines.extend(f"  {name}: {value}" for name, value in report["counters"].items())
+        logger.info("\n".join(["Strava runmap build metrics:", *lines]))
+
+    def write(self, path: str | os.PathLike):
+        try:
+            with open(path, "w", encoding="utf-8") as metrics_file:
+                json.dump(self.report(), metrics_file, indent=2)
+        except OSError:
+            logger.warning(f"Could not write metrics to {path}", exc_info=True)
+
+
+# Shared by every module, enabled with the `METRICS` or `METRICS_FILE` settings.
+METRICS = Metrics()
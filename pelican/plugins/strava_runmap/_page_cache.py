@@ -0,0 +1,134 @@
+"""Reuse the last build's runmap pages while nothing that went in to them has changed.
+
+A build is fingerprinted by the activities on the page, the page template and the
+    settings that change how they are drawn. Settings for fetching activities are
+    left out, as whatever they change shows up in the activities themselves, and so
+    are those for caching, workers, timeouts and metrics, which never change the page.
+The last build is kept in memory for `pelican --autoreload`, and on disk as per
+    Pelican's `CACHE_CONTENT` and `LOAD_CONTENT_CACHE` settings.
+"""
+
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+import threading
+
+from . import _strava_interface
+
+logger = logging.getLogger(__name__)
+
+PAGE_CACHE_FILENAME = "pages.json"
+# Bump whenever the page output changes for the same inputs.
+FINGERPRINT_VERSION = "1"
+# Plugin settings that change the page drawn from the same activities.
+PLUGIN_SETTINGS = (
+    "DATE_DISPLAY_FORMAT",
+    # Archived routes are drawn from 32 bit floats, rather than decoded polylines.
+    "ARCHIVE",
+    "SIMPLIFY",
+    "SIMPLIFY_TOLERANCE",
+    "SVG_FORMAT",
+    "SVG_PRECISION",
+    "HEATMAP",
+    "HEATMAP_RESOLUTION",
+    "HEATMAP_REGIONS",
+    "GROUP_BY",
+    "REGIONS",
+    "REGION_CLUSTER_DEGREES",
+    "PAGINATE",
+    "SPRITES",
+)
+# Pelican settings that change the links between pages.
+PELICAN_SETTINGS = ("SITEURL", "PAGE_URL", "PAGE_SAVE_AS", "SLUG_REGEX_SUBSTITUTIONS")
+
+
+def fingerprint(
+    activities: list[_strava_interface.StravaRouteData],
+    plugin_settings: dict,
+    pelican_settings: dict,
+    template_source: str = "",
+) -> str:
+    digest = hashlib.sha256(FINGERPRINT_VERSION.encode("utf-8"))
+    digest.update(template_source.encode("utf-8"))
+    settings = [(key, plugin_settings.get(key)) for key in PLUGIN_SETTINGS]
+    settings.extend((key, pelican_settings.get(key)) for key in PELICAN_SETTINGS)
+    digest.update(repr(settings).encode("utf-8"))
+    for activity in activities:
+        digest.update(
+            repr(
+                (
+                    activity.id,
+                    activity.name,
+                    activity.distance,
+                    activity.moving_time,
+                    activity.start_date_local.isoformat(),
+                )
+            ).encode("utf-8")
+        )
+        digest.update(activity.map.route_polyline.encode("utf-8"))
+    return digest.hexdigest()
+
+
+class PageCache:
+    """The last build, shared by the main thread and the prefetch thread."""
+
+    path: Path | None
+    build: dict
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.path = None
+        self.build = {}
+
+    def configure(self, cache_dir: str | os.PathLike | None):
+        self.path = Path(cache_dir) / PAGE_CACHE_FILENAME if cache_dir else None
+
+    def last(self, load_cache: bool = False) -> dict | None:
+        """Get the last build, whatever it was made from, if there is one.
+
+        With `load_cache`, the last build is read from disk if this process hasn't
+            made one yet.
+        """
+        with self._lock:
+            if not self.build and load_cache and self.path is not None:
+                try:
+                    self.build = json.loads(self.path.read_text(encoding="utf-8"))
+                except (OSError, ValueError):
+                    self.build = {}
+            return self.build or None
+
+    def get(self, build_fingerprint: str, load_cache: bool = False) -> dict | None:
+        """Get the last build if it has the same fingerprint.
+
+        Builds have the `pages` as a list of `title`, `slug` and `content` dicts,
+            and the contents of any sprite sheets by file name as `sprites`.
+        """
+        last_build = self.last(load_cache)
+        if last_build is None or last_build.get("fingerprint") != build_fingerprint:
+            return None
+        return last_build
+
+    def put(
+        self,
+        build_fingerprint: str,
+        pages: list[dict],
+        sprites: dict[str, str],
+        save_cache: bool = False,
+    ):
+        with self._lock:
+            self.build = {
+                "fingerprint": build_fingerprint,
+                "pages": pages,
+                "sprites": sprites,
+            }
+            if not save_cache or self.path is None:
+                return
+            try:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                tmp_path = self.path.with_suffix(".tmp")
+                tmp_path.write_text(json.dumps(self.build), encoding="utf-8")
+                os.replace(tmp_path, self.path)
+            except OSError:
+                logger.warning(f"Could not write page cache {self.path}", exc_info=True)
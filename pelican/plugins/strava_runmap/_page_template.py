@@ -0,0 +1,62 @@
+"""Render the runmap page from a Jinja2 template that themes can override.
+
+The plugin ships `templates/strava_runmap.html`, which is used unless a template of
+    the same name is found first in Pelican's `THEME_TEMPLATES_OVERRIDES` or in the
+    theme's own `templates`.
+The page is rendered as one string, as that is what Pelican takes as a page's
+    content, joined once from the chunks the template generates rather than built up
+    from lists of every year and activity.
+"""
+
+import os
+from pathlib import Path
+
+import jinja2
+
+TEMPLATE_NAME = "strava_runmap.html"
+TEMPLATES_PATH = Path(__file__).parent / "templates"
+
+
+class PageTemplate:
+    search_path: list[str]
+    environment: jinja2.Environment
+
+    def __init__(self):
+        self.configure()
+
+    def configure(self, pelican_settings: dict | None = None):
+        """Look for the template in the overrides and theme of `pelican_settings`."""
+        pelican_settings = pelican_settings or {}
+        self.search_path = [
+            *pelican_settings.get("THEME_TEMPLATES_OVERRIDES", []),
+            *(
+                [os.path.join(pelican_settings["THEME"], "templates")]
+                if pelican_settings.get("THEME")
+                else []
+            ),
+            str(TEMPLATES_PATH),
+        ]
+        # Activity SVGs and heatmaps are already HTML.
+        self.environment = jinja2.Environment(
+            loader=jinja2.FileSystemLoader(self.search_path),
+            trim_blocks=True,
+            lstrip_blocks=True,
+        )
+
+    @property
+    def source(self) -> str:
+        """The template as found, to tell when an override has been edited."""
+        source, _, _ = self.environment.loader.get_source(
+            self.environment, TEMPLATE_NAME
+        )
+        return source
+
+    def render(self, context: dict) -> str:
+        """Render the page as a string.
+
+        Most chunks are activity SVGs and names that already exist as strings, so
+            joining them only copies them once, in to the page, where writing them
+            to an `io.StringIO` would copy them in to the buffer and then again out
+            of it.
+        """
+        return "".join(self.environment.get_template(TEMPLATE_NAME).generate(context))
@@ -0,0 +1,100 @@
+"""Fetch and render activities in the background while Pelican reads the site.
+
+By the time the runmap page is added, Pelican has already read every article and run
+    its other generators, which is plenty of time to have waited on Strava instead.
+Under `pelican --autoreload`, the last result is kept between rebuilds, and refreshed
+    in the background once it is older than `REFRESH_INTERVAL`.
+"""
+
+from collections.abc import Callable
+from concurrent import futures
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TIMEOUT = 300
+DEFAULT_REFRESH_INTERVAL = 15 * 60
+
+
+class Prefetch:
+    """Run a call in a background thread, for its result to be taken later on.
+
+    The thread is a daemon, so a build that gave up waiting on it can still exit.
+    The last result taken is kept as `last` for as long as the process lives, along
+        with the `key` it was started with, e.g. the settings it was made with.
+    """
+
+    _future: futures.Future | None
+    _future_key: object
+    last: object | None
+    last_key: object
+    last_at: float | None
+
+    def __init__(self):
+        self._future = self._future_key = None
+        self._lock = threading.Lock()
+        self.forget()
+
+    def start(self, call: Callable[[], object], key: object = None):
+        """Start running `call`, unless the last call started is still running."""
+        future = futures.Future()
+
+        def _run():
+            if not future.set_running_or_notify_cancel():
+                return
+            try:
+                future.set_result(call())
+            except BaseException as e:  # noqa: BLE001
+                # Raised again in whichever thread takes the result.
+                future.set_exception(e)
+
+        with self._lock:
+            if self._future is not None and not self._future.done():
+                return
+            self._future, self._future_key = future, key
+        threading.Thread(
+            target=_run, name="strava-runmap-prefetch", daemon=True
+        ).start()
+
+    @property
+    def pending(self) -> bool:
+        """Whether a call was started, and its result hasn't been taken yet."""
+        return self._future is not None
+
+    @property
+    def done(self) -> bool:
+        future = self._future
+        return future is not None and future.done()
+
+    def take(self, timeout: float | None = None) -> object:
+        """Wait for the started call's result, and keep it as `last`.
+
+        Raises whatever the call raised, or `concurrent.futures.TimeoutError` if it
+            is still running after `timeout` seconds, in which case it can be taken
+            later on. Before Python 3.11 that isn't the builtin `TimeoutError`.
+        """
+        future, key = self._future, self._future_key
+        if not futures.wait([future], timeout).done:
+            raise futures.TimeoutError
+        with self._lock:
+            if self._future is future:
+                self._future = self._future_key = None
+        result = future.result()
+        self.keep(result, key)
+        return result
+
+    def keep(self, result: object, key: object = None):
+        self.last, self.last_key = result, key
+        self.last_at = time.monotonic()
+
+    def forget(self):
+        self.last = self.last_key = self.last_at = None
+
+    @property
+    def age(self) -> float | None:
+        """Seconds since `last` was kept, if there is one."""
+        if self.last_at is None:
+            return None
+        return time.monotonic() - self.last_at
@@ -0,0 +1,198 @@
+"""Remember rendered route SVGs, so unchanged activities aren't re-drawn every build.
+
+Entries are addressed by a hash of the encoded polyline and the render options, so
+    an edited route or a changed setting simply misses rather than going stale.
+There are two tiers: an in-process LRU (which survives `pelican --autoreload`
+    rebuilds) and an on-disk directory in the plugin's cache dir.
+A build that timed out waiting on the prefetch can render alongside it, so entries
+    are written to disk whole, and each build counts its own hits and misses.
+"""
+
+from collections import OrderedDict
+from collections.abc import Callable
+import contextlib
+import dataclasses
+import hashlib
+import logging
+import os
+from pathlib import Path
+import tempfile
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Bump whenever the SVG output changes for the same inputs.
+CACHE_VERSION = "1"
+DEFAULT_MAX_ENTRIES = 4096
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+# Routes without any points are remembered too, as an empty entry.
+NO_SVG = ""
+
+
+def cache_key(encoded_polyline: str, options) -> str:
+    content = "\0".join([CACHE_VERSION, repr(options), encoded_polyline])
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+@dataclasses.dataclass
+class Counts:
+    """Hits and misses of the routes looked up by one build."""
+
+    hits: int = 0
+    misses: int = 0
+
+
+class RenderCache:
+    max_entries: int
+    max_bytes: int
+    cache_dir: Path | None
+
+    def __init__(
+        self,
+        cache_dir: str | os.PathLike | None = None,
+        max_entries: int = DEFAULT_MAX_ENTRIES,
+        max_bytes: int = DEFAULT_MAX_BYTES,
+    ):
+        self._entries: OrderedDict[str, str] = OrderedDict()
+        self._lock = threading.Lock()
+        self.configure(cache_dir, max_entries, max_bytes)
+
+    def configure(
+        self,
+        cache_dir: str | os.PathLike | None,
+        max_entries: int = DEFAULT_MAX_ENTRIES,
+        max_bytes: int = DEFAULT_MAX_BYTES,
+    ):
+        """Point the cache at new settings, keeping whatever is already in memory."""
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        with self._lock:
+            self._trim_memory()
+
+    def _path(self, key: str) -> Path:
+        return self.cache_dir / key[:2] / f"{key}.svg"
+
+    def _trim_memory(self):
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def get(self, key: str) -> str | None:
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+        if self.cache_dir is None:
+            return None
+        path = self._path(key)
+        try:
+            svg = path.read_text(encoding="utf-8")
+        except OSError:
+            return None
+        # Keep recently used entries from being evicted from disk.
+        path.touch()
+        self._remember(key, svg)
+        return svg
+
+    def _remember(self, key: str, svg: str):
+        with self._lock:
+            self._entries[key] = svg
+            self._entries.move_to_end(key)
+            self._trim_memory()
+
+    def put(self, key: str, svg: str):
+        self._remember(key, svg)
+        if self.cache_dir is None:
+            return
+        path = self._path(key)
+        tmp_path = None
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(
+                dir=path.parent, prefix=f"{key}.", suffix=".tmp"
+            )
+            with open(fd, "w", encoding="utf-8") as file:
+                file.write(svg)
+            os.replace(tmp_path, path)
+        except OSError:
+            logger.warning(f"Could not write SVG cache entry {path}", exc_info=True)
+            if tmp_path is not None:
+                with contextlib.suppress(OSError):
+                    os.unlink(tmp_path)
+
+    def get_or_render(
+        self,
+        encoded_polyline: str,
+        options,
+        render: Callable[[str, object], str | None],
+    ) -> str | None:
+        """Get the SVG of `encoded_polyline`, only calling `render` on a miss."""
+
+        def _submit(encoded_polylines: list[str], options):
+            svgs = [render(encoded, options) for encoded in encoded_polylines]
+            return lambda: svgs
+
+        return self.get_or_submit([encoded_polyline], options, _submit)()[0]
+
+    def get_or_submit(
+        self,
+        encoded_polylines: list[str],
+        options,
+        submit: Callable[[list, object], Callable[[], list[str | None]]],
+        routes: list | None = None,
+        counts: Counts | None = None,
+    ) -> Callable[[], list[str | None]]:
+        """Look up the SVGs of many routes, and hand the misses over to `submit`.
+
+        `submit` starts rendering the routes it is given and returns a call that
+            waits for them (see `_svg_interface.SvgRenderer.submit`). Likewise, this
+            returns a call that waits for every SVG, in the order of
+            `encoded_polylines`, and stores the newly rendered ones.
+        If given, `submit` is handed the misses' `routes` (e.g. their decoded
+            coordinates) in place of their encoded polylines.
+        Hits and misses are added to `counts`, if given.
+        """
+        keys = [cache_key(encoded, options) for encoded in encoded_polylines]
+        svgs = [self.get(key) for key in keys]
+        missing = [index for index, svg in enumerate(svgs) if svg is None]
+        if counts is not None:
+            counts.hits += len(svgs) - len(missing)
+            counts.misses += len(missing)
+        routes = encoded_polylines if routes is None else routes
+        wait_for_rendered = (
+            submit([routes[index] for index in missing], options) if missing else list
+        )
+
+        def _wait() -> list[str | None]:
+            for index, svg in zip(missing, wait_for_rendered()):
+                svgs[index] = svg or NO_SVG
+                self.put(keys[index], svgs[index])
+            return [svg or None for svg in svgs]
+
+        return _wait
+
+    def prune(self):
+        """Evict the least recently used files until the disk tier fits `max_bytes`."""
+        if self.cache_dir is None or not self.cache_dir.is_dir():
+            return
+        entries = []
+        total_bytes = 0
+        for path in self.cache_dir.glob("*/*.svg"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                # Evicted by a build pruning at the same time.
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total_bytes += stat.st_size
+        if total_bytes <= self.max_bytes:
+            return
+        entries.sort()
+        evicted = 0
+        for _, size, path in entries:
+            if total_bytes <= self.max_bytes:
+                break
+            path.unlink(missing_ok=True)
+            total_bytes -= size
+            evicted += 1
+        logger.info(f"Evicted {evicted} entries from the SVG cache")
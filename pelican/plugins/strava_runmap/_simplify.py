@@ -0,0 +1,185 @@
+"""Drop route vertices that make no visible difference at the size a route is drawn.
+
+Both algorithms work on projected, scaled points, so the tolerance is in SVG units.
+Points can be a list of `[x, y]` pairs, a flat `x, y, x, y, ...` array('d'), or an
+    (n, 2) numpy array, and the simplified points are returned in the same form.
+"""
+
+from array import array
+from collections.abc import Sequence
+import heapq
+from itertools import chain
+import math
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+DOUGLAS_PEUCKER = "douglas-peucker"
+VISVALINGAM = "visvalingam"
+
+
+class UnknownSimplification(ValueError):
+    def __init__(self, method: str):
+        super().__init__(
+            f"Unknown SIMPLIFY method {method!r}, "
+            f"expected one of {DOUGLAS_PEUCKER!r} or {VISVALINGAM!r}."
+        )
+
+
+class _FlatPoints(Sequence):
+    """`(x, y)` pairs view of a flat coordinate array, without copying it."""
+
+    __slots__ = ("coords",)
+
+    def __init__(self, coords: array):
+        self.coords = coords
+
+    def __len__(self):
+        return len(self.coords) // 2
+
+    def __getitem__(self, index: int) -> tuple[float, float]:
+        if index < 0:
+            index += len(self)
+        return self.coords[2 * index], self.coords[2 * index + 1]
+
+
+def _segment_distances(points, first: int, last: int):
+    """Distance of every point strictly between `first` and `last` to their segment.
+
+    Routes often end where they started, so this measures to the segment (rather than
+        the infinite line) to cope with `first` and `last` being the same point.
+    """
+    if np is not None and isinstance(points, np.ndarray):
+        start, end = points[first], points[last]
+        between = points[first + 1 : last]
+        segment = end - start
+        length_sq = segment @ segment
+        if length_sq:
+            t = np.clip((between - start) @ segment / length_sq, 0, 1)
+            between = between - np.outer(t, segment)
+        return np.hypot(*(between - start).T)
+
+    (start_x, start_y), (end_x, end_y) = points[first], points[last]
+    segment_x, segment_y = end_x - start_x, end_y - start_y
+    length_sq = segment_x * segment_x + segment_y * segment_y
+    distances = []
+    for index in range(first + 1, last):
+        x, y = points[index]
+        t = 0.0
+        if length_sq:
+            t = ((x - start_x) * segment_x + (y - start_y) * segment_y) / length_sq
+            t = min(max(t, 0.0), 1.0)
+        distances.append(
+            math.hypot(x - start_x - t * segment_x, y - start_y - t * segment_y)
+        )
+    return distances
+
+
+def douglas_peucker(points, tolerance: float) -> list[int]:
+    """Find the indices of the points kept by Ramer-Douglas-Peucker simplification.
+
+    Recursively keeps the point farthest from the segment between two kept points,
+        while it is farther than `tolerance`. O(n log n) for typical routes (the
+        worst case is quadratic), with each split measured in a single pass.
+    """
+    if len(points) < 3:  # noqa: PLR2004
+        return list(range(len(points)))
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:  # noqa: PLR2004
+            continue
+        distances = _segment_distances(points, first, last)
+        if np is not None and isinstance(distances, np.ndarray):
+            farthest = int(distances.argmax())
+        else:
+            farthest = max(range(len(distances)), key=distances.__getitem__)
+        if distances[farthest] > tolerance:
+            farthest += first + 1
+            keep[farthest] = True
+            stack.append((first, farthest))
+            stack.append((farthest, last))
+    return [index for index, kept in enumerate(keep) if kept]
+
+
+def _triangle_area(points, a: int, b: int, c: int) -> float:
+    (ax, ay), (bx, by), (cx, cy) = points[a], points[b], points[c]
+    return abs((bx - ax) * (cy - ay) - (cx - ax) * (by - ay)) / 2
+
+
+def visvalingam_whyatt(points, tolerance: float) -> list[int]:
+    """Find the indices of the points kept by Visvalingam-Whyatt simplification.
+
+    Repeatedly drops the point that forms the smallest triangle with its neighbours,
+        until every remaining triangle is at least `tolerance ** 2` in area.
+        O(n log n), using a heap with lazily invalidated entries.
+    """
+    if np is not None and isinstance(points, np.ndarray):
+        points = points.tolist()
+    if len(points) < 3:  # noqa: PLR2004
+        return list(range(len(points)))
+    min_area = tolerance**2
+    previous = list(range(-1, len(points) - 1))
+    following = list(range(1, len(points) + 1))
+    areas = [math.inf] * len(points)
+    for index in range(1, len(points) - 1):
+        areas[index] = _triangle_area(points, index - 1, index, index + 1)
+    heap = [(area, index) for index, area in enumerate(areas) if area < math.inf]
+    heapq.heapify(heap)
+    removed = [False] * len(points)
+
+    while heap:
+        area, index = heapq.heappop(heap)
+        if removed[index] or area != areas[index]:
+            # Superseded by a recalculation after a neighbour was removed.
+            continue
+        if area >= min_area:
+            break
+        removed[index] = True
+        before, after = previous[index], following[index]
+        following[before], previous[after] = after, before
+        for neighbour in (before, after):
+            if previous[neighbour] < 0 or following[neighbour] >= len(points):
+                continue
+            # A neighbour never becomes less significant than what was just removed,
+            #     otherwise points would be dropped out of order.
+            areas[neighbour] = max(
+                area,
+                _triangle_area(
+                    points, previous[neighbour], neighbour, following[neighbour]
+                ),
+            )
+            heapq.heappush(heap, (areas[neighbour], neighbour))
+    return [index for index, dropped in enumerate(removed) if not dropped]
+
+
+SIMPLIFIERS = {
+    DOUGLAS_PEUCKER: douglas_peucker,
+    VISVALINGAM: visvalingam_whyatt,
+}
+
+
+def simplify(points, method: str, tolerance: float):
+    """Simplify `points` with the named `method`, or return them as is if not set."""
+    if not method or tolerance <= 0:
+        return points
+    try:
+        simplifier = SIMPLIFIERS[method]
+    except KeyError:
+        raise UnknownSimplification(method) from None
+    if isinstance(points, array):
+        kept = simplifier(_FlatPoints(points), tolerance)
+        return array(
+            "d",
+            chain.from_iterable(
+                (points[2 * index], points[2 * index + 1]) for index in kept
+            ),
+        )
+    kept = simplifier(points, tolerance)
+    if np is not None and isinstance(points, np.ndarray):
+        return points[kept]
+    return [points[index] for index in kept]
@@ -0,0 +1,237 @@
+"""Find activities by where they are, without scanning every activity for every region.
+
+Items are indexed by their bounding box on a uniform grid of `cell_degrees` sized
+    cells, so a query only looks at the items in the cells it covers. Boxes covering
+    too many cells (usually GPS glitches) are kept aside and checked on every query.
+Routes' bounds are kept in a `BoundsCache`, so they are only decoded once.
+"""
+
+from collections import defaultdict
+from collections.abc import Callable
+import hashlib
+import json
+import logging
+import math
+import os
+from pathlib import Path
+import threading
+
+import polyline
+
+from . import _svg_interface
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CELL_DEGREES = 0.25
+BOUNDS_CACHE_FILENAME = "bounds.json"
+MAX_CELLS_PER_ITEM = 64
+# Bounds are `(south, west, north, east)`, in degrees.
+Bounds = tuple[float, float, float, float]
+
+
+def intersects(bounds: Bounds, other: Bounds) -> bool:
+    south, west, north, east = bounds
+    other_south, other_west, other_north, other_east = other
+    return not (
+        other_north < south
+        or other_south > north
+        or other_east < west
+        or other_west > east
+    )
+
+
+def expand(bounds: Bounds, degrees: float) -> Bounds:
+    south, west, north, east = bounds
+    return south - degrees, west - degrees, north + degrees, east + degrees
+
+
+def union(all_bounds: list[Bounds]) -> Bounds | None:
+    if not all_bounds:
+        return None
+    south, west, north, east = zip(*all_bounds)
+    return min(south), min(west), max(north), max(east)
+
+
+def array_bounds(lat_lon) -> Bounds:
+    """Bounding box of an (n, 2) numpy array of `[lat, lon]` points."""
+    (south, west), (north, east) = lat_lon.min(axis=0), lat_lon.max(axis=0)
+    return float(south), float(west), float(north), float(east)
+
+
+def polyline_bounds(route: _svg_interface.Route) -> Bounds | None:
+    """Bounding box of an encoded polyline (or its coordinates), if it has points."""
+    if _svg_interface.np is not None:
+        lat_lon = _svg_interface.route_array(route)
+        return array_bounds(lat_lon) if len(lat_lon) else None
+    if isinstance(route, str):
+        points = polyline.decode(route, _svg_interface.POLYLINE_PRECISION)
+        lats, lons = [lat for lat, _ in points], [lon for _, lon in points]
+    else:
+        lats, lons = route[0::2], route[1::2]
+    if not lats:
+        return None
+    return min(lats), min(lons), max(lats), max(lons)
+
+
+class SpatialIndex:
+    cell_degrees: float
+
+    def __init__(self, cell_degrees: float = DEFAULT_CELL_DEGREES):
+        self.cell_degrees = cell_degrees
+        self._items = []
+        self._bounds: list[Bounds] = []
+        self._cells: dict[tuple[int, int], list[int]] = defaultdict(list)
+        self._oversized: list[int] = []
+
+    def __len__(self):
+        return len(self._items)
+
+    @property
+    def bounds(self) -> Bounds | None:
+        """Bounds of every item together, or None if the index is empty."""
+        return union(self._bounds)
+
+    def _cell_ranges(self, bounds: Bounds) -> tuple[range, range]:
+        south, west, north, east = bounds
+        rows = range(
+            math.floor(south / self.cell_degrees),
+            math.floor(north / self.cell_degrees) + 1,
+        )
+        cols = range(
+            math.floor(west / self.cell_degrees),
+            math.floor(east / self.cell_degrees) + 1,
+        )
+        return rows, cols
+
+    def insert(self, item, bounds: Bounds):
+        index = len(self._items)
+        self._items.append(item)
+        self._bounds.append(bounds)
+        rows, cols = self._cell_ranges(bounds)
+        if len(rows) * len(cols) > MAX_CELLS_PER_ITEM:
+            self._oversized.append(index)
+            return
+        for row in rows:
+            for col in cols:
+                self._cells[row, col].append(index)
+
+    def _query_indices(self, bounds: Bounds) -> list[int]:
+        rows, cols = self._cell_ranges(bounds)
+        if len(rows) * len(cols) > len(self._cells):
+            # Cheaper to check the cells there are than the ones the query covers.
+            candidates = {
+                index
+                for (row, col), indices in self._cells.items()
+                if row in rows and col in cols
+                for index in indices
+            }
+        else:
+            candidates = {
+                index
+                for row in rows
+                for col in cols
+                for index in self._cells.get((row, col), ())
+            }
+        candidates.update(self._oversized)
+        return sorted(
+            index for index in candidates if intersects(self._bounds[index], bounds)
+        )
+
+    def query(self, bounds: Bounds) -> list:
+        """Find every item intersecting `bounds`, in the order they were inserted."""
+        return [self._items[index] for index in self._query_indices(bounds)]
+
+    def clusters(self, gap: float | None = None) -> list[list]:
+        """Group items in to clusters of boxes no more than `gap` degrees apart.
+
+        Defaults to a gap of one cell. Clusters are in order of their first item.
+        Items too big to put in cells (e.g. GPS glitches spanning continents) are
+            each a cluster of their own, rather than joining everything they span.
+        """
+        gap = self.cell_degrees if gap is None else gap
+        parents = list(range(len(self._items)))
+        oversized = set(self._oversized)
+
+        def _root(index: int) -> int:
+            while parents[index] != index:
+                parents[index] = parents[parents[index]]
+                index = parents[index]
+            return index
+
+        for index, bounds in enumerate(self._bounds):
+            if index in oversized:
+                continue
+            for neighbour in self._query_indices(expand(bounds, gap)):
+                if neighbour not in oversized:
+                    parents[_root(neighbour)] = _root(index)
+
+        clusters = defaultdict(list)
+        for index, item in enumerate(self._items):
+            clusters[_root(index)].append(item)
+        return list(clusters.values())
+
+
+class BoundsCache:
+    """Bounds of routes by a hash of their encoded polyline.
+
+    Kept in memory for as long as the process lives, and as one JSON file in the
+        plugin's cache dir. Only the routes looked up since the process started are
+        written back, so deleted activities drop out of the file.
+    """
+
+    path: Path | None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries: dict[str, Bounds | None] = {}
+        self._used: set[str] = set()
+        self._dirty = False
+        self.configure(None)
+
+    def configure(self, cache_dir: str | os.PathLike | None):
+        """Point the cache at a new cache dir, keeping whatever is already in memory."""
+        path = Path(cache_dir) / BOUNDS_CACHE_FILENAME if cache_dir else None
+        stored = {}
+        if path is not None:
+            try:
+                stored = json.loads(path.read_text(encoding="utf-8"))
+            except (OSError, ValueError):
+                stored = {}
+        with self._lock:
+            self.path = path
+            for key, bounds in stored.items():
+                self._entries.setdefault(key, tuple(bounds) if bounds else None)
+
+    def get(
+        self, encoded_polyline: str, compute: Callable[[], Bounds | None]
+    ) -> Bounds | None:
+        """Get the bounds of a route, calling `compute` for them if not cached."""
+        key = hashlib.sha256(encoded_polyline.encode("utf-8")).hexdigest()
+        with self._lock:
+            if key in self._entries:
+                self._used.add(key)
+                return self._entries[key]
+        bounds = compute()
+        with self._lock:
+            self._entries[key] = bounds
+            self._used.add(key)
+            self._dirty = True
+        return bounds
+
+    def save(self):
+        """Write the bounds looked up so far, if any were new."""
+        with self._lock:
+            if self.path is None or not self._dirty:
+                return
+            entries = {key: self._entries[key] for key in self._used}
+            try:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                tmp_path = self.path.with_suffix(".tmp")
+                tmp_path.write_text(json.dumps(entries), encoding="utf-8")
+                os.replace(tmp_path, self.path)
+            except OSError:
+                logger.warning(
+                    f"Could not write bounds cache {self.path}", exc_info=True
+                )
+                return
+            self._dirty = False
@@ -0,0 +1,118 @@
+"""Move route SVGs out of the page, in to static sprite sheets of `<symbol>`s.
+
+The page then only holds a `<use>` of each route, so it stays small, and the sheets
+    can be cached by browsers and CDNs, being named after a hash of their contents.
+Identical routes become a single symbol, in the sheet of the first group using it.
+Sheets of earlier builds that the page no longer uses are removed as the new ones are
+    written, so they don't pile up in the output.
+"""
+
+from collections import defaultdict
+import hashlib
+import logging
+import os
+from pathlib import Path
+import re
+
+logger = logging.getLogger(__name__)
+
+SPRITE_DIR = "strava-runmap"
+SPRITE_SHEET_TEMPLATE = '<svg xmlns="http://www.w3.org/2000/svg">\n{symbols}\n</svg>\n'
+_SVG_OPEN = re.compile(r"<svg\b([^>]*)>")
+_VIEW_BOX = re.compile(r'\bviewBox="[^"]*"')
+_SHEET_FILENAME = re.compile(r".+-[0-9a-f]{12}\.svg")
+
+
+def symbol_id(svg: str) -> str:
+    return "route-" + hashlib.sha256(svg.encode("utf-8")).hexdigest()[:16]
+
+
+def to_symbol(svg: str, symbol_id: str) -> str:
+    """Turn a complete route `<svg>` in to a `<symbol>` with the same view box."""
+    opening = _SVG_OPEN.search(svg)
+    view_box = _VIEW_BOX.search(opening.group(1))
+    inner = svg[opening.end() : svg.rindex("</svg>")]
+    return f'<symbol id="{symbol_id}" {view_box.group(0)}>{inner}</symbol>'
+
+
+class SpriteSheets:
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self._symbols: dict[str, dict[str, str]] = defaultdict(dict)
+        self._sheet_of: dict[str, str] = {}
+        self._filenames: dict[str, str] = {}
+        self._restored: dict[str, str] = {}
+
+    def __len__(self):
+        return len(self._sheet_of)
+
+    def add(self, sheet: str, svg: str):
+        """Add a route's SVG to `sheet`, unless an identical route was already added.
+
+        Add every route before taking any `reference`, as sheets are named after
+            their contents.
+        """
+        route_id = symbol_id(svg)
+        if route_id not in self._sheet_of:
+            self._sheet_of[route_id] = sheet
+            self._symbols[sheet][route_id] = to_symbol(svg, route_id)
+
+    def _content(self, sheet: str) -> str:
+        return SPRITE_SHEET_TEMPLATE.format(
+            symbols="\n".join(self._symbols[sheet].values())
+        )
+
+    def filename(self, sheet: str) -> str:
+        """Path of a sheet relative to the output directory."""
+        if sheet not in self._filenames:
+            digest = hashlib.sha256(self._content(sheet).encode("utf-8")).hexdigest()
+            self._filenames[sheet] = f"{SPRITE_DIR}/{sheet}-{digest[:12]}.svg"
+        return self._filenames[sheet]
+
+    def reference(self, svg: str, base_url: str) -> str:
+        """Replace a route's SVG with one that `<use>`s its symbol."""
+        route_id = symbol_id(svg)
+        href = f"{base_url}/{self.filename(self._sheet_of[route_id])}#{route_id}"
+        opening = _SVG_OPEN.search(svg).group(0)
+        return f'{opening}<use href="{href}"/></svg>'
+
+    def files(self) -> dict[str, str]:
+        """Contents of every sheet, by its path relative to the output directory."""
+        if self._restored:
+            return self._restored
+        return {self.filename(sheet): self._content(sheet) for sheet in self._symbols}
+
+    def restore(self, files: dict[str, str]):
+        """Replace the sheets with those of an earlier build, as given by `files`."""
+        self.clear()
+        self._restored = files
+
+    def write(self, output_path: str | os.PathLike):
+        """Write every sheet, and remove any sheets left over from earlier builds."""
+        files = self.files()
+        for filename, content in files.items():
+            path = Path(output_path) / filename
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_text(content, encoding="utf-8")
+        logger.info(f"Wrote {len(files)} SVG sprite sheets")
+        self._remove_stale(Path(output_path))
+
+    def _remove_stale(self, output_path: Path):
+        current = {output_path / filename for filename in self.files()}
+        try:
+            stale = [
+                path
+                for path in (output_path / SPRITE_DIR).iterdir()
+                if _SHEET_FILENAME.fullmatch(path.name) and path not in current
+            ]
+        except OSError:
+            return
+        for path in stale:
+            try:
+                path.unlink()
+            except OSError:
+                logger.warning(f"Could not remove stale sprite sheet {path}")
+        if stale:
+            logger.info(f"Removed {len(stale)} stale SVG sprite sheets")
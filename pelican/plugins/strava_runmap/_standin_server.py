@@ -0,0 +1,366 @@
+"""A local stand-in for the parts of the Strava API the plugin uses.
+
+Serves `/oauth/token`, a paginated `/api/v3/activities` and each activity's
+    `latlng` stream from a synthetic or recorded history, with configurable latency,
+    page size and rate limits, and with 429/5xx errors and dropped connections
+    injected at random. Point the plugin at it with `ACTIVITIES_ENDPOINT` and
+    `AUTH_ENDPOINT` to exercise the fetch path end to end without a network.
+
+Run with `invoke standin`, or
+    `python -m pelican.plugins.strava_runmap._standin_server --activities 1000`.
+"""
+
+import argparse
+from collections import Counter
+import dataclasses
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import logging
+from pathlib import Path
+import random
+import threading
+import time
+from urllib.parse import parse_qs, urlsplit
+
+import polyline
+
+from . import _activity_store, _strava_interface, _synthetic
+
+logger = logging.getLogger(__name__)
+
+AUTH_PATH = "/oauth/token"
+ACTIVITIES_PATH = "/api/v3/activities"
+ACCESS_TOKEN = "standin-access-token"
+TOKEN_LIFETIME_SECONDS = 6 * 60 * 60
+STREAMS_PATH = "/streams"
+# Streams have this many points between each pair of summary polyline points,
+#     standing in for the detail a summary polyline leaves out.
+STREAM_DENSITY = 4
+
+
+@dataclasses.dataclass(frozen=True, slots=True)
+class StandinOptions:
+    # Seconds added to every response.
+    latency: float = 0.0
+    # The most activities a page holds, whatever `per_page` asks for.
+    max_per_page: int = _strava_interface.DEFAULT_PER_PAGE
+    # 15-minute and daily request limits, reported in the rate limit headers.
+    short_limit: int = 100
+    daily_limit: int = 1000
+    # Fractions of requests answered with one of `error_statuses`, or dropped.
+    error_rate: float = 0.0
+    error_statuses: tuple[int, ...] = (429, 500, 502, 503)
+    drop_rate: float = 0.0
+    seed: int = 0
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server: "_StandinHTTPServer"
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        logger.debug(f"{self.address_string()} {format % args}")
+
+    def _send_json(self, status: int, body, headers: dict[str, str] | None = None):
+        content = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def _handle(self, respond):
+        standin = self.server.standin
+        if self.headers.get("Content-Length"):
+            self.rfile.read(int(self.headers["Content-Length"]))
+        time.sleep(standin.options.latency)
+        outcome = standin.roll()
+        if outcome == "drop":
+            # Hang up without a response, like a connection reset mid-request.
+            self.close_connection = True
+            return
+        headers = standin.count_request()
+        if outcome is not None:
+            self._send_json(
+                outcome, {"message": "Injected error"}, {"Retry-After": "0", **headers}
+            )
+        elif standin.rate_limited():
+            self._send_json(
+                HTTPStatus.TOO_MANY_REQUESTS,
+                {"message": "Rate Limit Exceeded"},
+                headers,
+            )
+        else:
+            respond(headers)
+
+    def do_POST(self):
+        if urlsplit(self.path).path != AUTH_PATH:
+            self._send_json(HTTPStatus.NOT_FOUND, {"message": "Not Found"})
+            return
+
+        def _respond(headers):
+            self._send_json(
+                HTTPStatus.OK,
+                {
+                    "token_type": "Bearer",
+                    "access_token": ACCESS_TOKEN,
+                    "expires_at": int(time.time()) + TOKEN_LIFETIME_SECONDS,
+                    "expires_in": TOKEN_LIFETIME_SECONDS,
+                },
+                headers,
+            )
+
+        self._handle(_respond)
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        path = url.path.rstrip("/")
+        if path != ACTIVITIES_PATH and not (
+            path.startswith(f"{ACTIVITIES_PATH}/") and path.endswith(STREAMS_PATH)
+        ):
+            self._send_json(HTTPStatus.NOT_FOUND, {"message": "Not Found"})
+            return
+        if self.headers.get("Authorization") != f"Bearer {ACCESS_TOKEN}":
+            self._send_json(HTTPStatus.UNAUTHORIZED, {"message": "Authorization Error"})
+            return
+
+        def _respond(headers):
+            standin = self.server.standin
+            if path == ACTIVITIES_PATH:
+                params = {
+                    key: values[-1] for key, values in parse_qs(url.query).items()
+                }
+                self._send_json(HTTPStatus.OK, standin.page(params), headers)
+                return
+            activity_id = path[len(ACTIVITIES_PATH) + 1 : -len(STREAMS_PATH)]
+            stream = standin.stream(activity_id)
+            if stream is None:
+                self._send_json(
+                    HTTPStatus.NOT_FOUND, {"message": "Record Not Found"}, headers
+                )
+            else:
+                self._send_json(HTTPStatus.OK, stream, headers)
+
+        self._handle(_respond)
+
+
+class _StandinHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    standin: "StandinServer"
+
+
+class StandinServer:
+    """Serve `activities` (Strava responses, newest first) on a local port.
+
+    Use as a context manager, or `start` and `stop` it. `port=0` picks a free port.
+    """
+
+    activities: list[dict]
+    options: StandinOptions
+    counts: Counter
+
+    def __init__(
+        self,
+        activities: list[dict],
+        options: StandinOptions | None = None,
+        host: str = "127.0.0.1",
+        port: int = 0,
+    ):
+        self.activities = activities
+        self.options = options or StandinOptions()
+        self.counts = Counter()
+        self._random = random.Random(self.options.seed)
+        self._lock = threading.Lock()
+        self._short_window = self._short_usage = self._daily_usage = 0
+        self._httpd = _StandinHTTPServer((host, port), _Handler)
+        self._httpd.standin = self
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def settings(self) -> dict[str, str]:
+        """Plugin settings that point `StravaAPI` at this server."""
+        return {
+            "ACTIVITIES_ENDPOINT": f"{self.url}{ACTIVITIES_PATH}",
+            "AUTH_ENDPOINT": f"{self.url}{AUTH_PATH}",
+            "CLIENT_ID": "standin",
+            "CLIENT_SECRET": "standin",
+            "REFRESH_TOKEN": "standin",
+        }
+
+    def roll(self) -> str | int | None:
+        """Pick whether to drop a request, fail it with a status, or serve it."""
+        with self._lock:
+            roll = self._random.random()
+            if roll < self.options.drop_rate:
+                self.counts["dropped"] += 1
+                return "drop"
+            if roll < self.options.drop_rate + self.options.error_rate:
+                status = self._random.choice(self.options.error_statuses)
+                self.counts[status] += 1
+                return status
+        return None
+
+    def count_request(self) -> dict[str, str]:
+        """Count a request against the rate limits, returning the headers for it."""
+        now = time.time()
+        with self._lock:
+            window = int(now // _strava_interface.RATE_LIMIT_WINDOW_SECONDS)
+            if window != self._short_window:
+                self._short_window, self._short_usage = window, 0
+            self._short_usage += 1
+            self._daily_usage += 1
+            self.counts["requests"] += 1
+            return {
+                "X-RateLimit-Limit": (
+                    f"{self.options.short_limit},{self.options.daily_limit}"
+                ),
+                "X-RateLimit-Usage": f"{self._short_usage},{self._daily_usage}",
+            }
+
+    def rate_limited(self) -> bool:
+        with self._lock:
+            return (
+                self._short_usage > self.options.short_limit
+                or self._daily_usage > self.options.daily_limit
+            )
+
+    def page(self, params: dict[str, str]) -> list[dict]:
+        """Filter and paginate the activities like Strava's list activities endpoint."""
+        activities = self.activities
+        if "before" in params:
+            before = int(params["before"])
+            activities = [
+                activity
+                for activity in activities
+                if _activity_store.start_timestamp(activity) < before
+            ]
+        if "after" in params:
+            after = int(params["after"])
+            activities = [
+                activity
+                for activity in activities
+                if _activity_store.start_timestamp(activity) > after
+            ]
+        per_page = min(int(params.get("per_page", 30)), self.options.max_per_page)
+        start = (int(params.get("page", 1)) - 1) * per_page
+        with self._lock:
+            self.counts["activities"] += len(activities[start : start + per_page])
+        return activities[start : start + per_page]
+
+    def stream(self, activity_id: str) -> dict | None:
+        """Make up the `latlng` stream of an activity, if it has a route."""
+        activity = next(
+            (
+                activity
+                for activity in self.activities
+                if str(activity["id"]) == activity_id
+            ),
+            None,
+        )
+        if activity is None or not (activity.get("map") or {}).get("summary_polyline"):
+            return None
+        points = polyline.decode(activity["map"]["summary_polyline"])
+        lat_lon = [list(points[0])]
+        for (lat, lon), (next_lat, next_lon) in zip(points, points[1:]):
+            lat_lon.extend(
+                [
+                    lat + (next_lat - lat) * step / STREAM_DENSITY,
+                    lon + (next_lon - lon) * step / STREAM_DENSITY,
+                ]
+                for step in range(1, STREAM_DENSITY + 1)
+            )
+        with self._lock:
+            self.counts["streams"] += 1
+        return {
+            "latlng": {
+                "type": "latlng",
+                "data": lat_lon,
+                "series_type": "distance",
+                "original_size": len(lat_lon),
+                "resolution": "high",
+            }
+        }
+
+    def start(self) -> "StandinServer":
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def serve_forever(self):
+        """Serve in this thread until interrupted."""
+        try:
+            self._httpd.serve_forever()
+        finally:
+            self._httpd.server_close()
+
+    def __enter__(self) -> "StandinServer":
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def load_recorded(path: str) -> list[dict]:
+    """Read a recorded history: a JSON list, or JSON lines like the activity store."""
+    text = Path(path).read_text(encoding="utf-8")
+    if text.lstrip().startswith("["):
+        return json.loads(text)
+    return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+
+def main(argv: list[str] | None = None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    data = parser.add_mutually_exclusive_group()
+    data.add_argument(
+        "--activities", type=int, default=1000, help="Serve N synthetic activities"
+    )
+    data.add_argument("--recorded", help="Serve activities from a JSON(L) file")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    for field in dataclasses.fields(StandinOptions):
+        if field.name != "error_statuses":
+            parser.add_argument(
+                f"--{field.name.replace('_', '-')}",
+                type=type(field.default),
+                default=field.default,
+            )
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    activities = (
+        load_recorded(args.recorded)
+        if args.recorded
+        else _synthetic.synthetic_activities(args.activities)
+    )
+    options = StandinOptions(
+        **{
+            field.name: getattr(args, field.name)
+            for field in dataclasses.fields(StandinOptions)
+            if field.name != "error_statuses"
+        }
+    )
+    server = StandinServer(activities, options, args.host, args.port)
+    for key, value in server.settings.items():
+        logger.info(f'"{key}": "{value}",')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info(f"Served {dict(server.counts)}")
+
+
+if __name__ == "__main__":
+    main()
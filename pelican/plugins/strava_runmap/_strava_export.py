@@ -0,0 +1,399 @@
+"""Read activities from a Strava bulk export, instead of from the Strava API.
+
+Strava's "Download or Delete Your Account" archive has an `activities.csv` listing
+    every activity, and an `activities/` directory with the recorded track of each.
+    The archive can be used as a zip, or unpacked to a directory.
+Tracks are GPX or TCX files (gzipped or not), parsed a point at a time with
+    `iterparse` in worker processes, then downsampled like `HIGH_FIDELITY` streams.
+    Activities recorded as FIT files are listed without a route, as there is no FIT
+    parser in the standard library.
+Parsed tracks are cached in the plugin's cache dir by file and modification time, or
+    by content hash if only the modification time has changed.
+
+https://support.strava.com/hc/en-us/articles/216918437-Exporting-your-Data-and-Bulk-Export
+"""
+
+from collections.abc import Collection, Iterator
+from concurrent.futures import ProcessPoolExecutor
+import contextlib
+import csv
+from datetime import datetime, timezone
+import gzip
+import hashlib
+import io
+import json
+import logging
+import os
+from pathlib import Path
+from typing import IO
+import xml.etree.ElementTree as ET
+import zipfile
+
+import zoneinfo
+
+from . import _activity_store, _metrics, _strava_interface, _streams
+
+logger = logging.getLogger(__name__)
+
+ACTIVITIES_CSV = "activities.csv"
+CACHE_FILENAME = "export.json"
+# Bump whenever tracks are parsed or downsampled differently.
+CACHE_VERSION = "1"
+# e.g. `Oct 30, 2023, 12:02:49 AM`, in UTC.
+CSV_DATE_FORMAT = "%b %d, %Y, %I:%M:%S %p"
+TRACK_SUFFIXES = (".gpx", ".tcx")
+FIT_SUFFIX = ".fit"
+DEFAULT_TIMEZONE = "UTC"
+HASH_CHUNK_BYTES = 1024 * 1024
+
+
+class StravaExportError(Exception):
+    def __init__(self, path: str, message: str):
+        super().__init__(f"Could not read the Strava export at {path}: {message}")
+
+
+def _local_name(tag: str) -> str:
+    """Drop the `{namespace}` of an XML tag, GPX and TCX have several versions."""
+    return tag.rpartition("}")[2]
+
+
+def _iter_gpx_points(track: IO[bytes]) -> Iterator[tuple[float, float]]:
+    for _, element in ET.iterparse(track):
+        if _local_name(element.tag) == "trkpt":
+            yield float(element.get("lat")), float(element.get("lon"))
+            element.clear()
+
+
+def _iter_tcx_points(track: IO[bytes]) -> Iterator[tuple[float, float]]:
+    lat = lon = None
+    for _, element in ET.iterparse(track):
+        tag = _local_name(element.tag)
+        if tag == "LatitudeDegrees":
+            lat = float(element.text)
+        elif tag == "LongitudeDegrees":
+            lon = float(element.text)
+        elif tag == "Trackpoint":
+            # Trackpoints without a position (e.g. paused, or indoors) are skipped.
+            if lat is not None and lon is not None:
+                yield lat, lon
+            lat = lon = None
+            element.clear()
+
+
+def _open(source: str | zipfile.ZipFile, name: str) -> IO[bytes]:
+    """Open a file of the export, from the zip it is in or the directory it is in."""
+    if isinstance(source, zipfile.ZipFile):
+        return source.open(name)
+    return open(os.path.join(source, name), "rb")
+
+
+@contextlib.contextmanager
+def _open_track(source: str | zipfile.ZipFile, name: str) -> Iterator[IO[bytes]]:
+    """Open a track of the export, unzipping it as it is read if it is gzipped."""
+    with _open(source, name) as track:
+        if name.endswith(".gz"):
+            with gzip.GzipFile(fileobj=track) as unzipped:
+                yield unzipped
+        else:
+            yield track
+
+
+def parse_track(source: str | zipfile.ZipFile, name: str, resolution: int) -> str:
+    """Read a GPX or TCX track of the export as a downsampled, encoded polyline."""
+    with _open_track(source, name) as track:
+        iter_points = (
+            _iter_tcx_points
+            if name.removesuffix(".gz").endswith(".tcx")
+            else _iter_gpx_points
+        )
+        try:
+            lat_lon = list(iter_points(track))
+        except (ET.ParseError, OSError, ValueError):
+            logger.warning(f"Could not parse the track {name}", exc_info=True)
+            return _streams.NO_STREAM
+    return _streams.downsample(lat_lon, resolution)
+
+
+def _content_hash(source: str | zipfile.ZipFile, name: str) -> str:
+    digest = hashlib.sha256()
+    with _open(source, name) as track:
+        while chunk := track.read(HASH_CHUNK_BYTES):
+            digest.update(chunk)
+    return f"sha256:{digest.hexdigest()}"
+
+
+def _parse_tracks(
+    export_path: str,
+    names: list[str],
+    resolution: int,
+    unhashed: Collection[str] = (),
+) -> list[tuple[str, str | None]]:
+    """Parse a batch of tracks, reading a zipped export's index only once.
+
+    Tracks in `unhashed` are hashed along the way, so a worker reads them in place
+        of the main process.
+    """
+
+    def _parse(source: str | zipfile.ZipFile, name: str) -> tuple[str, str | None]:
+        content_hash = _content_hash(source, name) if name in unhashed else None
+        return parse_track(source, name, resolution), content_hash
+
+    if not zipfile.is_zipfile(export_path):
+        return [_parse(export_path, name) for name in names]
+    with zipfile.ZipFile(export_path) as archive:
+        return [_parse(archive, name) for name in names]
+
+
+def _column(header: list[str], *names: str) -> int | None:
+    """Index of the column of the first of `names` that the export has."""
+    for name in names:
+        if name in header:
+            return header.index(name)
+    return None
+
+
+class StravaExport:
+    """A Strava bulk export, as a source of activities in place of `StravaAPI`.
+
+    Activities come out like activity responses of the Strava API, trimmed to what
+        the activity store keeps, so they go through `StravaRouteData` the same way.
+    """
+
+    export_path: str
+    cache_path: Path | None
+    timezone: zoneinfo.ZoneInfo
+    resolution: int
+    workers: int
+    per_page: int
+    # Never anything to fall back to, the export is already local.
+    activity_store = None
+
+    def __init__(self, client_settings: dict):
+        self.export_path = str(client_settings["EXPORT_PATH"])
+        cache_dir = client_settings.get("CACHE_DIR")
+        self.cache_path = Path(cache_dir) / CACHE_FILENAME if cache_dir else None
+        self.timezone = zoneinfo.ZoneInfo(
+            client_settings.get("EXPORT_TIMEZONE") or DEFAULT_TIMEZONE
+        )
+        self.resolution = int(
+            client_settings.get("HIGH_FIDELITY_RESOLUTION")
+            or _streams.DEFAULT_RESOLUTION
+        )
+        self.workers = int(client_settings.get("EXPORT_WORKERS") or os.cpu_count())
+        self.per_page = int(
+            client_settings.get("PER_PAGE") or _strava_interface.DEFAULT_PER_PAGE
+        )
+
+    def _read_csv(self) -> list[list[str]]:
+        try:
+            if zipfile.is_zipfile(self.export_path):
+                with zipfile.ZipFile(self.export_path) as archive:
+                    content = archive.read(ACTIVITIES_CSV)
+            else:
+                content = Path(self.export_path, ACTIVITIES_CSV).read_bytes()
+        except (OSError, KeyError) as e:
+            raise StravaExportError(self.export_path, str(e)) from e
+        return list(csv.reader(io.StringIO(content.decode("utf-8-sig"))))
+
+    def _fingerprints(self, names: list[str]) -> dict[str, tuple[list, str | None]]:
+        """Cheap `[modification time, size]` of every track, to spot changed files.
+
+        Zip members come with the CRC of their content as well, where files have to
+            be hashed, which is only done once their modification time has changed.
+        """
+        if zipfile.is_zipfile(self.export_path):
+            with zipfile.ZipFile(self.export_path) as archive:
+                infos = {info.filename: info for info in archive.infolist()}
+            return {
+                name: (
+                    [list(infos[name].date_time), infos[name].file_size],
+                    f"crc32:{infos[name].CRC:08x}",
+                )
+                for name in names
+                if name in infos
+            }
+        fingerprints = {}
+        for name in names:
+            try:
+                stat = os.stat(os.path.join(self.export_path, name))
+            except OSError:
+                continue
+            fingerprints[name] = ([stat.st_mtime_ns, stat.st_size], None)
+        return fingerprints
+
+    def _load_cache(self) -> dict[str, dict]:
+        if self.cache_path is None:
+            return {}
+        try:
+            cache = json.loads(self.cache_path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return {}
+        if (
+            cache.get("version") != CACHE_VERSION
+            or cache.get("resolution") != self.resolution
+        ):
+            return {}
+        return cache.get("tracks", {})
+
+    def _save_cache(self, tracks: dict[str, dict]):
+        if self.cache_path is None:
+            return
+        cache = {
+            "version": CACHE_VERSION,
+            "resolution": self.resolution,
+            "tracks": tracks,
+        }
+        try:
+            self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.cache_path.with_suffix(".tmp")
+            tmp_path.write_text(json.dumps(cache), encoding="utf-8")
+            os.replace(tmp_path, self.cache_path)
+        except OSError:
+            logger.warning(
+                f"Could not write export cache {self.cache_path}", exc_info=True
+            )
+
+    def _tracks(self, names: list[str]) -> dict[str, str]:
+        """Get the tracks as encoded polylines, parsing only those not cached."""
+        cached = self._load_cache()
+        fingerprints = self._fingerprints(names)
+        entries = {}
+        to_parse = []
+        for name, (fingerprint, known_hash) in fingerprints.items():
+            entry = cached.get(name)
+            if entry is not None and entry["fingerprint"] == fingerprint:
+                entries[name] = entry
+                continue
+            content_hash = known_hash
+            if entry is not None:
+                content_hash = content_hash or _content_hash(self.export_path, name)
+                if entry["hash"] == content_hash:
+                    entries[name] = {**entry, "fingerprint": fingerprint}
+                    continue
+            entries[name] = {"fingerprint": fingerprint, "hash": content_hash}
+            to_parse.append(name)
+
+        if to_parse:
+            logger.info(f"Parsing {len(to_parse)} tracks of the Strava export")
+            # New tracks are parsed whatever their hash, so are hashed as they are.
+            unhashed = {name for name in to_parse if entries[name]["hash"] is None}
+            with _metrics.METRICS.span("export.parse_tracks"):
+                for name, (encoded, content_hash) in zip(
+                    to_parse, self._parse(to_parse, unhashed)
+                ):
+                    entries[name]["polyline"] = encoded
+                    if content_hash is not None:
+                        entries[name]["hash"] = content_hash
+            _metrics.METRICS.count("export.tracks_parsed", len(to_parse))
+        if entries != cached:
+            self._save_cache(entries)
+        return {name: entry["polyline"] for name, entry in entries.items()}
+
+    def _parse(
+        self, names: list[str], unhashed: set[str]
+    ) -> list[tuple[str, str | None]]:
+        if self.workers < 2 or len(names) < 2:  # noqa: PLR2004
+            return _parse_tracks(self.export_path, names, self.resolution, unhashed)
+        batch_size = max(len(names) // (self.workers * 4), 1)
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            batches = [
+                executor.submit(
+                    _parse_tracks,
+                    self.export_path,
+                    names[start : start + batch_size],
+                    self.resolution,
+                    unhashed,
+                )
+                for start in range(0, len(names), batch_size)
+            ]
+            return [encoded for batch in batches for encoded in batch.result()]
+
+    def _strava_date(self, value: str) -> tuple[str, str, str]:
+        """UTC start date, local start date and timezone, as Strava writes them."""
+        start = datetime.strptime(value, CSV_DATE_FORMAT).replace(tzinfo=timezone.utc)
+        local_start = start.astimezone(self.timezone)
+        offset = local_start.strftime("%z")
+        return (
+            start.strftime(_strava_interface.STRAVA_DT_FORMAT),
+            local_start.strftime(_strava_interface.STRAVA_DT_FORMAT),
+            f"(GMT{offset[:3]}:{offset[3:]}) {self.timezone.key}",
+        )
+
+    def load(self) -> list[dict]:
+        """Read every activity of the export, newest first."""
+        rows = self._read_csv()
+        if not rows:
+            return []
+        header, rows = rows[0], rows[1:]
+        id_column = _column(header, "Activity ID")
+        date_column = _column(header, "Activity Date")
+        name_column = _column(header, "Activity Name")
+        filename_column = _column(header, "Filename")
+        moving_time_column = _column(header, "Moving Time", "Elapsed Time")
+        # Newer exports have the distance in km, and again later on in metres.
+        distance_columns = [
+            index for index, column in enumerate(header) if column == "Distance"
+        ]
+        if None in (id_column, date_column, filename_column) or not distance_columns:
+            raise StravaExportError(
+                self.export_path, f"unexpected {ACTIVITIES_CSV} columns"
+            )
+
+        names = [
+            row[filename_column]
+            for row in rows
+            if row[filename_column].removesuffix(".gz").endswith(TRACK_SUFFIXES)
+        ]
+        skipped = sum(
+            row[filename_column].removesuffix(".gz").endswith(FIT_SUFFIX)
+            for row in rows
+        )
+        if skipped:
+            logger.info(f"Listing {skipped} activities recorded as FIT without routes")
+        tracks = self._tracks(names)
+
+        activities = []
+        for row in rows:
+            start_date, start_date_local, timezone_name = self._strava_date(
+                row[date_column]
+            )
+            distance = float((row[distance_columns[-1]] or "0").replace(",", ""))
+            if len(distance_columns) == 1:
+                distance *= 1000
+            moving_time = (
+                row[moving_time_column] if moving_time_column is not None else ""
+            )
+            activities.append(
+                {
+                    "id": int(row[id_column]),
+                    "name": row[name_column] if name_column is not None else "",
+                    "distance": distance,
+                    "moving_time": int(float(moving_time or 0)),
+                    "start_date": start_date,
+                    "start_date_local": start_date_local,
+                    "timezone": timezone_name,
+                    "map": {
+                        "id": f"a{row[id_column]}",
+                        "summary_polyline": tracks.get(row[filename_column], ""),
+                        "resource_state": 2,
+                    },
+                }
+            )
+        activities.sort(key=_activity_store.start_timestamp, reverse=True)
+        return activities
+
+    def iter_activities(self) -> Iterator[list[_strava_interface.StravaRouteData]]:
+        """Yield every activity of the export a page at a time, newest first."""
+        activities = self.load()
+        _metrics.METRICS.count("export.activities", len(activities))
+        for start in range(0, len(activities), self.per_page):
+            yield [
+                _strava_interface.StravaRouteData.from_strava_data(activity)
+                for activity in activities[start : start + self.per_page]
+            ]
+
+    def fetch_activities(self) -> list[_strava_interface.StravaRouteData]:
+        return [activity for page in self.iter_activities() for activity in page]
+
+    def cached_activities(self) -> list[_strava_interface.StravaRouteData]:
+        return self.fetch_activities()
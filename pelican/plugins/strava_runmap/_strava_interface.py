@@ -3,16 +3,45 @@
 https://developers.strava.com/docs/reference/#api-Activities-getLoggedInAthleteActivities
 """
 
+from collections import deque
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
 import dataclasses
 from datetime import datetime
 from decimal import Decimal
+import functools
+import logging
+import random
+import threading
+import time
 
 import requests
+from requests.adapters import HTTPAdapter
 import zoneinfo
 
+from . import _activity_store, _metrics, _streams
+
+logger = logging.getLogger(__name__)
+
 STRAVA_DT_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
 DEFAULT_ACTIVITIES_ENDPOINT = "https://www.strava.com/api/v3/activities"
 DEFAULT_AUTH_ENDPOINT = "https://www.strava.com/oauth/token"
+# Strava's maximum page size. Fewer, bigger pages means fewer requests against quota.
+DEFAULT_PER_PAGE = 200
+DEFAULT_FETCH_WORKERS = 4
+DAY_SECONDS = 24 * 60 * 60
+# Strava's short-term limit resets on the natural quarter hour, the daily one at
+#     midnight UTC.
+RATE_LIMIT_WINDOW_SECONDS = 15 * 60
+# The general limits, and the (stricter) limits for read requests.
+RATE_LIMIT_HEADER_PREFIXES = ("X-RateLimit", "X-ReadRateLimit")
+RETRY_STATUS_CODES = frozenset({429, 500, 502, 503, 504})
+DEFAULT_RATE_LIMIT_FRACTION = 0.9
+DEFAULT_MAX_RETRIES = 5
+DEFAULT_RATE_LIMIT_MAX_WAIT = RATE_LIMIT_WINDOW_SECONDS
+MAX_BACKOFF_SECONDS = 60
+# Refresh access tokens a little before Strava says they expire.
+TOKEN_EXPIRY_MARGIN_SECONDS = 60
 
 
 class StravaAuthorizationError(Exception): ...
@@ -33,20 +62,44 @@ class StravaAPIError(Exception):
         )
 
 
-@dataclasses.dataclass
+class StravaRateLimitExceeded(StravaAPIError):
+    def __init__(self, window: str):
+        super().__init__(f"the {window} rate limit budget has been used up")
+
+
+@functools.cache
+def strava_timezone(timezone: str | None) -> zoneinfo.ZoneInfo:
+    """Look up one of Strava's timezones, once per name however many activities."""
+    try:
+        # Strava gives us timezones in the form of `(GMT+09:00) Asia/Tokyo`, but
+        #     zoneinfo expects just the latter named part.
+        name = timezone.split()[1]
+    except (AttributeError, IndexError):
+        name = ""
+    return zoneinfo.ZoneInfo(name)
+
+
+@dataclasses.dataclass(frozen=True, slots=True)
 class AthleteData:
     id: int
     resource_state: int
 
 
-@dataclasses.dataclass
+@dataclasses.dataclass(frozen=True, slots=True)
 class MapData:
     id: str
     summary_polyline: str
     resource_state: int
+    # The downsampled GPS stream, with `HIGH_FIDELITY`.
+    polyline: str = ""
+
+    @property
+    def route_polyline(self) -> str:
+        """The most detailed route we have, to draw the activity with."""
+        return self.polyline or self.summary_polyline
 
 
-@dataclasses.dataclass
+@dataclasses.dataclass(frozen=True, slots=True)
 class StravaRouteData:
     """Represents the actual API response from Strava.
 
@@ -65,10 +118,10 @@ class StravaRouteData:
     # type: str
     # sport_type: str
     # workout_type: None
-    # id: id
+    id: int
     # external_id: str
     # upload_id: int
-    # start_date: datetime
+    start_date: datetime
     start_date_local: datetime
     timezone: zoneinfo.ZoneInfo
     # utc_offset: int
@@ -108,20 +161,15 @@ class StravaRouteData:
 
     @classmethod
     def from_strava_data(cls, strava_response: dict):
-        # athlete_data = strava_response.pop("athlete")
-        map_data = strava_response.pop("map")
-        try:
-            # Strava gives us timezones in the form of `(GMT+09:00) Asia/Tokyo`, but
-            #     zoneinfo expects just the latter named part.
-            timezone = strava_response["timezone"].split()[1]
-        except (AttributeError, IndexError):
-            timezone = ""
+        # athlete_data = strava_response["athlete"]
         return cls(
-            start_date_local=datetime.strptime(
-                strava_response["start_date_local"], STRAVA_DT_FORMAT
+            id=strava_response["id"],
+            start_date=_activity_store.parse_datetime(strava_response["start_date"]),
+            start_date_local=_activity_store.parse_datetime(
+                strava_response["start_date_local"]
             ),
-            timezone=zoneinfo.ZoneInfo(timezone),
-            map=MapData(**map_data),
+            timezone=strava_timezone(strava_response["timezone"]),
+            map=MapData(**strava_response["map"]),
             name=strava_response["name"],
             distance=strava_response["distance"],
             moving_time=strava_response["moving_time"],
@@ -135,13 +183,190 @@ class ActivitySvg:
     height: int
 
 
+@dataclasses.dataclass(frozen=True, slots=True)
+class AccessToken:
+    access_token: str
+    # Epoch seconds.
+    expires_at: float
+    # Strava may hand out a new refresh token along with the access token.
+    refresh_token: str
+
+    @property
+    def expired(self) -> bool:
+        return time.time() >= self.expires_at - TOKEN_EXPIRY_MARGIN_SECONDS
+
+
+# Access tokens by auth endpoint, client ID and configured refresh token, kept for
+#     as long as the process lives so that rebuilds with `pelican --autoreload` don't
+#     each ask for a new one.
+ACCESS_TOKENS: dict[tuple[str, str, str], AccessToken] = {}
+
+
+@dataclasses.dataclass
+class RateLimitBudget:
+    """Requests left before the pacing threshold of each window, if known yet."""
+
+    short_term: int | None = None
+    daily: int | None = None
+
+
+class RequestScheduler:
+    """Pace requests to stay under Strava's rate limits, and retry transient failures.
+
+    Every Strava response carries `limit,usage` pairs for the 15-minute and daily
+        windows. Requests are only sent while usage is below `budget_fraction` of
+        both limits: a spent 15-minute window is waited out (up to `max_wait`
+        seconds), a spent daily window raises `StravaRateLimitExceeded`.
+    429s, 5xxs and dropped connections are retried with jittered exponential backoff.
+
+    https://developers.strava.com/docs/rate-limits/
+    """
+
+    budget_fraction: float
+    max_retries: int
+    max_wait: float
+    short_limit: int | None
+    short_usage: int
+    daily_limit: int | None
+    daily_usage: int
+
+    def __init__(
+        self,
+        budget_fraction: float = DEFAULT_RATE_LIMIT_FRACTION,
+        max_retries: int = DEFAULT_MAX_RETRIES,
+        max_wait: float = DEFAULT_RATE_LIMIT_MAX_WAIT,
+    ):
+        self.budget_fraction = budget_fraction
+        self.max_retries = max_retries
+        self.max_wait = max_wait
+        self.short_limit = self.daily_limit = None
+        self.short_usage = self.daily_usage = 0
+        self._short_window_start = self._day_start = 0
+        self._lock = threading.Lock()
+
+    @property
+    def budget(self) -> RateLimitBudget:
+        with self._lock:
+            self._roll_windows(time.time())
+            return RateLimitBudget(
+                short_term=self._remaining(self.short_limit, self.short_usage),
+                daily=self._remaining(self.daily_limit, self.daily_usage),
+            )
+
+    def _remaining(self, limit: int | None, usage: int) -> int | None:
+        if limit is None:
+            return None
+        return max(int(limit * self.budget_fraction) - usage, 0)
+
+    def _roll_windows(self, now: float):
+        """Forget usage from windows that have reset since we last heard from Strava."""
+        short_window_start = now - now % RATE_LIMIT_WINDOW_SECONDS
+        if short_window_start > self._short_window_start:
+            self._short_window_start = short_window_start
+            self.short_usage = 0
+        day_start = now - now % DAY_SECONDS
+        if day_start > self._day_start:
+            self._day_start = day_start
+            self.daily_usage = 0
+
+    def update(self, headers):
+        """Take the tightest of the limits reported in a response's headers."""
+        budgets = []
+        for prefix in RATE_LIMIT_HEADER_PREFIXES:
+            try:
+                short_limit, daily_limit = (
+                    int(value) for value in headers[f"{prefix}-Limit"].split(",")
+                )
+                short_usage, daily_usage = (
+                    int(value) for value in headers[f"{prefix}-Usage"].split(",")
+                )
+            except (KeyError, ValueError):
+                continue
+            budgets.append((short_limit, short_usage, daily_limit, daily_usage))
+        if not budgets:
+            return
+        with self._lock:
+            self._roll_windows(time.time())
+            self.short_limit, self.short_usage = min(
+                ((limit, usage) for limit, usage, _, _ in budgets),
+                key=lambda pair: pair[0] - pair[1],
+            )
+            self.daily_limit, self.daily_usage = min(
+                ((limit, usage) for _, _, limit, usage in budgets),
+                key=lambda pair: pair[0] - pair[1],
+            )
+
+    def _acquire(self):
+        """Block until there is budget for one more request, then claim it."""
+        while True:
+            with self._lock:
+                now = time.time()
+                self._roll_windows(now)
+                if self._remaining(self.daily_limit, self.daily_usage) == 0:
+                    raise StravaRateLimitExceeded("daily")
+                if self._remaining(self.short_limit, self.short_usage) != 0:
+                    # Count the request now, responses only tell us about it later.
+                    self.short_usage += 1
+                    self.daily_usage += 1
+                    return
+                wait = self._short_window_start + RATE_LIMIT_WINDOW_SECONDS - now
+            if wait > self.max_wait:
+                raise StravaRateLimitExceeded("15-minute")
+            logger.info(f"Strava rate limit budget used up, waiting {int(wait)}s")
+            time.sleep(wait)
+
+    def _backoff(self, attempt: int, retry_after: str | None = None):
+        try:
+            delay = float(retry_after)
+        except (TypeError, ValueError):
+            delay = random.uniform(0, min(MAX_BACKOFF_SECONDS, 2**attempt))
+        time.sleep(delay)
+
+    def request(self, send, *args, **kwargs) -> requests.Response:
+        """Send a request with `send` (e.g. `session.get`) within the rate limits."""
+        for attempt in range(self.max_retries + 1):
+            self._acquire()
+            _metrics.METRICS.count("strava.requests")
+            if attempt:
+                _metrics.METRICS.count("strava.retries")
+            try:
+                with _metrics.METRICS.span("strava.request"):
+                    response = send(*args, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt == self.max_retries:
+                    raise StravaAPIError(str(e)) from e
+                logger.info(f"Strava request failed ({e}), retrying")
+                self._backoff(attempt)
+                continue
+            self.update(response.headers)
+            if (
+                response.status_code not in RETRY_STATUS_CODES
+                or attempt == self.max_retries
+            ):
+                return response
+            logger.info(f"Strava responded {response.status_code}, retrying")
+            self._backoff(attempt, response.headers.get("Retry-After"))
+        return response
+
+
 class StravaAPI:
     activities_endpoint: str
+    auth_endpoint: str
     stored_auth_token: str
     client_id: str
     client_secret: str
     refresh_token: str
     dry_run: bool
+    activity_store: _activity_store.ActivityStore | None
+    full_resync: bool
+    resync_window_days: int
+    per_page: int
+    fetch_workers: int
+    high_fidelity: bool
+    stream_resolution: int
+    stream_store: _streams.StreamStore | None
+    session: requests.Session
+    scheduler: RequestScheduler
 
     def __init__(self, client_settings: dict[str, str], auth_token: str | None = None):
         self.client_id = client_settings["CLIENT_ID"]
@@ -151,7 +376,44 @@ class StravaAPI:
         self.activities_endpoint = (
             client_settings.get("ACTIVITIES_ENDPOINT") or DEFAULT_ACTIVITIES_ENDPOINT
         )
+        self.auth_endpoint = (
+            client_settings.get("AUTH_ENDPOINT") or DEFAULT_AUTH_ENDPOINT
+        )
         self.dry_run = bool(client_settings.get("STRAVA_DRY_RUN"))
+        cache_dir = client_settings.get("CACHE_DIR")
+        self.activity_store = (
+            _activity_store.ActivityStore(cache_dir) if cache_dir else None
+        )
+        self.full_resync = bool(client_settings.get("FULL_RESYNC"))
+        self.resync_window_days = int(client_settings.get("RESYNC_WINDOW_DAYS") or 0)
+        self.per_page = int(client_settings.get("PER_PAGE") or DEFAULT_PER_PAGE)
+        self.fetch_workers = int(
+            client_settings.get("FETCH_WORKERS") or DEFAULT_FETCH_WORKERS
+        )
+        self.high_fidelity = bool(client_settings.get("HIGH_FIDELITY"))
+        self.stream_resolution = int(
+            client_settings.get("HIGH_FIDELITY_RESOLUTION")
+            or _streams.DEFAULT_RESOLUTION
+        )
+        self.stream_store = _streams.StreamStore(cache_dir) if cache_dir else None
+        self._streams_paused = False
+        # One keep-alive session for every request, with enough pooled connections
+        #     for each fetch worker to hold on to its own.
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=self.fetch_workers)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.scheduler = RequestScheduler(
+            budget_fraction=float(
+                client_settings.get("RATE_LIMIT_FRACTION")
+                or DEFAULT_RATE_LIMIT_FRACTION
+            ),
+            max_retries=int(client_settings.get("MAX_RETRIES") or DEFAULT_MAX_RETRIES),
+            max_wait=float(
+                client_settings.get("RATE_LIMIT_MAX_WAIT")
+                or DEFAULT_RATE_LIMIT_MAX_WAIT
+            ),
+        )
 
     def get_auth_token(self) -> str:
         if self.stored_auth_token:
@@ -160,48 +422,288 @@ class StravaAPI:
         if not all([self.client_id, self.client_secret, self.refresh_token]):
             raise StravaAPIMisconfigured()
 
-        resp = requests.post(
-            DEFAULT_AUTH_ENDPOINT,
-            {
-                "client_id": self.client_id,
-                "client_secret": self.client_secret,
-                "refresh_token": self.refresh_token,
-                "grant_type": "refresh_token",
-            },
-        )
+        token_key = (self.auth_endpoint, self.client_id, self.refresh_token)
+        cached = ACCESS_TOKENS.get(token_key)
+        if cached is not None and not cached.expired:
+            self.stored_auth_token = cached.access_token
+            return cached.access_token
+
+        with _metrics.METRICS.span("strava.auth"):
+            resp = self.scheduler.request(
+                self.session.post,
+                self.auth_endpoint,
+                {
+                    "client_id": self.client_id,
+                    "client_secret": self.client_secret,
+                    "refresh_token": (
+                        self.refresh_token if cached is None else cached.refresh_token
+                    ),
+                    "grant_type": "refresh_token",
+                },
+            )
         if not resp.ok:
             raise StravaAuthorizationError(resp.content)
 
-        access_token = resp.json().get("access_token")
+        token = resp.json()
+        access_token = token.get("access_token")
         self.stored_auth_token = access_token
+        if token.get("expires_at"):
+            ACCESS_TOKENS[token_key] = AccessToken(
+                access_token=access_token,
+                expires_at=float(token["expires_at"]),
+                refresh_token=token.get("refresh_token") or self.refresh_token,
+            )
         return access_token
 
+    @property
+    def remaining_budget(self) -> RateLimitBudget:
+        """What's left of the rate limits, to decide whether to fall back to cache."""
+        return self.scheduler.budget
+
     @property
     def auth_headers(self) -> dict[str, str]:
         return {"Authorization": f"Bearer {self.get_auth_token()}"}
 
     def fetch_activities(self) -> list[StravaRouteData]:
-        routes = []
+        """Get every activity of the logged in athlete."""
+        with _metrics.METRICS.span("strava.fetch_activities"):
+            return [activity for page in self.iter_activities() for activity in page]
+
+    def iter_activities(self) -> Iterator[list[StravaRouteData]]:
+        """Yield every activity of the logged in athlete a page at a time, newest first.
+
+        Without an activity store, every page is fetched from Strava.
+        With one, only activities newer than the latest stored activity are fetched
+            and merged in to the store (see `_iter_synced_pages`).
+        While a page is being worked on by the caller, the following pages are
+            already being downloaded.
+        """
         if self.dry_run:
-            return routes
-
-        def _fetch_from_strava(req_page: int = 1):
-            run_url = f"{self.activities_endpoint}?page={req_page}"
-            response = requests.get(run_url, headers=self.auth_headers)
-            if response.ok:
-                routes.extend(
-                    [
-                        StravaRouteData.from_strava_data(route)
-                        for route in response.json()
-                    ]
-                )
+            return
+
+        if self.activity_store is None:
+            pages = self._iter_activity_pages()
+        else:
+            pages = self._iter_synced_pages()
+        for page in pages:
+            with _metrics.METRICS.span("strava.from_strava_data"):
+                activities = [StravaRouteData.from_strava_data(route) for route in page]
+            _metrics.METRICS.count("strava.activities", len(activities))
+            if self.high_fidelity:
+                activities = self.add_streams(activities)
+            yield activities
+
+    def add_streams(
+        self, activities: list[StravaRouteData], fetch: bool = True
+    ) -> list[StravaRouteData]:
+        """Give every activity with a map its downsampled GPS stream, if it has one.
+
+        Streams are read from the stream store, and those not stored yet are fetched
+            `fetch_workers` at a time. Stream requests only spend what is left of the
+            rate limits after keeping `fetch_workers` requests back for the activity
+            pages, and are put off until the next build once that runs out.
+        """
+        streams = {}
+        missing = []
+        for activity in activities:
+            if not activity.map or not activity.map.summary_polyline:
+                # Nothing was recorded to have a stream of.
+                continue
+            stored = self.stream_store.get(activity.id) if self.stream_store else None
+            if stored is None:
+                missing.append(activity.id)
             else:
-                raise StravaAPIError(response.content)
-            return req_page + 1
-
-        prev_len = -1  # Anything other than 0 to kick off the loop.
-        page = 1
-        while prev_len != len(routes):
-            prev_len = len(routes)
-            page = _fetch_from_strava(page)
-        return routes
+                streams[activity.id] = stored
+        if fetch and missing and not self._streams_paused:
+            headers = self.auth_headers
+            with ThreadPoolExecutor(max_workers=self.fetch_workers) as executor:
+                fetching = [
+                    (
+                        activity_id,
+                        executor.submit(self._fetch_stream, activity_id, headers),
+                    )
+                    for activity_id in missing
+                ]
+                for activity_id, future in fetching:
+                    try:
+                        streams[activity_id] = future.result()
+                    except StravaRateLimitExceeded:
+                        if not self._streams_paused:
+                            logger.info(
+                                "Rate limit budget for activity streams used up, "
+                                "the rest are fetched on a later build"
+                            )
+                        self._streams_paused = True
+                    except StravaAPIError:
+                        logger.warning(
+                            f"Could not fetch the stream of activity {activity_id}",
+                            exc_info=True,
+                        )
+        return [
+            (
+                dataclasses.replace(
+                    activity,
+                    map=dataclasses.replace(
+                        activity.map, polyline=streams[activity.id]
+                    ),
+                )
+                if streams.get(activity.id)
+                else activity
+            )
+            for activity in activities
+        ]
+
+    def _fetch_stream(self, activity_id: int, headers: dict[str, str]) -> str:
+        """Download, downsample and store the GPS stream of an activity."""
+        budget = self.scheduler.budget
+        if self._streams_paused or any(
+            remaining is not None and remaining < self.fetch_workers
+            for remaining in (budget.short_term, budget.daily)
+        ):
+            raise StravaRateLimitExceeded("stream")
+        response = self.scheduler.request(
+            self.session.get,
+            f"{self.activities_endpoint}/{activity_id}/streams",
+            params={"keys": "latlng", "key_by_type": "true"},
+            headers=headers,
+        )
+        if response.status_code == requests.codes.too_many_requests:
+            raise StravaRateLimitExceeded("15-minute")
+        if response.status_code == requests.codes.not_found:
+            # Manual and indoor activities have no streams to speak of.
+            encoded = _streams.NO_STREAM
+        elif not response.ok:
+            raise StravaAPIError(response.content)
+        else:
+            _metrics.METRICS.count("strava.bytes", len(response.content))
+            with _metrics.METRICS.span("strava.downsample_stream"):
+                lat_lon = response.json().get("latlng", {}).get("data", [])
+                encoded = _streams.downsample(lat_lon, self.stream_resolution)
+        _metrics.METRICS.count("strava.streams")
+        if self.stream_store is not None:
+            self.stream_store.put(activity_id, encoded)
+        return encoded
+
+    def _fetch_page(
+        self, page: int, params: dict, headers: dict[str, str]
+    ) -> list[dict]:
+        response = self.scheduler.request(
+            self.session.get,
+            self.activities_endpoint,
+            params={"page": page, "per_page": self.per_page, **params},
+            headers=headers,
+        )
+        if response.status_code == requests.codes.too_many_requests:
+            raise StravaRateLimitExceeded("15-minute")
+        if not response.ok:
+            raise StravaAPIError(response.content)
+        _metrics.METRICS.count("strava.bytes", len(response.content))
+        with _metrics.METRICS.span("strava.parse_json"):
+            return _activity_store.parse_activities(response.content)
+
+    def _iter_activity_pages(self, **params) -> Iterator[list[dict]]:
+        """Yield each page of the activities endpoint, in page order.
+
+        The first page is fetched on its own, so an incremental sync that fits in one
+            page costs one request. After that, `fetch_workers` pages are kept in
+            flight speculatively, and fetching stops at the first short page.
+        """
+        headers = self.auth_headers
+        page_routes = self._fetch_page(1, params, headers)
+        if len(page_routes) < self.per_page:
+            if page_routes:
+                yield page_routes
+            return
+
+        with ThreadPoolExecutor(max_workers=self.fetch_workers) as executor:
+            next_page = 2 + self.fetch_workers
+            in_flight = deque(
+                executor.submit(self._fetch_page, page, params, headers)
+                for page in range(2, next_page)
+            )
+            try:
+                yield page_routes
+                while True:
+                    page_routes = in_flight.popleft().result()
+                    if len(page_routes) < self.per_page:
+                        if page_routes:
+                            yield page_routes
+                        return
+                    # Keep the pool busy while the caller works on this page.
+                    in_flight.append(
+                        executor.submit(self._fetch_page, next_page, params, headers)
+                    )
+                    next_page += 1
+                    yield page_routes
+            finally:
+                # Pages past the end (or past a failure) are of no use to anyone.
+                for future in in_flight:
+                    future.cancel()
+
+    def cached_activities(self) -> list[StravaRouteData]:
+        """Whatever is in the activity store, without talking to Strava at all."""
+        if self.activity_store is None:
+            return []
+        activities = [
+            StravaRouteData.from_strava_data(route)
+            for route in self.activity_store.load()
+        ]
+        if self.high_fidelity:
+            activities = self.add_streams(activities, fetch=False)
+        return activities
+
+    def _iter_synced_pages(self) -> Iterator[list[dict]]:
+        """Bring the activity store up to date and yield its contents a page at a time.
+
+        The store is refreshed with `after=<latest stored start_date>`, so a build with
+            nothing new costs a single request. `RESYNC_WINDOW_DAYS` moves that
+            boundary back so recent edits and deletions are picked up too, and
+            `FULL_RESYNC` (or an empty store) re-downloads everything. Pages of a full
+            download are passed on as they arrive, rather than after the last one.
+        If a download of the full history is cut short, the pages fetched so far are
+            kept and the next build carries on with `before=<oldest stored
+            start_date>` rather than starting over.
+        """
+        stored = [] if self.full_resync else self.activity_store.load()
+        backfill_pending = not stored or self.activity_store.backfill_pending
+        latest = _activity_store.latest_timestamp(stored)
+        after = (
+            None if latest is None else latest - self.resync_window_days * DAY_SECONDS
+        )
+        evict_after = None
+        fetched: list[dict] = []
+        try:
+            if after is not None:
+                for page in self._iter_activity_pages(after=after):
+                    fetched.extend(page)
+                # Only a completed fetch can tell us what was deleted.
+                evict_after = after
+            if backfill_pending:
+                oldest = _activity_store.oldest_timestamp(stored)
+                logger.info("Fetching full activity history")
+                for page in self._iter_activity_pages(
+                    **({} if oldest is None else {"before": oldest})
+                ):
+                    fetched.extend(page)
+                    if not stored:
+                        # Newest first already, nothing to merge it with.
+                        yield page
+                backfill_pending = False
+        except StravaAPIError:
+            if fetched and not self.full_resync:
+                logger.warning(
+                    f"Fetch interrupted, keeping {len(fetched)} fetched activities "
+                    "to resume from on the next build"
+                )
+                self.activity_store.save(
+                    self.activity_store.merge(stored, fetched),
+                    backfill_pending=backfill_pending,
+                )
+            raise
+        logger.info(f"Fetched {len(fetched)} new or updated activities")
+        activities = self.activity_store.save(
+            self.activity_store.merge(stored, fetched, after=evict_after)
+        )
+        if stored:
+            for start in range(0, len(activities), self.per_page):
+                yield activities[start : start + self.per_page]
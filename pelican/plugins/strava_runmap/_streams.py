@@ -0,0 +1,87 @@
+"""Keep full resolution GPS tracks, downsampled to the size they are drawn at.
+
+Strava's `summary_polyline` is heavily generalized, which shows on larger renderings.
+    An activity's `latlng` stream has every recorded point instead, far more than
+    can be drawn. Streams are downsampled as they are downloaded and kept as encoded
+    polylines, one file per activity in the plugin's cache dir. A finished activity's
+    GPS track doesn't change, so they are kept for good.
+
+https://developers.strava.com/docs/reference/#api-Streams-getActivityStreams
+"""
+
+import logging
+import math
+import os
+from pathlib import Path
+
+import polyline
+
+from . import _simplify
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+logger = logging.getLogger(__name__)
+
+STREAMS_DIRNAME = "streams"
+# Matches the default heatmap resolution, well past the size of a thumbnail.
+DEFAULT_RESOLUTION = 512
+POLYLINE_PRECISION = 5
+# Stored for activities without a GPS stream, so they aren't asked for again.
+NO_STREAM = ""
+
+
+def downsample(lat_lon: list[list[float]], resolution: int = DEFAULT_RESOLUTION) -> str:
+    """Drop the points of a track that wouldn't show at `resolution`, and encode it.
+
+    Points are simplified with Douglas-Peucker to within half a pixel of a
+        `resolution` pixel rendering of the track's own bounds. Degrees of longitude
+        are scaled down to the length of a degree of latitude in the middle of the
+        track, which is close enough to Mercator over the span of one activity.
+    """
+    if not lat_lon:
+        return NO_STREAM
+    if np is not None:
+        points = np.asarray(lat_lon, dtype=float)[:, ::-1].copy()
+        points[:, 0] *= math.cos(math.radians(points[:, 1].mean()))
+        extent = float((points.max(axis=0) - points.min(axis=0)).max())
+    else:
+        scale = math.cos(math.radians(sum(lat for lat, _ in lat_lon) / len(lat_lon)))
+        points = [(lon * scale, lat) for lat, lon in lat_lon]
+        xs, ys = [x for x, _ in points], [y for _, y in points]
+        extent = max(max(xs) - min(xs), max(ys) - min(ys))
+    kept = _simplify.douglas_peucker(points, extent / resolution / 2)
+    return polyline.encode(
+        [tuple(lat_lon[index]) for index in kept], POLYLINE_PRECISION
+    )
+
+
+class StreamStore:
+    """Downsampled tracks by activity id, as encoded polylines."""
+
+    path: Path
+
+    def __init__(self, cache_dir: str | os.PathLike):
+        self.path = Path(cache_dir) / STREAMS_DIRNAME
+
+    def _path(self, activity_id: int) -> Path:
+        return self.path / f"{activity_id}.polyline"
+
+    def get(self, activity_id: int) -> str | None:
+        """Get the stored track, `NO_STREAM` if it has none, or None if not fetched."""
+        try:
+            return self._path(activity_id).read_text(encoding="ascii")
+        except OSError:
+            return None
+
+    def put(self, activity_id: int, encoded_polyline: str):
+        path = self._path(activity_id)
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = path.with_suffix(".tmp")
+            tmp_path.write_text(encoded_polyline, encoding="ascii")
+            os.replace(tmp_path, path)
+        except OSError:
+            logger.warning(f"Could not write stream cache entry {path}", exc_info=True)
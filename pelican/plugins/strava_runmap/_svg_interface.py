@@ -1,11 +1,28 @@
+from array import array
+from collections.abc import Callable
+from concurrent.futures import ProcessPoolExecutor
 import dataclasses
+from itertools import chain
+import logging
 import math
 
 import polyline
 
-from . import _strava_interface
+from . import _metrics, _simplify, _strava_interface
+
+try:
+    import numpy as np
+except ImportError:
+    # Optional, everything has a (slower) pure python fallback.
+    np = None
+
+logger = logging.getLogger(__name__)
 
 EARTH_RADIUS_KM = 6378137.0
+POLYLINE_PRECISION = 5
+DEFAULT_RENDER_BATCH_SIZE = 50
+# Below this many routes to draw, starting worker processes costs more than it saves.
+DEFAULT_PARALLEL_RENDER_MIN = 500
 
 SVG_TEMPLATE = "\n".join(
     [
@@ -16,14 +33,56 @@ SVG_TEMPLATE = "\n".join(
         "</svg>",
     ]
 )
+# No transform needed, y is flipped when the points are projected.
+SVG_PATH_TEMPLATE = (
+    '<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 {width} {height}" '
+    'class="h-32"><path d="{path}" fill="none" stroke="black"/></svg>'
+)
+SVG_FORMAT_POLYLINE = "polyline"
+SVG_FORMAT_PATH = "path"
+DEFAULT_SVG_PRECISION = 1
 
 
-@dataclasses.dataclass
+@dataclasses.dataclass(slots=True)
 class ActivitySvg:
-    points: list[list[float]]
+    # One buffer of floats from decoding through to drawing, rather than a list per
+    #     point: a flat `x, y, x, y, ...` array('d'), or an (n, 2) float64 array
+    #     when numpy is installed.
+    coords: array
     width: int
     height: int
 
+    @property
+    def points(self):
+        """The coordinates as `(x, y)` pairs."""
+        if isinstance(self.coords, array):
+            return list(zip(self.coords[0::2], self.coords[1::2]))
+        return self.coords
+
+    @property
+    def vertex_count(self) -> int:
+        if isinstance(self.coords, array):
+            return len(self.coords) // 2
+        return len(self.coords)
+
+
+# An encoded polyline, or its decoded `lat, lon, lat, lon, ...` as a flat buffer of
+#     32 bit floats (see `_activity_archive`).
+Route = str | memoryview | array
+
+
+@dataclasses.dataclass(frozen=True, slots=True)
+class RenderOptions:
+    """Everything that changes how a route is drawn (and so its cached SVG)."""
+
+    width: int = 50
+    height: int = 50
+    padding: int = 10
+    simplify: str = ""
+    tolerance: float = 0.0
+    svg_format: str = SVG_FORMAT_POLYLINE
+    precision: int = DEFAULT_SVG_PRECISION
+
 
 def y2lat(y):
     return math.degrees(2 * math.atan(math.exp(y / EARTH_RADIUS_KM)) - math.pi / 2.0)
@@ -41,53 +100,353 @@ def lon2x(lon):
     return math.radians(lon) * EARTH_RADIUS_KM
 
 
+def decode_polyline_array(encoded: str, precision: int = POLYLINE_PRECISION):
+    """Decode a Google encoded polyline in to an (n, 2) array of `[lat, lon]`.
+
+    Equivalent to `polyline.decode`, but works on the whole string at once: every
+        character carries 5 bits of a value and flags whether the value continues in
+        the next character, so values can be reassembled with array operations.
+    https://developers.google.com/maps/documentation/utilities/polylinealgorithm
+    """
+    chunks = np.frombuffer(encoded.encode("ascii"), dtype=np.uint8).astype(np.int64)
+    chunks -= 63
+    value_ends = np.flatnonzero(chunks < 0x20)  # noqa: PLR2004
+    # Drop a trailing incomplete value, as well as a lat without its lon.
+    value_count = len(value_ends) // 2 * 2
+    if not value_count:
+        return np.empty((0, 2))
+    chunks = chunks[: value_ends[value_count - 1] + 1]
+    value_starts = np.concatenate(([0], value_ends[: value_count - 1] + 1))
+    value_lengths = np.diff(np.append(value_starts, len(chunks)))
+    chunk_shifts = (np.arange(len(chunks)) - np.repeat(value_starts, value_lengths)) * 5
+    values = np.add.reduceat((chunks & 0x1F) << chunk_shifts, value_starts)
+    values = np.where(values & 1, ~(values >> 1), values >> 1)
+    return np.cumsum(values.reshape(-1, 2), axis=0) / 10**precision
+
+
+def route_array(route: Route):
+    """Get the (n, 2) array of `[lat, lon]` of a route, decoding it if need be."""
+    if isinstance(route, str):
+        return decode_polyline_array(route)
+    return np.frombuffer(route, dtype=np.float32).reshape(-1, 2).astype(float)
+
+
+def _scale_to_fit(width: int, height: int, map_width: float, map_height: float):
+    """Largest scale that fits the map in the box, ignoring zero-size dimensions."""
+    scales = [
+        box_size / map_size
+        for box_size, map_size in ((width, map_width), (height, map_height))
+        if map_size
+    ]
+    return min(scales) if scales else 1.0
+
+
+def _extract_svg_data_vectorized(
+    route: Route, width: int, height: int, padding: int, *, flip_y: bool
+) -> ActivitySvg | None:
+    """Array version of `extract_svg_data`, the whole route in a handful of passes."""
+    lat_lon = route_array(route)
+    if not len(lat_lon):
+        return None
+    # Use Mercator points so route doesn't look slightly off when flattened.
+    points = np.empty_like(lat_lon)
+    np.radians(lat_lon[:, 1], out=points[:, 0])
+    np.radians(lat_lon[:, 0], out=points[:, 1])
+    points[:, 1] = np.log(np.tan(math.pi / 4 + points[:, 1] / 2))
+    points *= EARTH_RADIUS_KM
+
+    min_xy, max_xy = points.min(axis=0), points.max(axis=0)
+    map_width, map_height = max_xy - min_xy
+    scale = _scale_to_fit(width, height, map_width, map_height)
+    points -= (max_xy + min_xy) / 2
+    points *= scale
+    points += (width / 2, height / 2)
+    if flip_y:
+        np.subtract(height + padding, points[:, 1], out=points[:, 1])
+    return ActivitySvg(coords=points, width=width + padding, height=height + padding)
+
+
 def convert_to_svg(activity_svg: ActivitySvg) -> str:
     # {% for coords in svg.points %}{{ coords.0 }},{{ coords.1 }} {% endfor %}
-    points = " ".join([f"{x},{y}" for (x, y) in activity_svg.points])
+    coords = activity_svg.coords
+    if isinstance(coords, array):
+        points = " ".join(
+            [
+                f"{coords[index]},{coords[index + 1]}"
+                for index in range(0, len(coords), 2)
+            ]
+        )
+    else:
+        points = " ".join([f"{x},{y}" for (x, y) in coords.tolist()])
 
     return SVG_TEMPLATE.format(
         width=activity_svg.width, height=activity_svg.height, points=points
     )
 
 
-def extract_svg_data(
+def extract_svg_data(  # noqa: PLR0913
     activity: _strava_interface.StravaRouteData,
     width: int = 50,
     height: int = 50,
     padding: int = 10,
+    *,
+    simplify: str = "",
+    tolerance: float = 0.0,
 ) -> ActivitySvg | None:
     """Translate the geocoordinates of an activity to points for SVG drawing."""
-    point_list = [
-        list(coords) for coords in polyline.decode(activity.map.summary_polyline)
+    return extract_polyline_svg_data(
+        activity.map.route_polyline,
+        width,
+        height,
+        padding,
+        simplify=simplify,
+        tolerance=tolerance,
+    )
+
+
+def extract_polyline_svg_data(  # noqa: PLR0913
+    route: Route,
+    width: int = 50,
+    height: int = 50,
+    padding: int = 10,
+    *,
+    simplify: str = "",
+    tolerance: float = 0.0,
+    flip_y: bool = False,
+) -> ActivitySvg | None:
+    """Translate an encoded polyline (or its coordinates) to points for SVG drawing.
+
+    Uses numpy if it is installed, and falls back to plain python otherwise.
+    If `simplify` names one of `_simplify.SIMPLIFIERS`, points that are within
+        `tolerance` (in SVG units) of the simplified route are dropped.
+    With `flip_y`, y runs downwards like SVG's, rather than upwards like latitude.
+    """
+    with _metrics.METRICS.span("svg.decode_and_project"):
+        if np is not None:
+            activity_svg = _extract_svg_data_vectorized(
+                route, width, height, padding, flip_y=flip_y
+            )
+        else:
+            activity_svg = _extract_svg_data_python(
+                route, width, height, padding, flip_y=flip_y
+            )
+    if activity_svg is None:
+        return None
+    if _metrics.METRICS.enabled:
+        _metrics.METRICS.count("svg.vertices", activity_svg.vertex_count)
+    if simplify:
+        with _metrics.METRICS.span("svg.simplify"):
+            activity_svg.coords = _simplify.simplify(
+                activity_svg.coords, simplify, tolerance
+            )
+        if _metrics.METRICS.enabled:
+            _metrics.METRICS.count("svg.vertices_kept", activity_svg.vertex_count)
+    return activity_svg
+
+
+def _format_fixed(value: int, precision: int) -> str:
+    """Write an integer count of `10 ** -precision` units as a short decimal."""
+    if not precision:
+        return str(value)
+    sign = "-" if value < 0 else ""
+    whole, fraction = divmod(abs(value), 10**precision)
+    fraction_digits = f"{fraction:0{precision}d}".rstrip("0")
+    if not fraction_digits:
+        return f"{sign}{whole}"
+    return f"{sign}{whole or ''}.{fraction_digits}"
+
+
+def _path_steps(grid_points) -> list[tuple[int, int]]:
+    """Relative steps between grid points, with collinear runs merged in to one."""
+    if np is not None and isinstance(grid_points, np.ndarray):
+        steps = np.diff(grid_points, axis=0)
+        steps = steps[steps.any(axis=1)]
+        if not len(steps):
+            return []
+        previous, current = steps[:-1], steps[1:]
+        collinear = (
+            previous[:, 0] * current[:, 1] == previous[:, 1] * current[:, 0]
+        ) & ((previous * current).sum(axis=1) > 0)
+        run_starts = np.flatnonzero(np.concatenate(([True], ~collinear)))
+        return np.add.reduceat(steps, run_starts).tolist()
+
+    steps: list[list[int]] = []
+    for (x, y), (next_x, next_y) in zip(grid_points, grid_points[1:]):
+        dx, dy = next_x - x, next_y - y
+        if not dx and not dy:
+            continue
+        if steps:
+            last_dx, last_dy = steps[-1]
+            if last_dx * dy == last_dy * dx and last_dx * dx + last_dy * dy > 0:
+                steps[-1] = [last_dx + dx, last_dy + dy]
+                continue
+        steps.append([dx, dy])
+    return steps
+
+
+def convert_to_svg_path(activity_svg: ActivitySvg, precision: int) -> str:
+    """Draw points (projected with `flip_y`) as a compact `<path>`.
+
+    Points are snapped to a grid of `10 ** -precision` units, and drawn as relative
+        `l` steps between grid points so numbers stay short. Steps that carry on in
+        the same direction are merged, and steps that don't move are dropped.
+    """
+    grid_scale = 10**precision
+    if isinstance(activity_svg.coords, array):
+        grid_points = [
+            (round(x * grid_scale), round(y * grid_scale))
+            for x, y in activity_svg.points
+        ]
+    else:
+        grid_points = np.rint(activity_svg.coords * grid_scale).astype(np.int64)
+    start_x, start_y = (int(value) for value in grid_points[0])
+    numbers = [
+        _format_fixed(value, precision)
+        for step in _path_steps(grid_points)
+        for value in step
     ]
-    if point_list:
-        x_values: list[float] = []
-        y_values: list[float] = []
+    # A minus sign separates numbers just as well as a space does.
+    steps = "".join(
+        number if number.startswith("-") else f" {number}" for number in numbers
+    )
+    path = f"M{_format_fixed(start_x, precision)} {_format_fixed(start_y, precision)}"
+    if steps:
+        path += f"l{steps.lstrip()}"
+    return SVG_PATH_TEMPLATE.format(
+        width=activity_svg.width, height=activity_svg.height, path=path
+    )
+
+
+def render_svg(route: Route, options: RenderOptions) -> str | None:
+    """Draw a route as a complete SVG, if it has any points to draw."""
+    as_path = options.svg_format == SVG_FORMAT_PATH
+    activity_svg = extract_polyline_svg_data(
+        route,
+        options.width,
+        options.height,
+        options.padding,
+        simplify=options.simplify,
+        tolerance=options.tolerance,
+        flip_y=as_path,
+    )
+    if not activity_svg:
+        return None
+    with _metrics.METRICS.span("svg.format"):
+        if as_path:
+            return convert_to_svg_path(activity_svg, options.precision)
+        return convert_to_svg(activity_svg)
 
-        for lat, lon in point_list:
+
+def _extract_svg_data_python(
+    route: Route, width: int, height: int, padding: int, *, flip_y: bool
+) -> ActivitySvg | None:
+    # Decoded `lat, lon` pairs are flattened straight in to the buffer that is then
+    #     projected and scaled in place.
+    coords = array(
+        "d",
+        (
+            chain.from_iterable(polyline.decode(route))
+            if isinstance(route, str)
+            else route
+        ),
+    )
+    if coords:
+        for index in range(0, len(coords), 2):
+            lat, lon = coords[index], coords[index + 1]
             # Use Mercator points so route doesn't look slightly off when flattened.
-            projected_x = lon2x(lon)
-            projected_y = lat2y(lat)
-            x_values.append(projected_x)
-            y_values.append(projected_y)
+            coords[index] = lon2x(lon)
+            coords[index + 1] = lat2y(lat)
 
+        x_values, y_values = coords[0::2], coords[1::2]
         max_x, max_y = max(x_values), max(y_values)
         min_x, min_y = min(x_values), min(y_values)
         map_width = max_x - min_x
         map_height = max_y - min_y
         center_x = (max_x + min_x) / 2
         center_y = (max_y + min_y) / 2
-        scale = min(width / map_width, height / map_height)
+        scale = _scale_to_fit(width, height, map_width, map_height)
+        for index in range(0, len(coords), 2):
+            coords[index] = (coords[index] - center_x) * scale + width / 2
+            coords[index + 1] = (coords[index + 1] - center_y) * scale + height / 2
+            if flip_y:
+                coords[index + 1] = height + padding - coords[index + 1]
         return ActivitySvg(
-            points=[
-                [
-                    (x - center_x) * scale + width / 2,
-                    (y - center_y) * scale + height / 2,
-                ]
-                for x, y in zip(x_values, y_values)
-            ],
+            coords=coords,
             width=width + padding,
             height=height + padding,
         )
 
     return None
+
+
+def render_svgs(routes: list[Route], options: RenderOptions) -> list[str | None]:
+    return [render_svg(route, options) for route in routes]
+
+
+def _picklable(route: Route) -> str | array:
+    """Copy a slice of a memory-mapped archive, to send it to a worker process."""
+    if isinstance(route, memoryview):
+        return array(route.format, route.tobytes())
+    return route
+
+
+class SvgRenderer:
+    """Render batches of routes, in worker processes once there are enough of them.
+
+    Only the routes and render options are sent to the workers, and the
+        SVGs come back in the order they were submitted. Until `min_parallel` routes
+        have been submitted (or with fewer than 2 `workers`), routes are rendered
+        in this process, so small or mostly cached histories never start a pool.
+    """
+
+    workers: int
+    batch_size: int
+    min_parallel: int
+
+    def __init__(
+        self,
+        workers: int = 1,
+        batch_size: int = DEFAULT_RENDER_BATCH_SIZE,
+        min_parallel: int = DEFAULT_PARALLEL_RENDER_MIN,
+    ):
+        self.workers = workers
+        self.batch_size = batch_size
+        self.min_parallel = min_parallel
+        self._submitted = 0
+        self._executor: ProcessPoolExecutor | None = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(cancel_futures=True)
+            self._executor = None
+
+    def submit(
+        self, routes: list[Route], options: RenderOptions
+    ) -> Callable[[], list[str | None]]:
+        """Start rendering `routes`, returning a call that waits for them."""
+        self._submitted += len(routes)
+        if self.workers < 2 or self._submitted < self.min_parallel:  # noqa: PLR2004
+            svgs = render_svgs(routes, options)
+            return lambda: svgs
+
+        if self._executor is None:
+            logger.info(f"Rendering SVGs with {self.workers} worker processes")
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        batches = [
+            self._executor.submit(
+                render_svgs,
+                [
+                    _picklable(route)
+                    for route in routes[start : start + self.batch_size]
+                ],
+                options,
+            )
+            for start in range(0, len(routes), self.batch_size)
+        ]
+        return lambda: [svg for batch in batches for svg in batch.result()]
@@ -0,0 +1,72 @@
+"""Generate a made up, but realistic looking, Strava activity history.
+
+The same arguments always generate the same history, so it can be used to compare
+    the plugin's performance between commits.
+"""
+
+from datetime import datetime, timedelta
+import math
+import random
+
+import polyline
+
+from . import _strava_interface, _svg_interface
+
+DEFAULT_SEED = 0
+DEFAULT_POINTS = (100, 400)
+# Activities start somewhere around one of these `(lat, lon)`s.
+HOME_TOWNS = ((35.68, 139.76), (38.26, 140.87), (51.51, -0.13), (40.71, -74.01))
+# Roughly 10m between recorded points.
+STEP_DEGREES = 1e-4
+FIRST_START = datetime(2015, 1, 1, 6)
+
+
+def synthetic_polyline(rng: random.Random, points: int) -> str:
+    """Encode a random walk that turns gradually, like a run through streets."""
+    lat, lon = rng.choice(HOME_TOWNS)
+    lat += rng.uniform(-0.1, 0.1)
+    lon += rng.uniform(-0.1, 0.1)
+    heading = rng.uniform(0, 2 * math.pi)
+    route = []
+    for _ in range(points):
+        route.append((lat, lon))
+        heading += rng.gauss(0, 0.3)
+        lat += STEP_DEGREES * math.sin(heading)
+        lon += STEP_DEGREES * math.cos(heading)
+    return polyline.encode(route, _svg_interface.POLYLINE_PRECISION)
+
+
+def synthetic_activities(
+    count: int,
+    points: tuple[int, int] = DEFAULT_POINTS,
+    seed: int = DEFAULT_SEED,
+) -> list[dict]:
+    """Generate `count` Strava activity responses, newest first.
+
+    Each route has between `points[0]` and `points[1]` points.
+    """
+    rng = random.Random(seed)
+    activities = []
+    for index in range(count):
+        start = FIRST_START + timedelta(hours=13 * index + rng.randrange(6))
+        route_points = rng.randint(*points)
+        activities.append(
+            {
+                "id": 10_000_000_000 + index,
+                "name": f"Run {index}",
+                "distance": round(route_points * 11.1 * rng.uniform(0.9, 1.1), 1),
+                "moving_time": route_points * 3 + rng.randrange(60),
+                "start_date": (start - timedelta(hours=9)).strftime(
+                    _strava_interface.STRAVA_DT_FORMAT
+                ),
+                "start_date_local": start.strftime(_strava_interface.STRAVA_DT_FORMAT),
+                "timezone": "(GMT+09:00) Asia/Tokyo",
+                "map": {
+                    "id": f"a{10_000_000_000 + index}",
+                    "summary_polyline": synthetic_polyline(rng, route_points),
+                    "resource_state": 2,
+                },
+            }
+        )
+    activities.reverse()
+    return activities
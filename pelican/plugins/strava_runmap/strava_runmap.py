@@ -1,11 +1,29 @@
 from collections import defaultdict
-from dataclasses import dataclass
+from collections.abc import Callable, Iterable
+from concurrent import futures
+from dataclasses import dataclass, replace
 from datetime import date, datetime
 import logging
+import os
 
 from pelican import contents, generators, signals
+from pelican.utils import slugify
 
-from . import _strava_interface, _svg_interface
+from . import (
+    _activity_archive,
+    _heatmap,
+    _metrics,
+    _page_cache,
+    _page_template,
+    _prefetch,
+    _render_cache,
+    _spatial_index,
+    _sprites,
+    _strava_export,
+    _strava_interface,
+    _streams,
+    _svg_interface,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -16,12 +34,58 @@ STRAVA_RUNMAP_SETTINGS = {
     "CLIENT_SECRET": "",
     "REFRESH_TOKEN": "",
     "ACTIVITIES_ENDPOINT": "",
+    "AUTH_ENDPOINT": "",
     "STRAVA_DRY_RUN": "",
     "DATE_DISPLAY_FORMAT": "%Y-%m-%d",
+    "CACHE_DIR": "",
+    "FULL_RESYNC": "",
+    "RESYNC_WINDOW_DAYS": 0,
+    "PER_PAGE": 200,
+    "FETCH_WORKERS": 4,
+    "HIGH_FIDELITY": "",
+    "HIGH_FIDELITY_RESOLUTION": _streams.DEFAULT_RESOLUTION,
+    "ARCHIVE": "",
+    "EXPORT_PATH": "",
+    "EXPORT_TIMEZONE": _strava_export.DEFAULT_TIMEZONE,
+    "EXPORT_WORKERS": 0,
+    "RATE_LIMIT_FRACTION": 0.9,
+    "RATE_LIMIT_MAX_WAIT": 900,
+    "MAX_RETRIES": 5,
+    "SIMPLIFY": "",
+    "SIMPLIFY_TOLERANCE": 0.25,
+    "RENDER_CACHE_SIZE": _render_cache.DEFAULT_MAX_ENTRIES,
+    "RENDER_CACHE_MAX_BYTES": _render_cache.DEFAULT_MAX_BYTES,
+    "RENDER_WORKERS": 1,
+    "RENDER_BATCH_SIZE": _svg_interface.DEFAULT_RENDER_BATCH_SIZE,
+    "RENDER_PARALLEL_MIN": _svg_interface.DEFAULT_PARALLEL_RENDER_MIN,
+    "SVG_FORMAT": _svg_interface.SVG_FORMAT_POLYLINE,
+    "SVG_PRECISION": _svg_interface.DEFAULT_SVG_PRECISION,
+    "HEATMAP": "",
+    "HEATMAP_RESOLUTION": _heatmap.DEFAULT_RESOLUTION,
+    "HEATMAP_REGIONS": {},
+    "GROUP_BY": "year",
+    "REGIONS": {},
+    "REGION_CLUSTER_DEGREES": _spatial_index.DEFAULT_CELL_DEGREES,
+    "PAGINATE": "",
+    "SPRITES": "",
+    "METRICS": "",
+    "METRICS_FILE": "",
+    "PREFETCH": True,
+    "PREFETCH_TIMEOUT": _prefetch.DEFAULT_TIMEOUT,
+    "REFRESH_INTERVAL": _prefetch.DEFAULT_REFRESH_INTERVAL,
 }
+GROUP_BY_YEAR = "year"
+GROUP_BY_REGION = "region"
+# Activities rendered without a map still need a group to be looked up in.
+UNKNOWN_REGION = "Elsewhere"
+PAGE_TITLE = "Strava Runmap"
+INDEX_SLUG = "strava-runmap"
+# Paginates by year, or by region with `GROUP_BY = "region"`.
+PAGINATE_BY_GROUP = "year"
+LAZY_STYLE = "content-visibility: auto; contain-intrinsic-size: auto 20rem;"
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class SvgPageContext:
     display_name: str
     display_date: date
@@ -31,134 +95,599 @@ class SvgPageContext:
 
 # Shared list so that the static generator and page generator can link together
 RUN_HISTORY: dict[str, list[SvgPageContext]] = defaultdict(list)
+# Lives as long as the process, so autoreload rebuilds only render new activities.
+RENDER_CACHE = _render_cache.RenderCache()
+BOUNDS_CACHE = _spatial_index.BoundsCache()
+# The last content of each paginated page by slug, with what it was built from, so
+#     pages whose activities are unchanged aren't built again.
+PAGE_CONTENT: dict[str, tuple[tuple, str]] = {}
+# Filled while building the page, and written out once Pelican has finished.
+SPRITE_SHEETS = _sprites.SpriteSheets()
+PAGE_CACHE = _page_cache.PageCache()
+# Pelican's settings as of `initialized`, to fingerprint a build before rendering it.
+PELICAN_SETTINGS: dict = {}
+PAGE_TEMPLATE = _page_template.PageTemplate()
+# With `ARCHIVE`, the decoded routes of the last build.
+ACTIVITY_ARCHIVE = _activity_archive.ActivityArchive()
+# Started as soon as the plugin is configured, and taken when the page is added.
+#     Keeps the last run images it took for rebuilds with `--autoreload`.
+PREFETCH = _prefetch.Prefetch()
 
 
-def _build_runmap_page(run_history: dict[str, list[SvgPageContext]]):
+def _build_runmap_page(
+    run_history: dict[str, list[SvgPageContext]],
+    heatmaps: dict[str, str] | None = None,
+    navigation: list[tuple[str, str]] | None = None,
+):
     """Use the collection of activity SVG data from strava to build a page's content.
 
     Activities will be grouped by year, and displayed in descending chronological order.
-    Will ultimately look like the below, but is not done in an HTML template due to
-        lack of being able to figure out how to inject that using pelican.
-
-    <ul style="display: flex; flex-direction: column">
-      {% for year in years %}
-      <li>{{ year.display }}</li>
-      <li>
-        <ul style="display: flex; flex-direction: row; flex-wrap: wrap;">
-          <li>
-            {% for run in year %}
-            <ul style="display: flex; flex-direction: column">
-              <li>{{ run.title }}</li>
-              <li>{{ run.svg }}</li>
-              <li>{{ run.date }}</li>
-            </ul>
-            {% endfor %}
-          </li>
-        </ul>
-      </li>
-    </ul>
+    The page is rendered from the `strava_runmap.html` template, which a theme can
+        override (see `_page_template`).
 
+    With `heatmaps`, each region's heatmap is shown above the years, and with
+        `navigation`, `(title, url)` links to other pages above that.
     """
-    year_sections = []
-    flex_style = "display: flex; list-style: none;"
-    for year, svg_contexts in run_history.items():
-        svg_sections = [
-            "\n".join(
-                [
-                    '<li style="margin-top: 4rem;">',
-                    f'<ul style="{flex_style} flex-direction: '
-                    'column; max-width:10rem;">',
-                    f"<li>{context.display_name}</li>",
-                    f"<li>{context.svg_content}</li>",
-                    f"<li>{context.display_date}</li>",
-                    f"<li>{context.distance_display}<li>",
-                    "</ul>",
-                    "</li>",
-                ]
+    return PAGE_TEMPLATE.render(
+        {
+            "run_history": run_history,
+            "heatmaps": heatmaps or {},
+            "navigation": navigation or [],
+            "project_link": PROJECT_LINK,
+            "flex_style": "display: flex; list-style: none;",
+            # Lets browsers skip laying out and drawing years that are off screen.
+            #     Whether their sprite sheets are fetched any later is up to them.
+            "year_style": LAZY_STYLE if STRAVA_RUNMAP_SETTINGS["SPRITES"] else "",
+        }
+    )
+
+
+def _paginate(
+    run_history: dict[str, list[SvgPageContext]], paginate: str | int
+) -> list[tuple[str, dict[str, list[SvgPageContext]]]]:
+    """Split the run history in to `(title, run history)` pages, as per `PAGINATE`."""
+    if paginate == PAGINATE_BY_GROUP:
+        return [(group, {group: contexts}) for group, contexts in run_history.items()]
+    per_page = int(paginate)
+    pages = [defaultdict(list)]
+    count = 0
+    for group, contexts in run_history.items():
+        for context in contexts:
+            if count == per_page:
+                pages.append(defaultdict(list))
+                count = 0
+            pages[-1][group].append(context)
+            count += 1
+    return [(f"Page {number}", page) for number, page in enumerate(pages, 1)]
+
+
+def _page_content(
+    slug: str,
+    run_history: dict[str, list[SvgPageContext]],
+    heatmaps: dict[str, str] | None,
+    navigation: list[tuple[str, str]],
+) -> str:
+    """Build a page's content with `_build_runmap_page`, unless it is unchanged."""
+    built_from = (
+        tuple((group, tuple(contexts)) for group, contexts in run_history.items()),
+        tuple((heatmaps or {}).items()),
+        tuple(navigation),
+        PAGE_TEMPLATE.source,
+    )
+    previous = PAGE_CONTENT.get(slug)
+    if previous is not None and previous[0] == built_from:
+        return previous[1]
+    with _metrics.METRICS.span("runmap.build_page"):
+        content = _build_runmap_page(run_history, heatmaps, navigation)
+    PAGE_CONTENT[slug] = (built_from, content)
+    return content
+
+
+def _build_runmap_pages(
+    run_history: dict[str, list[SvgPageContext]],
+    heatmaps: dict[str, str] | None,
+    settings: dict,
+) -> list[dict]:
+    """Build an index page linking to a page per group, or per `PAGINATE` activities.
+
+    Every page links to the index and to the pages either side of it. Pages are
+        `title`, `slug` and `content` dicts.
+    """
+
+    def _url(slug: str) -> str:
+        page = _runmap_page({"title": "", "slug": slug, "content": ""}, settings)
+        return f"{settings['SITEURL']}/{page.url}"
+
+    pages = []
+    for title, page_history in _paginate(
+        run_history, STRAVA_RUNMAP_SETTINGS["PAGINATE"]
+    ):
+        slug = slugify(
+            f"{INDEX_SLUG}-{title}", regex_subs=settings["SLUG_REGEX_SUBSTITUTIONS"]
+        )
+        pages.append((f"{PAGE_TITLE} {title}", slug, page_history))
+
+    index_links = [(title, _url(slug)) for title, slug, _ in pages]
+    runmap_pages = [
+        {
+            "title": PAGE_TITLE,
+            "slug": INDEX_SLUG,
+            "content": _page_content(INDEX_SLUG, {}, heatmaps, index_links),
+        }
+    ]
+    for number, (title, slug, page_history) in enumerate(pages):
+        navigation = [(PAGE_TITLE, _url(INDEX_SLUG))]
+        if number > 0:
+            navigation.insert(0, ("Previous", index_links[number - 1][1]))
+        if number + 1 < len(pages):
+            navigation.append(("Next", index_links[number + 1][1]))
+        runmap_pages.append(
+            {
+                "title": title,
+                "slug": slug,
+                "content": _page_content(slug, page_history, None, navigation),
+            }
+        )
+    return runmap_pages
+
+
+def _runmap_page(page: dict, settings: dict) -> contents.Page:
+    metadata = {"title": page["title"], "date": datetime.now()}
+    if page["slug"]:
+        metadata["slug"] = page["slug"]
+    return contents.Page(page["content"], metadata, settings=settings)
+
+
+def _use_sprite_sheets(
+    run_history: dict[str, list[SvgPageContext]], settings: dict
+) -> dict[str, list[SvgPageContext]]:
+    """Move every SVG in to a sprite sheet per year, leaving `<use>`s in its place."""
+    SPRITE_SHEETS.clear()
+    sheet_of = {
+        group: slugify(group, regex_subs=settings["SLUG_REGEX_SUBSTITUTIONS"])
+        for group in run_history
+    }
+    for group, contexts in run_history.items():
+        for context in contexts:
+            SPRITE_SHEETS.add(sheet_of[group], context.svg_content)
+    return {
+        group: [
+            replace(
+                context,
+                svg_content=SPRITE_SHEETS.reference(
+                    context.svg_content, settings["SITEURL"]
+                ),
             )
-            for context in svg_contexts
+            for context in contexts
         ]
-        year_sections.append(
-            "\n".join(
-                [
-                    f'<li style="text-align: center;"><h2>{year}</h2></li>',
-                    "<li>",
-                    f'<ul style="{flex_style}; flex-direction: row; flex-wrap: wrap">',
-                    *svg_sections,
-                    "</li>",
-                ]
-            )
+        for group, contexts in run_history.items()
+    }
+
+
+def _render_options() -> _svg_interface.RenderOptions:
+    return _svg_interface.RenderOptions(
+        simplify=STRAVA_RUNMAP_SETTINGS["SIMPLIFY"],
+        tolerance=float(STRAVA_RUNMAP_SETTINGS["SIMPLIFY_TOLERANCE"]),
+        svg_format=STRAVA_RUNMAP_SETTINGS["SVG_FORMAT"],
+        precision=int(STRAVA_RUNMAP_SETTINGS["SVG_PRECISION"]),
+    )
+
+
+def _submit_run_images(
+    activities: list[_strava_interface.StravaRouteData],
+    render_options: _svg_interface.RenderOptions,
+    renderer: _svg_interface.SvgRenderer,
+    counts: _render_cache.Counts | None = None,
+) -> tuple[list[_strava_interface.StravaRouteData], Callable[[], list[str | None]]]:
+    """Start rendering the SVGs of a page of activities that aren't cached yet."""
+    # Not all strava activities have maps
+    activities = [activity for activity in activities if activity.map]
+    routes = None
+    if STRAVA_RUNMAP_SETTINGS["ARCHIVE"]:
+        routes = [ACTIVITY_ARCHIVE.route_coords(activity) for activity in activities]
+    wait_for_svgs = RENDER_CACHE.get_or_submit(
+        [activity.map.route_polyline for activity in activities],
+        render_options,
+        renderer.submit,
+        routes,
+        counts,
+    )
+    return activities, wait_for_svgs
+
+
+def _activity_bounds(
+    activity: _strava_interface.StravaRouteData,
+) -> _spatial_index.Bounds | None:
+    """Bounds of an activity's route, cached by its polyline."""
+    encoded = activity.map.route_polyline
+    return BOUNDS_CACHE.get(
+        encoded,
+        lambda: _spatial_index.polyline_bounds(
+            ACTIVITY_ARCHIVE.route_coords(activity)
+            if STRAVA_RUNMAP_SETTINGS["ARCHIVE"]
+            else encoded
+        ),
+    )
+
+
+def _index_activities(
+    activities: list[_strava_interface.StravaRouteData],
+    item: Callable[[_strava_interface.StravaRouteData], object] = lambda x: x,
+) -> _spatial_index.SpatialIndex:
+    """Index `item(activity)` of every activity with a route by its bounds."""
+    index = _spatial_index.SpatialIndex(
+        float(STRAVA_RUNMAP_SETTINGS["REGION_CLUSTER_DEGREES"])
+    )
+    for activity in activities:
+        bounds = _activity_bounds(activity)
+        if bounds is not None:
+            index.insert(item(activity), bounds)
+    BOUNDS_CACHE.save()
+    return index
+
+
+def _region_names(
+    activities: list[_strava_interface.StravaRouteData],
+) -> dict[int, str]:
+    """Name the region of every activity, by activity id.
+
+    Activities in one of the configured `REGIONS` take its name (the first, if they
+        are in several). The rest are clustered with nearby activities, and named
+        after the middle of their cluster.
+    """
+    index = _index_activities(activities)
+    names = {}
+    for name, bounds in STRAVA_RUNMAP_SETTINGS["REGIONS"].items():
+        for activity in index.query(tuple(bounds)):
+            names.setdefault(activity.id, name)
+    for cluster in index.clusters():
+        unnamed = [activity for activity in cluster if activity.id not in names]
+        if not unnamed:
+            continue
+        south, west, north, east = _spatial_index.union(
+            [_activity_bounds(activity) for activity in unnamed]
         )
+        name = f"Around {(south + north) / 2:.2f}, {(west + east) / 2:.2f}"
+        names.update((activity.id, name) for activity in unnamed)
+    return names
 
-    return "\n".join(
-        [
-            f'<ul style="{flex_style} flex-direction: column;">',
-            '<li style="text-align: center;"><h1>Maps of my Activities</h1></li>',
-            f'<li style="text-align: center;"><p>Powered by <a href="{PROJECT_LINK}">'
-            "strava-runmap for pelican</a>",
-            *year_sections,
-            "</ul>",
-        ]
+
+def _add_run_image(
+    run_history: dict[str, list[SvgPageContext]],
+    group: str,
+    activity: _strava_interface.StravaRouteData,
+    svg_content: str | None,
+):
+    """Add a single activity's SVG in to its group (year or region) of run history."""
+    if not svg_content:
+        # Not all strava activity maps have polylines to svg-ize
+        return
+    distance_display = f"{int(activity.distance)}m in {activity.moving_time // 60}"
+
+    run_history[group].append(
+        SvgPageContext(
+            display_date=activity.start_date_local.strftime(
+                STRAVA_RUNMAP_SETTINGS["DATE_DISPLAY_FORMAT"]
+            ),
+            display_name=activity.name or "Untitled Run",
+            svg_content=svg_content,
+            distance_display=distance_display,
+        )
     )
 
 
-def _create_run_images():
+def _create_run_images(
+    mapped_activities: list[_strava_interface.StravaRouteData] | None = None,
+    from_cache: bool = False,
+) -> dict[str, list[SvgPageContext]] | None:
     """Add map SVGs after Static Generators Finalized.
 
     Actually calls the strava endpoint and generates all of the SVGs.
+    Activities are rendered a page at a time as they come in, so rendering overlaps
+        with the download of the following pages. With `RENDER_WORKERS`, large
+        histories are rendered in worker processes.
     The SVGs are then insterted in to a share context so that
         the page generator can access them.
+    Activities are grouped by year, or with `GROUP_BY = "region"`, by region.
+    Every activity with a map is also collected in to `mapped_activities`, if given.
+    With `from_cache`, only the cached activities are used, without asking Strava.
+    With `EXPORT_PATH`, activities are read from a Strava bulk export instead.
+    With `ARCHIVE`, routes are drawn from the coordinates kept by the last build.
+    If there is a last build to reuse, every activity is fetched before any are
+        rendered, and if they are the very ones the last build's pages were made
+        from, nothing is rendered and None is returned.
     """
-    logger.info("Connecting to Strava API")
-    strava_api = _strava_interface.StravaAPI(STRAVA_RUNMAP_SETTINGS)
+    if STRAVA_RUNMAP_SETTINGS["EXPORT_PATH"]:
+        logger.info("Reading Strava export")
+        strava_api = _strava_export.StravaExport(STRAVA_RUNMAP_SETTINGS)
+    else:
+        logger.info("Connecting to Strava API")
+        strava_api = _strava_interface.StravaAPI(STRAVA_RUNMAP_SETTINGS)
     logger.info("Fetching Strava activities")
-    activities = strava_api.fetch_activities()
+    if mapped_activities is None:
+        mapped_activities = []
+    if not from_cache:
+        try:
+            pages = strava_api.iter_activities()
+            if PAGE_CACHE.last(load_cache=_load_page_cache()) is None:
+                return _render_run_images(pages, mapped_activities)
+            activities = [activity for page in pages for activity in page]
+        except _strava_interface.StravaAPIError:
+            if (
+                strava_api.activity_store is None
+                or not strava_api.activity_store.exists()
+            ):
+                raise
+            logger.warning(
+                "Could not fetch activities from Strava, "
+                "building from cached activities",
+                exc_info=True,
+            )
+            from_cache = True
+    if from_cache:
+        activities = strava_api.cached_activities()
+    activities = [activity for activity in activities if activity.map]
+    if _last_build(activities, PELICAN_SETTINGS) is not None:
+        logger.info("Strava activities are unchanged, skipping rendering")
+        mapped_activities.extend(activities)
+        return None
+    return _render_run_images([activities], mapped_activities)
+
+
+def _render_run_images(
+    pages: Iterable[list[_strava_interface.StravaRouteData]],
+    mapped_activities: list[_strava_interface.StravaRouteData],
+) -> dict[str, list[SvgPageContext]]:
+    """Render each page of activities as it comes, and group them in to run history."""
+    render_options = _render_options()
+    # Apart from those of a prefetch that may still be rendering at the same time.
+    counts = _render_cache.Counts()
+    with _svg_interface.SvgRenderer(
+        workers=int(STRAVA_RUNMAP_SETTINGS["RENDER_WORKERS"]),
+        batch_size=int(STRAVA_RUNMAP_SETTINGS["RENDER_BATCH_SIZE"]),
+        min_parallel=int(STRAVA_RUNMAP_SETTINGS["RENDER_PARALLEL_MIN"]),
+    ) as renderer:
+        rendering = [
+            _submit_run_images(page, render_options, renderer, counts) for page in pages
+        ]
+
+        rendered = [
+            (activity, svg_content)
+            for activities, wait_for_svgs in rendering
+            for activity, svg_content in zip(activities, wait_for_svgs())
+        ]
+    if STRAVA_RUNMAP_SETTINGS["ARCHIVE"]:
+        with _metrics.METRICS.span("runmap.save_archive"):
+            ACTIVITY_ARCHIVE.save([activity for activity, _ in rendered])
+    mapped_activities.extend(activity for activity, _ in rendered)
+    region_names = None
+    if STRAVA_RUNMAP_SETTINGS["GROUP_BY"] == GROUP_BY_REGION:
+        region_names = _region_names([activity for activity, _ in rendered])
+
     run_history = defaultdict(list)
-    for activity in activities:
-        if not activity.map:
-            # Not all strava activities have maps
-            continue
-        activity_svg = _svg_interface.extract_svg_data(activity)
-        if not activity_svg:
-            # Not all strava activity maps have polylines to svg-ize
-            continue
-        svg_content = _svg_interface.convert_to_svg(activity_svg)
-        distance_display = f"{int(activity.distance)}m in {activity.moving_time // 60}"
+    for activity, svg_content in rendered:
+        if region_names is None:
+            group = str(activity.start_date_local.year)
+        else:
+            group = region_names.get(activity.id, UNKNOWN_REGION)
+        _add_run_image(run_history, group, activity, svg_content)
+    logger.info(
+        f"Strava Activities fetched, {counts.hits} SVGs reused from cache "
+        f"and {counts.misses} rendered"
+    )
+    _metrics.METRICS.count("render_cache.hits", counts.hits)
+    _metrics.METRICS.count("render_cache.misses", counts.misses)
+    RENDER_CACHE.prune()
+    return run_history
 
-        run_history[str(activity.start_date_local.year)].append(
-            SvgPageContext(
-                display_date=activity.start_date_local.strftime(
-                    STRAVA_RUNMAP_SETTINGS["DATE_DISPLAY_FORMAT"]
-                ),
-                display_name=activity.name or "Untitled Run",
-                svg_content=svg_content,
-                distance_display=distance_display,
+
+def _load_page_cache() -> bool:
+    return PELICAN_SETTINGS.get("LOAD_CONTENT_CACHE", False)
+
+
+def _build_fingerprint(
+    mapped_activities: list[_strava_interface.StravaRouteData], settings: dict
+) -> str:
+    return _page_cache.fingerprint(
+        mapped_activities, STRAVA_RUNMAP_SETTINGS, settings, PAGE_TEMPLATE.source
+    )
+
+
+def _last_build(
+    mapped_activities: list[_strava_interface.StravaRouteData], settings: dict
+) -> dict | None:
+    """Get the last build, if it was made from these activities and settings."""
+    return PAGE_CACHE.get(
+        _build_fingerprint(mapped_activities, settings),
+        load_cache=settings.get("LOAD_CONTENT_CACHE", False),
+    )
+
+
+def _build_runmap_content(
+    run_history: dict[str, list[SvgPageContext]],
+    mapped_activities: list[_strava_interface.StravaRouteData],
+    settings: dict,
+) -> list[dict]:
+    """Build the runmap pages, as `title`, `slug` and `content` dicts."""
+    heatmaps = None
+    if STRAVA_RUNMAP_SETTINGS["HEATMAP"] and mapped_activities:
+        route = (
+            ACTIVITY_ARCHIVE.route_coords
+            if STRAVA_RUNMAP_SETTINGS["ARCHIVE"]
+            else lambda activity: activity.map.route_polyline
+        )
+        heatmaps = _heatmap.build_heatmaps(
+            _index_activities(mapped_activities, route),
+            STRAVA_RUNMAP_SETTINGS["HEATMAP_REGIONS"]
+            or STRAVA_RUNMAP_SETTINGS["REGIONS"],
+            int(STRAVA_RUNMAP_SETTINGS["HEATMAP_RESOLUTION"]),
+        )
+    if STRAVA_RUNMAP_SETTINGS["SPRITES"]:
+        run_history = _use_sprite_sheets(run_history, settings)
+    if STRAVA_RUNMAP_SETTINGS["PAGINATE"]:
+        return _build_runmap_pages(run_history, heatmaps, settings)
+    with _metrics.METRICS.span("runmap.build_page"):
+        content = _build_runmap_page(run_history, heatmaps)
+    return [{"title": PAGE_TITLE, "slug": None, "content": content}]
+
+
+def _prefetch_run_images() -> (
+    tuple[dict[str, list[SvgPageContext]], list[_strava_interface.StravaRouteData]]
+):
+    """Create the run images, and collect the activities with maps alongside them."""
+    mapped_activities = []
+    with _metrics.METRICS.span("runmap.create_run_images"):
+        run_history = _create_run_images(mapped_activities)
+    return run_history, mapped_activities
+
+
+def _reusable_run_images() -> bool:
+    """Whether the run images of an earlier build were made with the same settings."""
+    return PREFETCH.last is not None and PREFETCH.last_key == STRAVA_RUNMAP_SETTINGS
+
+
+def _take_run_images() -> (
+    tuple[dict[str, list[SvgPageContext]], list[_strava_interface.StravaRouteData]]
+):
+    """Get the run images for this build, prefetched, kept from earlier, or made now.
+
+    A prefetch is waited on for up to `PREFETCH_TIMEOUT`, after which the page is
+        built from cached activities instead. Under `pelican --autoreload`, the run
+        images of an earlier build are reused as they are, and once they are older
+        than `REFRESH_INTERVAL` they are refreshed in the background for a later
+        rebuild. A prefetch started before the settings were changed is drawn again.
+    """
+    if _reusable_run_images() and not PREFETCH.done:
+        if not PREFETCH.pending and PREFETCH.age >= float(
+            STRAVA_RUNMAP_SETTINGS["REFRESH_INTERVAL"]
+        ):
+            logger.info("Refreshing Strava activities in the background")
+            PREFETCH.start(_prefetch_run_images, dict(STRAVA_RUNMAP_SETTINGS))
+        logger.info("Reusing the Strava activities fetched earlier")
+        return PREFETCH.last
+    if not PREFETCH.pending:
+        run_images = _prefetch_run_images()
+        PREFETCH.keep(run_images, dict(STRAVA_RUNMAP_SETTINGS))
+        return run_images
+    try:
+        with _metrics.METRICS.span("runmap.wait_for_prefetch"):
+            run_images = PREFETCH.take(
+                timeout=float(STRAVA_RUNMAP_SETTINGS["PREFETCH_TIMEOUT"])
             )
+    except futures.TimeoutError:
+        logger.warning(
+            "Timed out waiting for Strava activities, building from cached activities"
         )
-    logger.info("Strava Activities fetched")
-    return run_history
+    except _strava_interface.StravaAPIError:
+        if not _reusable_run_images():
+            raise
+        logger.warning(
+            "Could not refresh Strava activities, reusing the ones fetched earlier",
+            exc_info=True,
+        )
+        return PREFETCH.last
+    else:
+        if PREFETCH.last_key == STRAVA_RUNMAP_SETTINGS:
+            return run_images
+        # e.g. a refresh that was still running when the settings were edited.
+        logger.info("Settings changed since Strava activities were fetched, redrawing")
+        PREFETCH.forget()
+        run_images = _prefetch_run_images()
+        PREFETCH.keep(run_images, dict(STRAVA_RUNMAP_SETTINGS))
+        return run_images
+    mapped_activities = []
+    run_history = _create_run_images(mapped_activities, from_cache=True)
+    return run_history, mapped_activities
 
 
 def add_runmap_page(pageGenerator: generators.PagesGenerator):
-    """Add srava page after Generators Finalized."""
+    """Add srava page after Generators Finalized.
+
+    Activities have (usually) been fetched in the background since Pelican
+        initialized, or on a rebuild, by an earlier build. The pages of the last
+        build are reused if none of the activities or settings have changed since.
+    """
     logger.info("Ading page for Run Maps")
-    run_history = _create_run_images()
-    content = _build_runmap_page(run_history)
-    runmap_page = contents.Page(
-        content,
-        {
-            "title": "Strava Runmap",
-            "date": datetime.now(),
-        },
-    )
-    pageGenerator.pages.append(runmap_page)
+    if not PREFETCH.pending:
+        _metrics.METRICS.reset()
+    settings = pageGenerator.settings
+    with _metrics.METRICS.span("runmap.total"):
+        run_history, mapped_activities = _take_run_images()
+        build_fingerprint = _build_fingerprint(mapped_activities, settings)
+        last_build = PAGE_CACHE.get(
+            build_fingerprint, load_cache=settings.get("LOAD_CONTENT_CACHE", False)
+        )
+        if last_build is not None:
+            logger.info(
+                "Strava activities are unchanged, reusing the last runmap pages"
+            )
+            _metrics.METRICS.count("runmap.pages_reused", len(last_build["pages"]))
+            pages = last_build["pages"]
+            SPRITE_SHEETS.restore(last_build["sprites"])
+        else:
+            if run_history is None:
+                # Rendering was skipped for a last build that this one no longer
+                #     matches, e.g. as Pelican's settings were changed since.
+                run_history = _render_run_images([mapped_activities], [])
+            with _metrics.METRICS.span("runmap.build_content"):
+                pages = _build_runmap_content(run_history, mapped_activities, settings)
+            PAGE_CACHE.put(
+                build_fingerprint,
+                pages,
+                SPRITE_SHEETS.files() if STRAVA_RUNMAP_SETTINGS["SPRITES"] else {},
+                save_cache=settings.get("CACHE_CONTENT", False),
+            )
+        pageGenerator.pages.extend(_runmap_page(page, settings) for page in pages)
+    _report_metrics()
+
+
+def _report_metrics():
+    """Log the build metrics, and write them to `METRICS_FILE` if set."""
+    if not _metrics.METRICS.enabled:
+        return
+    _metrics.METRICS.log_report()
+    if STRAVA_RUNMAP_SETTINGS["METRICS_FILE"]:
+        _metrics.METRICS.write(STRAVA_RUNMAP_SETTINGS["METRICS_FILE"])
 
 
 def init_default_config(pelican):
     STRAVA_RUNMAP_SETTINGS.update(pelican.settings[STRAVA_RUNMAP_KEY])
+    PELICAN_SETTINGS.clear()
+    PELICAN_SETTINGS.update(pelican.settings)
+    if not STRAVA_RUNMAP_SETTINGS["CACHE_DIR"]:
+        STRAVA_RUNMAP_SETTINGS["CACHE_DIR"] = os.path.join(
+            pelican.settings["CACHE_PATH"], "strava_runmap"
+        )
+    _metrics.METRICS.enabled = bool(
+        STRAVA_RUNMAP_SETTINGS["METRICS"] or STRAVA_RUNMAP_SETTINGS["METRICS_FILE"]
+    )
+    PAGE_CACHE.configure(STRAVA_RUNMAP_SETTINGS["CACHE_DIR"])
+    BOUNDS_CACHE.configure(STRAVA_RUNMAP_SETTINGS["CACHE_DIR"])
+    PAGE_TEMPLATE.configure(pelican.settings)
+    ACTIVITY_ARCHIVE.configure(
+        STRAVA_RUNMAP_SETTINGS["CACHE_DIR"]
+        if STRAVA_RUNMAP_SETTINGS["ARCHIVE"]
+        else None
+    )
+    RENDER_CACHE.configure(
+        os.path.join(STRAVA_RUNMAP_SETTINGS["CACHE_DIR"], "svg"),
+        max_entries=int(STRAVA_RUNMAP_SETTINGS["RENDER_CACHE_SIZE"]),
+        max_bytes=int(STRAVA_RUNMAP_SETTINGS["RENDER_CACHE_MAX_BYTES"]),
+    )
+    if STRAVA_RUNMAP_SETTINGS["PREFETCH"] and not _reusable_run_images():
+        logger.info("Fetching Strava activities in the background")
+        _metrics.METRICS.reset()
+        PREFETCH.start(_prefetch_run_images, dict(STRAVA_RUNMAP_SETTINGS))
+
+
+def write_sprite_sheets(pelican):
+    """Write the sprite sheets after Pelican Finalized, so they aren't cleaned up."""
+    if STRAVA_RUNMAP_SETTINGS["SPRITES"]:
+        SPRITE_SHEETS.write(pelican.settings["OUTPUT_PATH"])
 
 
 def register():
     """Register article creation signals with pelican."""
     signals.initialized.connect(init_default_config)
     signals.page_generator_finalized.connect(add_runmap_page)
+    signals.finalized.connect(write_sprite_sheets)
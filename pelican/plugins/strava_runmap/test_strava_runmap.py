@@ -1,25 +1,62 @@
+from array import array
+from concurrent import futures
+import dataclasses
 from datetime import datetime
+import gzip
+import json
+import os
+import re
+import threading
 from unittest import mock
+import zipfile
 
+import polyline
 import pytest
 import zoneinfo
 
-from . import _strava_interface, _svg_interface
+from pelican.settings import DEFAULT_CONFIG
+
+from . import (
+    _activity_archive,
+    _activity_store,
+    _benchmark,
+    _heatmap,
+    _metrics,
+    _page_cache,
+    _page_template,
+    _prefetch,
+    _render_cache,
+    _simplify,
+    _spatial_index,
+    _sprites,
+    _standin_server,
+    _strava_export,
+    _strava_interface,
+    _streams,
+    _svg_interface,
+    _synthetic,
+    strava_runmap,
+)
 
 MIN_ALLOWED_FLOAT_DIFF = 0.0001
+# 2023-10-30T00:02:49Z, the start of the newest activity in `strava_response`
+LATEST_START_TIMESTAMP = 1698624169
 
 
 class MockResponse:
-    def __init__(self, response_data):
+    def __init__(self, response_data, status_code=200, headers=None):
         """Just configure response data."""
         self.response_data = response_data
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.content = json.dumps(response_data).encode("utf-8")
 
     def json(self):
         return self.response_data
 
     @property
     def ok(self):
-        return True
+        return self.status_code < 400  # noqa: PLR2004
 
 
 @pytest.fixture
@@ -145,6 +182,8 @@ def strava_response():
 def strava_activities() -> [_strava_interface.StravaRouteData]:
     return [
         _strava_interface.StravaRouteData(
+            id=10128220001,
+            start_date=datetime(2023, 10, 30, 0, 2, 49),
             start_date_local=datetime(2023, 10, 30, 9, 2, 49),
             timezone=zoneinfo.ZoneInfo("Asia/Tokyo"),
             map=_strava_interface.MapData(
@@ -157,6 +196,8 @@ def strava_activities() -> [_strava_interface.StravaRouteData]:
             moving_time=1620,
         ),
         _strava_interface.StravaRouteData(
+            id=10121826000,
+            start_date=datetime(2023, 10, 28, 23, 6, 2),
             start_date_local=datetime(2023, 10, 29, 8, 6, 2),
             timezone=zoneinfo.ZoneInfo("Asia/Tokyo"),
             map=_strava_interface.MapData(
@@ -171,13 +212,20 @@ def strava_activities() -> [_strava_interface.StravaRouteData]:
     ]
 
 
+@pytest.fixture(autouse=True)
+def fresh_prefetch(monkeypatch):
+    """Don't let run images or pages kept by one test's build be reused by the next."""
+    monkeypatch.setattr(strava_runmap, "PREFETCH", _prefetch.Prefetch())
+    monkeypatch.setattr(strava_runmap, "PAGE_CACHE", _page_cache.PageCache())
+
+
 @pytest.fixture
 def mock_strava_api_get(monkeypatch, strava_response):
     import requests
 
     mock_get = mock.Mock()
     mock_get.side_effect = [strava_response, MockResponse(response_data=[])]
-    monkeypatch.setattr(requests, "get", mock_get)
+    monkeypatch.setattr(requests.Session, "get", mock_get)
     return mock_get
 
 
@@ -188,6 +236,8 @@ def mock_polyline_decode(monkeypatch, polyline_decode):
     mock_decode = mock.Mock()
     mock_decode.return_value = polyline_decode
     monkeypatch.setattr(polyline, "decode", mock_decode)
+    # Only the pure python path decodes with `polyline`.
+    monkeypatch.setattr(_svg_interface, "np", None)
 
     return mock_decode
 
@@ -208,6 +258,277 @@ def test_strava_interface_valid(mock_strava_api_get, strava_activities):
     assert activities == strava_activities
 
 
+@pytest.mark.parametrize("use_orjson", [True, False])
+def test_parse_activities_keeps_only_stored_fields(
+    monkeypatch, strava_response, strava_activities, use_orjson
+):
+    if not use_orjson:
+        monkeypatch.setattr(_activity_store, "orjson", None)
+    elif _activity_store.orjson is None:
+        pytest.skip("orjson is not installed")
+
+    parsed = _activity_store.parse_activities(strava_response.content)
+    _strava_interface.strava_timezone.cache_clear()
+    route_data = [
+        _strava_interface.StravaRouteData.from_strava_data(activity)
+        for activity in parsed
+    ]
+
+    assert parsed == [
+        _activity_store.trim_activity(activity)
+        for activity in strava_response.response_data
+    ]
+    assert route_data == strava_activities
+    # Each timezone is only looked up once, however many activities are in it.
+    timezones = {activity["timezone"] for activity in parsed}
+    cache_info = _strava_interface.strava_timezone.cache_info()
+    assert cache_info.misses == len(timezones)
+    assert cache_info.hits == len(parsed) - len(timezones)
+    assert cache_info.hits > 0
+
+
+@pytest.fixture
+def cached_strava_api(tmp_path):
+    return _strava_interface.StravaAPI(
+        client_settings={
+            "CLIENT_ID": "123",
+            "CLIENT_SECRET": "456",
+            "REFRESH_TOKEN": "abcd1234",
+            "CACHE_DIR": str(tmp_path),
+        },
+        auth_token="test-token123",
+    )
+
+
+def test_strava_interface_cold_cache_fetches_everything(
+    mock_strava_api_get, cached_strava_api, strava_activities
+):
+    activities = cached_strava_api.fetch_activities()
+
+    assert activities == strava_activities
+    requested_params = [
+        call.kwargs["params"] for call in mock_strava_api_get.call_args_list
+    ]
+    # A page shorter than `per_page` is the last one, no need to ask for another.
+    assert requested_params == [{"page": 1, "per_page": 200}]
+    assert cached_strava_api.activity_store.exists()
+
+
+def test_strava_interface_warm_cache_fetches_only_new(
+    monkeypatch, mock_strava_api_get, cached_strava_api, strava_activities
+):
+    import requests
+
+    cached_strava_api.fetch_activities()
+    warm_get = mock.Mock(return_value=MockResponse(response_data=[]))
+    monkeypatch.setattr(requests.Session, "get", warm_get)
+
+    activities = cached_strava_api.fetch_activities()
+
+    assert activities == strava_activities
+    warm_get.assert_called_once()
+    assert warm_get.call_args.kwargs["params"]["after"] == LATEST_START_TIMESTAMP
+
+
+def test_strava_interface_resync_window_evicts_deleted(
+    monkeypatch, mock_strava_api_get, cached_strava_api, strava_activities
+):
+    import requests
+
+    cached_strava_api.fetch_activities()
+    cached_strava_api.resync_window_days = 7
+    # Strava no longer knows about the newest activity.
+    monkeypatch.setattr(
+        requests.Session,
+        "get",
+        mock.Mock(return_value=MockResponse(response_data=[])),
+    )
+
+    activities = cached_strava_api.fetch_activities()
+
+    assert activities == []
+
+
+def test_strava_interface_fetches_pages_concurrently_in_order(
+    monkeypatch, strava_response
+):
+    import requests
+
+    pages = {
+        page: [{**route, "id": page}]
+        for page, route in enumerate(strava_response.response_data * 2, start=1)
+    }
+
+    def _get_page(url, params, headers):
+        return MockResponse(response_data=pages.get(params["page"], []))
+
+    mock_get = mock.Mock(side_effect=_get_page)
+    monkeypatch.setattr(requests.Session, "get", mock_get)
+    strava_api = _strava_interface.StravaAPI(
+        client_settings={
+            "CLIENT_ID": "123",
+            "CLIENT_SECRET": "456",
+            "REFRESH_TOKEN": "abcd1234",
+            "PER_PAGE": 1,
+            "FETCH_WORKERS": 3,
+        },
+        auth_token="test-token123",
+    )
+
+    activities = strava_api.fetch_activities()
+
+    assert [activity.id for activity in activities] == sorted(pages)
+    requested_pages = {
+        call.kwargs["params"]["page"] for call in mock_get.call_args_list
+    }
+    assert set(pages) < requested_pages
+
+
+@pytest.fixture
+def mock_sleep(monkeypatch):
+    mock_sleep = mock.Mock()
+    monkeypatch.setattr(_strava_interface.time, "sleep", mock_sleep)
+    return mock_sleep
+
+
+def test_strava_interface_retries_rate_limited_requests(
+    monkeypatch, mock_sleep, strava_response, strava_activities
+):
+    import requests
+
+    mock_get = mock.Mock(
+        side_effect=[
+            MockResponse(response_data=[], status_code=429),
+            MockResponse(response_data=[], status_code=503),
+            strava_response,
+        ]
+    )
+    monkeypatch.setattr(requests.Session, "get", mock_get)
+    strava_api = _strava_interface.StravaAPI(
+        client_settings={
+            "CLIENT_ID": "123",
+            "CLIENT_SECRET": "456",
+            "REFRESH_TOKEN": "",
+        },
+        auth_token="test-token123",
+    )
+
+    activities = strava_api.fetch_activities()
+
+    assert activities == strava_activities
+    assert mock_sleep.call_count == mock_get.call_count - 1
+
+
+def test_request_scheduler_tracks_rate_limit_headers(mock_sleep):
+    scheduler = _strava_interface.RequestScheduler(budget_fraction=0.5)
+
+    scheduler.update(
+        {
+            "X-RateLimit-Limit": "200,2000",
+            "X-RateLimit-Usage": "10,100",
+            "X-ReadRateLimit-Limit": "100,1000",
+            "X-ReadRateLimit-Usage": "10,100",
+        }
+    )
+
+    # Half of the (stricter) read limits, minus what has been used.
+    assert scheduler.budget == _strava_interface.RateLimitBudget(
+        short_term=40, daily=400
+    )
+
+
+def test_request_scheduler_stops_when_daily_budget_spent(mock_sleep):
+    scheduler = _strava_interface.RequestScheduler()
+    scheduler.update({"X-RateLimit-Limit": "100,1000", "X-RateLimit-Usage": "1,995"})
+    send = mock.Mock()
+
+    with pytest.raises(_strava_interface.StravaRateLimitExceeded):
+        scheduler.request(send, "https://example.com")
+
+    send.assert_not_called()
+
+
+def test_strava_interface_resumes_interrupted_backfill(
+    monkeypatch, mock_sleep, cached_strava_api, strava_response
+):
+    import requests
+
+    newest, oldest = strava_response.response_data
+    cached_strava_api.per_page = 1
+    cached_strava_api.fetch_workers = 1
+    cached_strava_api.scheduler.max_retries = 0
+    monkeypatch.setattr(
+        requests.Session,
+        "get",
+        mock.Mock(
+            side_effect=[
+                MockResponse(response_data=[newest]),
+                MockResponse(response_data=[], status_code=500),
+            ]
+        ),
+    )
+    with pytest.raises(_strava_interface.StravaAPIError):
+        cached_strava_api.fetch_activities()
+    assert cached_strava_api.activity_store.backfill_pending
+
+    resume_get = mock.Mock(
+        side_effect=[
+            MockResponse(response_data=[]),  # after= the newest stored
+            MockResponse(response_data=[oldest]),  # before= the oldest stored
+            MockResponse(response_data=[]),
+        ]
+    )
+    monkeypatch.setattr(requests.Session, "get", resume_get)
+    activities = cached_strava_api.fetch_activities()
+
+    assert [activity.id for activity in activities] == [newest["id"], oldest["id"]]
+    assert "before" in resume_get.call_args_list[1].kwargs["params"]
+    assert not cached_strava_api.activity_store.backfill_pending
+
+
+def test_strava_interface_streams_pages_lazily(monkeypatch, strava_response):
+    import requests
+
+    pages = [[route] for route in strava_response.response_data]
+    mock_get = mock.Mock(
+        side_effect=[MockResponse(response_data=page) for page in pages]
+        + [MockResponse(response_data=[])]
+    )
+    monkeypatch.setattr(requests.Session, "get", mock_get)
+    strava_api = _strava_interface.StravaAPI(
+        client_settings={
+            "CLIENT_ID": "123",
+            "CLIENT_SECRET": "456",
+            "REFRESH_TOKEN": "abcd1234",
+            "PER_PAGE": 1,
+            "FETCH_WORKERS": 1,
+        },
+        auth_token="test-token123",
+    )
+
+    activity_pages = strava_api.iter_activities()
+    first_page = next(activity_pages)
+
+    assert [activity.id for activity in first_page] == [pages[0][0]["id"]]
+    # Only the page after this one has been requested ahead of time.
+    assert mock_get.call_count < len(pages) + 1
+    assert len(list(activity_pages)) == len(pages) - 1
+
+
+def test_create_run_images_renders_each_page(monkeypatch, strava_activities):
+    monkeypatch.setattr(
+        _strava_interface.StravaAPI,
+        "iter_activities",
+        lambda self: iter([[activity] for activity in strava_activities]),
+    )
+
+    run_history = strava_runmap._create_run_images()
+
+    assert [context.display_name for context in run_history["2023"]] == [
+        activity.name for activity in strava_activities
+    ]
+
+
 @pytest.mark.parametrize(
     "polyline_decode,expect_svg_contents",
     [
@@ -215,10 +536,14 @@ def test_strava_interface_valid(mock_strava_api_get, strava_activities):
             [[0, 0], [1, 1]],
             [
                 _svg_interface.ActivitySvg(
-                    points=[[0.0012, 0.0], [49.9988, 50.0]], width=60, height=60
+                    coords=array("d", [0.0012, 0.0, 49.9988, 50.0]),
+                    width=60,
+                    height=60,
                 ),
                 _svg_interface.ActivitySvg(
-                    points=[[0.0012, 0.0], [49.9988, 50.0]], width=60, height=60
+                    coords=array("d", [0.0012, 0.0, 49.9988, 50.0]),
+                    width=60,
+                    height=60,
                 ),
             ],
         )
@@ -265,6 +590,1032 @@ def test_strava_data_turns_up_empty(
     assert svg_data == [None, None]
 
 
+def test_decode_polyline_array_matches_polyline(strava_activities):
+    import polyline
+
+    pytest.importorskip("numpy")
+    for activity in strava_activities:
+        encoded = activity.map.summary_polyline
+
+        decoded = _svg_interface.decode_polyline_array(encoded)
+
+        assert decoded.ravel().tolist() == pytest.approx(
+            [value for coords in polyline.decode(encoded) for value in coords]
+        )
+
+
+def test_vectorized_svg_data_matches_pure_python(monkeypatch, strava_activities):
+    pytest.importorskip("numpy")
+    vectorized = [
+        _svg_interface.extract_svg_data(activity) for activity in strava_activities
+    ]
+    monkeypatch.setattr(_svg_interface, "np", None)
+    pure_python = [
+        _svg_interface.extract_svg_data(activity) for activity in strava_activities
+    ]
+
+    for result, expect in zip(vectorized, pure_python):
+        assert result.points.ravel().tolist() == pytest.approx(
+            [value for point in expect.points for value in point]
+        )
+        assert (result.width, result.height) == (expect.width, expect.height)
+
+
+@pytest.mark.parametrize("method", [_simplify.DOUGLAS_PEUCKER, _simplify.VISVALINGAM])
+def test_simplify_drops_points_within_tolerance(method):
+    # Nearly straight out along the x axis, then straight up.
+    points = [[0, 0], [1, 0.001], [2, -0.001], [3, 0], [3, 1], [3.001, 2], [3, 3]]
+
+    simplified = _simplify.simplify(points, method, tolerance=0.1)
+
+    assert simplified == [[0, 0], [3, 0], [3, 3]]
+
+
+@pytest.mark.parametrize("method", [_simplify.DOUGLAS_PEUCKER, _simplify.VISVALINGAM])
+def test_simplify_keeps_shape_of_real_routes(strava_activities, method):
+    for activity in strava_activities:
+        full = _svg_interface.extract_svg_data(activity)
+        simplified = _svg_interface.extract_svg_data(
+            activity, simplify=method, tolerance=0.5
+        )
+
+        assert 2 < len(simplified.points) < len(full.points)  # noqa: PLR2004
+        # Loops come back to where they started.
+        assert simplified.points[0] == pytest.approx(full.points[0])
+        assert simplified.points[-1] == pytest.approx(full.points[-1])
+
+
+def test_render_cache_reuses_rendered_svgs(tmp_path, strava_activities):
+    encoded = strava_activities[0].map.summary_polyline
+    options = _svg_interface.RenderOptions()
+    render = mock.Mock(side_effect=_svg_interface.render_svg)
+    render_cache = _render_cache.RenderCache(tmp_path)
+
+    svg = render_cache.get_or_render(encoded, options, render)
+    assert render_cache.get_or_render(encoded, options, render) == svg
+    # A new process only has the disk tier to go on.
+    assert (
+        _render_cache.RenderCache(tmp_path).get_or_render(encoded, options, render)
+        == svg
+    )
+    render.assert_called_once()
+
+    # Different settings draw a different SVG.
+    render_cache.get_or_render(encoded, _svg_interface.RenderOptions(width=100), render)
+    assert render.call_count == 2  # noqa: PLR2004
+
+
+def test_render_cache_prunes_least_recently_used(tmp_path, strava_activities):
+    options = _svg_interface.RenderOptions()
+    render_cache = _render_cache.RenderCache(tmp_path)
+    for activity in strava_activities:
+        render_cache.get_or_render(
+            activity.map.summary_polyline, options, _svg_interface.render_svg
+        )
+    oldest, newest = (
+        _render_cache.cache_key(activity.map.summary_polyline, options)
+        for activity in strava_activities
+    )
+    os.utime(tmp_path / oldest[:2] / f"{oldest}.svg", (0, 0))
+    render_cache.max_bytes = len(render_cache.get(newest))
+
+    render_cache.prune()
+
+    assert [path.stem for path in tmp_path.glob("*/*.svg")] == [newest]
+
+
+def test_svg_renderer_parallel_matches_serial(strava_activities):
+    encoded_polylines = [
+        activity.map.summary_polyline for activity in strava_activities
+    ] * 3
+    options = _svg_interface.RenderOptions()
+
+    with _svg_interface.SvgRenderer(
+        workers=2, batch_size=2, min_parallel=0
+    ) as renderer:
+        parallel = renderer.submit(encoded_polylines, options)()
+
+    assert parallel == _svg_interface.render_svgs(encoded_polylines, options)
+
+
+def test_svg_renderer_small_inputs_stay_serial(strava_activities):
+    renderer = _svg_interface.SvgRenderer(workers=2, min_parallel=100)
+
+    renderer.submit(
+        [strava_activities[0].map.summary_polyline], _svg_interface.RenderOptions()
+    )
+
+    assert renderer._executor is None
+
+
+def test_pure_python_points_share_one_flat_buffer(monkeypatch, strava_activities):
+    monkeypatch.setattr(_svg_interface, "np", None)
+
+    for activity in strava_activities:
+        full = _svg_interface.extract_svg_data(activity)
+        simplified = _svg_interface.extract_svg_data(
+            activity, simplify=_simplify.DOUGLAS_PEUCKER, tolerance=0.5
+        )
+
+        assert isinstance(full.coords, array)
+        assert isinstance(simplified.coords, array)
+        assert simplified.points == _simplify.simplify(
+            full.points, _simplify.DOUGLAS_PEUCKER, 0.5
+        )
+
+
+def test_activity_records_are_compact(strava_activities):
+    activity = strava_activities[0]
+
+    assert not hasattr(activity, "__dict__")
+    assert not hasattr(activity.map, "__dict__")
+    with pytest.raises(AttributeError):
+        activity.name = "Renamed"
+
+
+@pytest.mark.parametrize(
+    "value,precision,expect",
+    [(0, 1, "0"), (120, 1, "12"), (123, 1, "12.3"), (5, 1, ".5"), (-5, 2, "-.05")],
+)
+def test_format_fixed(value, precision, expect):
+    assert _svg_interface._format_fixed(value, precision) == expect
+
+
+def test_convert_to_svg_path_merges_collinear_steps():
+    activity_svg = _svg_interface.ActivitySvg(
+        # Right in three steps (with one that goes nowhere), then up and back left.
+        coords=array("d", [0, 0, 1.04, 0, 1.04, 0, 2, 0, 3, 0, 3, 1.5, 0, 1.5]),
+        width=60,
+        height=60,
+    )
+
+    svg = _svg_interface.convert_to_svg_path(activity_svg, precision=1)
+
+    assert 'd="M0 0l3 0 0 1.5-3 0"' in svg
+    assert "transform" not in svg
+
+
+def _polyline_points(svg: str) -> list[tuple[float, float]]:
+    """Points of a polyline format SVG, with y flipped to run down as in a path."""
+    height = float(re.search(r'viewBox="0 0 \S+ (\S+)"', svg).group(1))
+    points = re.search(r'points="([^"]*)"', svg).group(1)
+    return [
+        (float(x), height - float(y))
+        for x, y in (point.split(",") for point in points.split())
+    ]
+
+
+def _path_points(svg: str) -> list[tuple[float, float]]:
+    """Points of a path format SVG, adding up its relative steps."""
+    moves = re.fullmatch(r"M(\S+) (\S+)(?:l(.*))?", re.search(r'd="([^"]*)"', svg)[1])
+    x, y = float(moves[1]), float(moves[2])
+    points = [(x, y)]
+    steps = [float(number) for number in re.findall(r"-?[\d.]+", moves[3] or "")]
+    for dx, dy in zip(steps[::2], steps[1::2]):
+        x, y = x + dx, y + dy
+        points.append((x, y))
+    return points
+
+
+def test_path_format_draws_the_polyline_format_route(monkeypatch, strava_activities):
+    precision = 2
+    path_options = _svg_interface.RenderOptions(svg_format="path", precision=precision)
+    # Snapping to the grid moves a point by up to half a grid step on each axis.
+    tolerance = 10**-precision / 2 + 1e-9
+    for activity in strava_activities:
+        encoded = activity.map.summary_polyline
+        polyline_svg = _svg_interface.render_svg(
+            encoded, _svg_interface.RenderOptions()
+        )
+        path_svg = _svg_interface.render_svg(encoded, path_options)
+        with monkeypatch.context() as patch:
+            patch.setattr(_svg_interface, "np", None)
+            pure_python_path_svg = _svg_interface.render_svg(encoded, path_options)
+
+        route = _polyline_points(polyline_svg)
+        path = _path_points(path_svg)
+        # Every point drawn is one of the route's, in order, with only points
+        #     along a straight step or that snap to the same spot dropped.
+        remaining = iter(route)
+        for x, y in path:
+            assert any(
+                abs(x - route_x) <= tolerance and abs(y - route_y) <= tolerance
+                for route_x, route_y in remaining
+            )
+        assert path[0] == pytest.approx(route[0], abs=tolerance)
+        assert path[-1] == pytest.approx(route[-1], abs=tolerance)
+        assert len(path_svg) < len(polyline_svg) / 2
+        assert path_svg == pure_python_path_svg
+
+
+def test_heatmap_accumulates_every_cell_a_track_crosses():
+    pytest.importorskip("numpy")
+    heatmap = _heatmap.Heatmap((0, 0, 1, 1), resolution=10)
+    # Diagonally across the region and back, plus a track far outside it.
+    track = _svg_interface.np.array([[0.05, 0.05], [0.95, 0.95], [0.05, 0.05]])
+    heatmap.add_track(track)
+    heatmap.add_track(track + 10)
+
+    png = heatmap.to_png()
+
+    # North is up, so the track runs from the bottom left to the top right.
+    grid = heatmap.counts.reshape(heatmap.rows, heatmap.cols)[::-1]
+    assert (heatmap.rows, heatmap.cols) == (10, 10)
+    assert grid.diagonal().all()
+    assert grid.sum() == grid.diagonal().sum()
+    assert png.startswith(b"\x89PNG")
+
+
+def test_build_heatmaps(strava_activities):
+    pytest.importorskip("numpy")
+    tracks = _spatial_index.SpatialIndex()
+    for activity in strava_activities:
+        encoded = activity.map.summary_polyline
+        tracks.insert(encoded, _spatial_index.polyline_bounds(encoded))
+
+    heatmaps = _heatmap.build_heatmaps(tracks, resolution=32)
+    regions = _heatmap.build_heatmaps(
+        tracks, {"Nowhere": (-1, -1, 0, 0)}, resolution=32
+    )
+
+    assert list(heatmaps) == ["All Activities"]
+    assert heatmaps["All Activities"].startswith('<img src="data:image/png;base64,')
+    assert list(regions) == ["Nowhere"]
+
+
+def test_spatial_index_queries_and_clusters():
+    index = _spatial_index.SpatialIndex(cell_degrees=0.25)
+    index.insert("tokyo", (35.6, 139.6, 35.7, 139.8))
+    index.insert("sendai", (38.2, 140.8, 38.3, 140.9))
+    index.insert("tokyo again", (35.75, 139.85, 35.8, 139.9))
+
+    assert index.clusters() == [["tokyo", "tokyo again"], ["sendai"]]
+
+    # A GPS glitch, too big to put in cells.
+    index.insert("glitch", (0, 0, 50, 150))
+
+    assert index.query((35.5, 139.5, 36, 140)) == ["tokyo", "tokyo again", "glitch"]
+    assert index.query((-10, -10, -5, -5)) == []
+    assert index.bounds == (0, 0, 50, 150)
+    assert index.clusters() == [["tokyo", "tokyo again"], ["sendai"], ["glitch"]]
+
+
+def test_bounds_cache_keeps_bounds_apart_from_svgs(tmp_path):
+    encoded = polyline.encode([(35.6, 139.6), (35.7, 139.8)])
+    compute = mock.Mock(return_value=(35.6, 139.6, 35.7, 139.8))
+    bounds_cache = _spatial_index.BoundsCache()
+    bounds_cache.configure(tmp_path)
+
+    bounds = bounds_cache.get(encoded, compute)
+    assert bounds_cache.get(encoded, compute) == bounds
+    bounds_cache.save()
+    reloaded = _spatial_index.BoundsCache()
+    reloaded.configure(tmp_path)
+
+    compute.assert_called_once()
+    assert reloaded.get(encoded, mock.Mock(side_effect=AssertionError)) == bounds
+    assert [path.name for path in tmp_path.iterdir()] == [
+        _spatial_index.BOUNDS_CACHE_FILENAME
+    ]
+
+
+@pytest.mark.parametrize(
+    "regions,expect_groups",
+    [({"Sendai": (38, 140, 39, 141)}, ["Sendai"]), ({}, ["Around 38.34, 140.84"])],
+)
+def test_create_run_images_groups_by_region(
+    monkeypatch, strava_activities, regions, expect_groups
+):
+    monkeypatch.setitem(strava_runmap.STRAVA_RUNMAP_SETTINGS, "GROUP_BY", "region")
+    monkeypatch.setitem(strava_runmap.STRAVA_RUNMAP_SETTINGS, "REGIONS", regions)
+    monkeypatch.setattr(
+        _strava_interface.StravaAPI,
+        "iter_activities",
+        lambda self: iter([strava_activities]),
+    )
+
+    run_history = strava_runmap._create_run_images()
+
+    assert list(run_history) == expect_groups
+    assert len(run_history[expect_groups[0]]) == len(strava_activities)
+
+
+@pytest.mark.parametrize(
+    "paginate,expect_slugs",
+    [
+        ("year", ["strava-runmap-2023", "strava-runmap-2022"]),
+        (2, ["strava-runmap-page-1", "strava-runmap-page-2"]),
+    ],
+)
+def test_build_runmap_pages(monkeypatch, paginate, expect_slugs):
+    monkeypatch.setitem(strava_runmap.STRAVA_RUNMAP_SETTINGS, "PAGINATE", paginate)
+    monkeypatch.setattr(strava_runmap, "PAGE_CONTENT", {})
+    run_history = {
+        year: [
+            strava_runmap.SvgPageContext(
+                display_name=f"Run {year} {number}",
+                display_date=f"{year}-01-0{number}",
+                svg_content="<svg></svg>",
+                distance_display="5000m in 30",
+            )
+            for number in range(1, count + 1)
+        ]
+        for year, count in [("2023", 2), ("2022", 1)]
+    }
+
+    pages = strava_runmap._build_runmap_pages(run_history, None, DEFAULT_CONFIG)
+    rebuilt = strava_runmap._build_runmap_pages(run_history, None, DEFAULT_CONFIG)
+
+    index, *year_pages = pages
+    assert index["slug"] == "strava-runmap"
+    assert [page["slug"] for page in year_pages] == expect_slugs
+    assert all(
+        f'href="/pages/{slug}.html"' in index["content"] for slug in expect_slugs
+    )
+    assert "Run 2022 1" not in year_pages[0]["content"]
+    assert 'href="/pages/strava-runmap.html"' in year_pages[0]["content"]
+    assert f'href="/pages/{expect_slugs[1]}.html">Next' in year_pages[0]["content"]
+    assert f'href="/pages/{expect_slugs[0]}.html">Previous' in year_pages[1]["content"]
+    assert all(
+        page["content"] is rebuilt_page["content"]
+        for page, rebuilt_page in zip(pages, rebuilt)
+    )
+
+
+def test_sprite_sheets_emit_each_route_once(monkeypatch, tmp_path, strava_activities):
+    monkeypatch.setattr(strava_runmap, "SPRITE_SHEETS", _sprites.SpriteSheets())
+    svgs = [
+        _svg_interface.render_svg(
+            activity.map.summary_polyline, _svg_interface.RenderOptions()
+        )
+        for activity in strava_activities
+    ]
+    run_history = {
+        year: [
+            strava_runmap.SvgPageContext(
+                display_name="Run",
+                display_date="2023-01-01",
+                svg_content=svg,
+                distance_display="5000m in 30",
+            )
+            for svg in year_svgs
+        ]
+        # The same route in both years.
+        for year, year_svgs in [("2023", svgs), ("2022", svgs[:1])]
+    }
+
+    sprite_history = strava_runmap._use_sprite_sheets(run_history, DEFAULT_CONFIG)
+    strava_runmap.SPRITE_SHEETS.write(tmp_path)
+
+    (sheet,) = (tmp_path / _sprites.SPRITE_DIR).iterdir()
+    assert sheet.name.startswith("2023-")
+    assert sheet.read_text().count("<symbol") == len(svgs)
+    assert "<polyline" not in sprite_history["2023"][0].svg_content
+    assert (
+        sprite_history["2022"][0].svg_content == sprite_history["2023"][0].svg_content
+    )
+    assert f'<use href="/{_sprites.SPRITE_DIR}/{sheet.name}#route-' in (
+        sprite_history["2022"][0].svg_content
+    )
+
+
+def test_sprite_sheets_remove_stale_sheets(tmp_path, strava_activities):
+    sprite_dir = tmp_path / _sprites.SPRITE_DIR
+    sprite_dir.mkdir()
+    (sprite_dir / "2023-0123456789ab.svg").write_text("<svg/>")
+    (sprite_dir / "notes.txt").write_text("Not a sheet")
+    sprite_sheets = _sprites.SpriteSheets()
+    sprite_sheets.add(
+        "2023",
+        _svg_interface.render_svg(
+            strava_activities[0].map.summary_polyline, _svg_interface.RenderOptions()
+        ),
+    )
+
+    sprite_sheets.write(tmp_path)
+
+    assert sorted(path.name for path in sprite_dir.iterdir()) == sorted(
+        [sprite_sheets.filename("2023").rsplit("/", 1)[-1], "notes.txt"]
+    )
+
+
+def test_unchanged_builds_reuse_the_last_pages(
+    monkeypatch, tmp_path, strava_activities
+):
+    monkeypatch.setattr(
+        _strava_interface.StravaAPI,
+        "iter_activities",
+        lambda self: iter([strava_activities]),
+    )
+    monkeypatch.setattr(strava_runmap, "PAGE_CACHE", _page_cache.PageCache())
+    strava_runmap.PAGE_CACHE.configure(tmp_path)
+    settings = {**DEFAULT_CONFIG, "CACHE_CONTENT": True, "LOAD_CONTENT_CACHE": True}
+    build_content = mock.Mock(wraps=strava_runmap._build_runmap_content)
+    monkeypatch.setattr(strava_runmap, "_build_runmap_content", build_content)
+
+    def _build():
+        page_generator = mock.Mock(settings=settings, pages=[])
+        strava_runmap.add_runmap_page(page_generator)
+        return page_generator.pages[0].content
+
+    first = _build()
+    # Settings that don't change the page don't make it stale either.
+    for key, value in [("PREFETCH_TIMEOUT", 1), ("RENDER_BATCH_SIZE", 1)]:
+        monkeypatch.setitem(strava_runmap.STRAVA_RUNMAP_SETTINGS, key, value)
+    unchanged = _build()
+    # A new process, with only the cache on disk.
+    monkeypatch.setattr(strava_runmap, "PAGE_CACHE", _page_cache.PageCache())
+    strava_runmap.PAGE_CACHE.configure(tmp_path)
+    from_disk = _build()
+    monkeypatch.setitem(
+        strava_runmap.STRAVA_RUNMAP_SETTINGS, "DATE_DISPLAY_FORMAT", "%d/%m/%Y"
+    )
+    changed = _build()
+
+    assert first == unchanged == from_disk
+    assert changed != first
+    assert build_content.call_count == 2  # noqa: PLR2004
+
+
+def test_unchanged_activities_are_not_rendered_again(
+    monkeypatch, tmp_path, strava_activities
+):
+    monkeypatch.setattr(
+        _strava_interface.StravaAPI,
+        "iter_activities",
+        lambda self: iter([strava_activities]),
+    )
+    settings = {**DEFAULT_CONFIG, "CACHE_CONTENT": True, "LOAD_CONTENT_CACHE": True}
+    monkeypatch.setattr(strava_runmap, "PELICAN_SETTINGS", settings)
+    submit = mock.Mock(wraps=strava_runmap._submit_run_images)
+    monkeypatch.setattr(strava_runmap, "_submit_run_images", submit)
+
+    def _build():
+        # A new process, with only the cache on disk.
+        monkeypatch.setattr(strava_runmap, "PREFETCH", _prefetch.Prefetch())
+        monkeypatch.setattr(strava_runmap, "PAGE_CACHE", _page_cache.PageCache())
+        strava_runmap.PAGE_CACHE.configure(tmp_path)
+        page_generator = mock.Mock(settings=settings, pages=[])
+        strava_runmap.add_runmap_page(page_generator)
+        return page_generator.pages[0].content
+
+    first = _build()
+    submitted = submit.call_count
+    unchanged = _build()
+
+    assert submitted > 0
+    assert submit.call_count == submitted
+    assert unchanged == first
+
+
+def test_synthetic_activities_are_deterministic():
+    min_points, max_points = 5, 10
+    activities = _synthetic.synthetic_activities(3, (min_points, max_points))
+
+    assert activities == _synthetic.synthetic_activities(3, (min_points, max_points))
+    assert activities != _synthetic.synthetic_activities(
+        3, (min_points, max_points), seed=1
+    )
+    for activity in activities:
+        route = _strava_interface.StravaRouteData.from_strava_data(dict(activity))
+        points = polyline.decode(route.map.summary_polyline)
+        assert min_points <= len(points) <= max_points
+
+
+def test_benchmark_saves_every_stage(tmp_path):
+    output = tmp_path / "benchmark.json"
+
+    _benchmark.main(
+        ["--sizes", "2", "3", "--points", "5", "10", "--output", str(output)]
+    )
+
+    report = json.loads(output.read_text())
+    assert [
+        (result["stage"], result["activities"]) for result in report["results"]
+    ] == [(stage, size) for size in (2, 3) for stage in _benchmark._stages([])]
+
+
+def test_fetch_through_standin_server_with_failures(mock_sleep):
+    activities = _synthetic.synthetic_activities(450, points=(5, 10))
+    options = _standin_server.StandinOptions(
+        max_per_page=100, error_rate=0.2, drop_rate=0.1, seed=1
+    )
+
+    with _standin_server.StandinServer(activities, options) as server:
+        strava_api = _strava_interface.StravaAPI(
+            {**server.settings, "PER_PAGE": 100, "MAX_RETRIES": 20}
+        )
+        fetched = strava_api.fetch_activities()
+
+    assert [activity.id for activity in fetched] == [
+        activity["id"] for activity in activities
+    ]
+    assert server.counts["dropped"]
+    assert strava_api.remaining_budget.short_term is not None
+
+
+def test_high_fidelity_streams_are_downsampled_and_kept(tmp_path):
+    activities = _synthetic.synthetic_activities(20, points=(50, 60))
+    activities[0]["map"]["summary_polyline"] = ""
+
+    with _standin_server.StandinServer(activities) as server:
+        settings = {**server.settings, "HIGH_FIDELITY": "1", "CACHE_DIR": tmp_path}
+        fetched = _strava_interface.StravaAPI(settings).fetch_activities()
+        streams_fetched = server.counts["streams"]
+        refetched = _strava_interface.StravaAPI(settings).fetch_activities()
+
+    assert streams_fetched == len(activities) - 1
+    assert server.counts["streams"] == streams_fetched
+    assert [activity.map for activity in refetched] == [
+        activity.map for activity in fetched
+    ]
+    assert not fetched[0].map.polyline
+    for activity in fetched[1:]:
+        stream_points = server.stream(str(activity.id))["latlng"]["data"]
+        assert 1 < len(polyline.decode(activity.map.polyline)) < len(stream_points)
+        assert activity.map.route_polyline == activity.map.polyline
+
+
+def test_downsample_drops_points_that_would_not_show():
+    straight = [[35.0 + index * 1e-4, 139.0] for index in range(100)]
+    corner = [*straight, [35.0099, 139.01]]
+
+    assert polyline.decode(_streams.downsample(straight)) == [
+        (35.0, 139.0),
+        (35.0099, 139.0),
+    ]
+    assert len(polyline.decode(_streams.downsample(corner))) == 3  # noqa: PLR2004
+    assert _streams.downsample([]) == _streams.NO_STREAM
+
+
+def test_build_metrics(monkeypatch, tmp_path):
+    activities = _synthetic.synthetic_activities(30, points=(5, 10))
+    metrics_file = tmp_path / "metrics.json"
+    monkeypatch.setattr(strava_runmap, "PAGE_CACHE", _page_cache.PageCache())
+    monkeypatch.setattr(_metrics.METRICS, "enabled", True)
+    monkeypatch.setitem(
+        strava_runmap.STRAVA_RUNMAP_SETTINGS, "METRICS_FILE", str(metrics_file)
+    )
+    monkeypatch.setitem(
+        strava_runmap.STRAVA_RUNMAP_SETTINGS, "SIMPLIFY", _simplify.DOUGLAS_PEUCKER
+    )
+
+    with _standin_server.StandinServer(activities) as server:
+        for key, value in server.settings.items():
+            monkeypatch.setitem(strava_runmap.STRAVA_RUNMAP_SETTINGS, key, value)
+        strava_runmap.add_runmap_page(mock.Mock(settings=DEFAULT_CONFIG, pages=[]))
+
+    report = json.loads(metrics_file.read_text())
+    assert {
+        "strava.auth",
+        "strava.request",
+        "strava.parse_json",
+        "runmap.create_run_images",
+        "runmap.build_page",
+        "runmap.total",
+    } <= set(report["spans"])
+    assert report["counters"]["strava.requests"] == 2  # noqa: PLR2004
+    assert report["counters"]["strava.activities"] == len(activities)
+    assert report["counters"]["svg.vertices"] >= report["counters"]["svg.vertices_kept"]
+
+
+def test_disabled_metrics_record_nothing():
+    metrics = _metrics.Metrics()
+
+    with metrics.span("stage"):
+        metrics.count("things")
+
+    assert metrics.report() == {"spans": {}, "counters": {}}
+
+
+def test_activities_are_prefetched_from_initialized(monkeypatch, tmp_path):
+    activities = _synthetic.synthetic_activities(30, points=(5, 10))
+    monkeypatch.setattr(
+        strava_runmap,
+        "STRAVA_RUNMAP_SETTINGS",
+        dict(strava_runmap.STRAVA_RUNMAP_SETTINGS),
+    )
+    monkeypatch.setattr(strava_runmap, "PAGE_CACHE", _page_cache.PageCache())
+    monkeypatch.setattr(strava_runmap, "RENDER_CACHE", _render_cache.RenderCache())
+    monkeypatch.setattr(_metrics.METRICS, "enabled", False)
+    page_generator = mock.Mock(settings=DEFAULT_CONFIG, pages=[])
+
+    with _standin_server.StandinServer(activities) as server:
+        strava_runmap.init_default_config(
+            mock.Mock(
+                settings={
+                    "CACHE_PATH": str(tmp_path),
+                    strava_runmap.STRAVA_RUNMAP_KEY: server.settings,
+                }
+            )
+        )
+        strava_runmap.add_runmap_page(page_generator)
+
+    assert server.counts["activities"] == len(activities)
+    assert not strava_runmap.PREFETCH.pending
+    assert len(page_generator.pages) == 1
+
+
+def test_prefetch_timeout_falls_back_to_cached_activities(monkeypatch):
+    release = threading.Event()
+    prefetch = _prefetch.Prefetch()
+    prefetch.start(release.wait)
+    create_run_images = mock.Mock(return_value={})
+    monkeypatch.setattr(strava_runmap, "PREFETCH", prefetch)
+    monkeypatch.setattr(strava_runmap, "PAGE_CACHE", _page_cache.PageCache())
+    monkeypatch.setattr(strava_runmap, "_create_run_images", create_run_images)
+    monkeypatch.setitem(strava_runmap.STRAVA_RUNMAP_SETTINGS, "PREFETCH_TIMEOUT", 0.01)
+
+    strava_runmap.add_runmap_page(mock.Mock(settings=DEFAULT_CONFIG, pages=[]))
+    release.set()
+
+    create_run_images.assert_called_once_with([], from_cache=True)
+
+
+def test_prefetch_finishing_during_the_fallback_keeps_its_own_counts(
+    monkeypatch, tmp_path
+):
+    activities = _synthetic.synthetic_activities(10, points=(5, 10))
+    fallback_rendering, prefetch_finished = threading.Event(), threading.Event()
+    submit_run_images = strava_runmap._submit_run_images
+    counts = []
+
+    class _Counts(_render_cache.Counts):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            counts.append(self)
+
+    def _submit_run_images(*args):
+        submitted = submit_run_images(*args)
+        if threading.current_thread() is threading.main_thread():
+            # Let the prefetch render everything while the fallback is rendering.
+            fallback_rendering.set()
+            prefetch_finished.wait(10)
+        return submitted
+
+    def _late_prefetch():
+        fallback_rendering.wait(10)
+        try:
+            return strava_runmap._prefetch_run_images()
+        finally:
+            prefetch_finished.set()
+
+    with _standin_server.StandinServer(activities) as server:
+        for key, value in server.settings.items():
+            monkeypatch.setitem(strava_runmap.STRAVA_RUNMAP_SETTINGS, key, value)
+        monkeypatch.setitem(strava_runmap.STRAVA_RUNMAP_SETTINGS, "CACHE_DIR", tmp_path)
+        # Fills the activity store for the fallback to build from.
+        strava_runmap.add_runmap_page(mock.Mock(settings=DEFAULT_CONFIG, pages=[]))
+        # Without any pages or SVGs to reuse, both draw every route.
+        monkeypatch.setattr(strava_runmap, "PAGE_CACHE", _page_cache.PageCache())
+        monkeypatch.setattr(strava_runmap, "RENDER_CACHE", _render_cache.RenderCache())
+        monkeypatch.setattr(strava_runmap, "PREFETCH", _prefetch.Prefetch())
+        monkeypatch.setattr(strava_runmap, "_submit_run_images", _submit_run_images)
+        monkeypatch.setattr(_render_cache, "Counts", _Counts)
+        monkeypatch.setitem(
+            strava_runmap.STRAVA_RUNMAP_SETTINGS, "PREFETCH_TIMEOUT", 0.01
+        )
+        strava_runmap.PREFETCH.start(
+            _late_prefetch, dict(strava_runmap.STRAVA_RUNMAP_SETTINGS)
+        )
+        page_generator = mock.Mock(settings=DEFAULT_CONFIG, pages=[])
+        strava_runmap.add_runmap_page(page_generator)
+        _, late_activities = strava_runmap.PREFETCH.take(timeout=10)
+
+    # The fallback's and the prefetch's, each counting only its own routes.
+    assert [(count.hits, count.misses) for count in counts] == [
+        (0, len(activities)),
+        (0, len(activities)),
+    ]
+    assert len(page_generator.pages) == 1
+    assert len(late_activities) == len(activities)
+
+
+def test_prefetch_take_times_out_like_a_future():
+    release = threading.Event()
+    prefetch = _prefetch.Prefetch()
+    prefetch.start(release.wait)
+
+    with pytest.raises(futures.TimeoutError):
+        prefetch.take(timeout=0.01)
+    release.set()
+
+    assert prefetch.take(timeout=10) is True
+
+
+def test_rebuilds_reuse_run_images_and_access_token(monkeypatch):
+    activities = _synthetic.synthetic_activities(30, points=(5, 10))
+    monkeypatch.setattr(strava_runmap, "PAGE_CACHE", _page_cache.PageCache())
+
+    with _standin_server.StandinServer(activities) as server:
+        for key, value in server.settings.items():
+            monkeypatch.setitem(strava_runmap.STRAVA_RUNMAP_SETTINGS, key, value)
+        for _ in range(2):
+            strava_runmap.add_runmap_page(mock.Mock(settings=DEFAULT_CONFIG, pages=[]))
+        # Authenticating, and a single page of activities.
+        assert server.counts["requests"] == 2  # noqa: PLR2004
+
+        strava_runmap.PREFETCH.last_at -= _prefetch.DEFAULT_REFRESH_INTERVAL
+        strava_runmap.add_runmap_page(mock.Mock(settings=DEFAULT_CONFIG, pages=[]))
+        strava_runmap.PREFETCH.take(timeout=10)
+
+    # The refresh fetched the page again, with the access token from before.
+    assert server.counts["requests"] == 3  # noqa: PLR2004
+    assert server.counts["activities"] == 2 * len(activities)
+
+
+def test_settings_changed_during_a_refresh_are_redrawn(monkeypatch):
+    activities = _synthetic.synthetic_activities(5, points=(5, 10))
+    release = threading.Event()
+    prefetch_run_images = strava_runmap._prefetch_run_images
+
+    def _slow_prefetch_run_images():
+        release.wait()
+        return prefetch_run_images()
+
+    monkeypatch.setattr(
+        strava_runmap, "_prefetch_run_images", _slow_prefetch_run_images
+    )
+
+    with _standin_server.StandinServer(activities) as server:
+        for key, value in server.settings.items():
+            monkeypatch.setitem(strava_runmap.STRAVA_RUNMAP_SETTINGS, key, value)
+        release.set()
+        strava_runmap.add_runmap_page(mock.Mock(settings=DEFAULT_CONFIG, pages=[]))
+        release.clear()
+        strava_runmap.PREFETCH.last_at -= _prefetch.DEFAULT_REFRESH_INTERVAL
+        # Starts a refresh, which is still running when the settings are edited.
+        strava_runmap.add_runmap_page(mock.Mock(settings=DEFAULT_CONFIG, pages=[]))
+        monkeypatch.setitem(
+            strava_runmap.STRAVA_RUNMAP_SETTINGS,
+            "SVG_FORMAT",
+            _svg_interface.SVG_FORMAT_PATH,
+        )
+        # As `init_default_config` would, which can't start over the refresh.
+        strava_runmap.PREFETCH.start(
+            strava_runmap._prefetch_run_images,
+            dict(strava_runmap.STRAVA_RUNMAP_SETTINGS),
+        )
+        release.set()
+        page_generator = mock.Mock(settings=DEFAULT_CONFIG, pages=[])
+        strava_runmap.add_runmap_page(page_generator)
+
+    content = page_generator.pages[0].content
+    assert "<path" in content
+    assert "<polyline" not in content
+    assert strava_runmap.PREFETCH.last_key == strava_runmap.STRAVA_RUNMAP_SETTINGS
+
+
+def test_theme_can_override_the_page_template(monkeypatch, tmp_path):
+    run_history = {"2024": [], "2023": []}
+    page_template = _page_template.PageTemplate()
+    monkeypatch.setattr(strava_runmap, "PAGE_TEMPLATE", page_template)
+    default_page = strava_runmap._build_runmap_page(run_history)
+    (tmp_path / _page_template.TEMPLATE_NAME).write_text(
+        "{% for year in run_history %}{{ year }};{% endfor %}"
+    )
+
+    page_template.configure(
+        {**DEFAULT_CONFIG, "THEME_TEMPLATES_OVERRIDES": [str(tmp_path)]}
+    )
+
+    assert default_page.count("<h2>") == len(run_history)
+    assert strava_runmap._build_runmap_page(run_history) == "2024;2023;"
+
+
+EXPORT_CSV = (
+    "Activity ID,Activity Date,Activity Name,Activity Type,Elapsed Time,Distance,"
+    "Filename,Moving Time,Distance\n"
+    '101,"Oct 30, 2023, 12:02:49 AM",Morning Run,Run,1900,5.01,'
+    "activities/101.gpx,1800,5012.3\n"
+    '102,"Nov 2, 2023, 10:30:00 PM",Evening Run,Run,2500,7.2,'
+    "activities/102.tcx.gz,2400,7203.0\n"
+    '103,"Nov 5, 2023, 9:00:00 AM",Watch Run,Run,1300,3.0,'
+    "activities/103.fit.gz,1200,3000.5\n"
+)
+EXPORT_GPX = """<?xml version="1.0" encoding="UTF-8"?>
+<gpx version="1.1" xmlns="http://www.topografix.com/GPX/1/1"><trk><trkseg>
+<trkpt lat="35.0" lon="139.0"><ele>10</ele></trkpt>
+<trkpt lat="35.01" lon="139.0"><ele>10</ele></trkpt>
+<trkpt lat="35.01" lon="139.01"><ele>10</ele></trkpt>
+</trkseg></trk></gpx>
+"""
+EXPORT_TCX = """<?xml version="1.0" encoding="UTF-8"?>
+<TrainingCenterDatabase
+  xmlns="http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2">
+<Activities><Activity Sport="Running"><Lap><Track>
+<Trackpoint><Position><LatitudeDegrees>35.5</LatitudeDegrees>
+<LongitudeDegrees>139.5</LongitudeDegrees></Position></Trackpoint>
+<Trackpoint><HeartRateBpm><Value>120</Value></HeartRateBpm></Trackpoint>
+<Trackpoint><Position><LatitudeDegrees>35.52</LatitudeDegrees>
+<LongitudeDegrees>139.5</LongitudeDegrees></Position></Trackpoint>
+</Track></Lap></Activity></Activities></TrainingCenterDatabase>
+"""
+
+
+def _write_strava_export(path, zipped):
+    files = {
+        _strava_export.ACTIVITIES_CSV: EXPORT_CSV.encode(),
+        "activities/101.gpx": EXPORT_GPX.encode(),
+        "activities/102.tcx.gz": gzip.compress(EXPORT_TCX.encode()),
+        "activities/103.fit.gz": gzip.compress(b".FIT"),
+    }
+    if zipped:
+        path = path / "export.zip"
+        with zipfile.ZipFile(path, "w") as archive:
+            for name, content in files.items():
+                archive.writestr(name, content)
+        return path
+    path = path / "export"
+    for name, content in files.items():
+        (path / name).parent.mkdir(parents=True, exist_ok=True)
+        (path / name).write_bytes(content)
+    return path
+
+
+@pytest.mark.parametrize("zipped,workers", [(False, 1), (True, 2)])
+def test_strava_export_activities(monkeypatch, tmp_path, zipped, workers):
+    settings = {
+        "EXPORT_PATH": _write_strava_export(tmp_path, zipped),
+        "EXPORT_TIMEZONE": "Asia/Tokyo",
+        "EXPORT_WORKERS": workers,
+        "CACHE_DIR": tmp_path / "cache",
+    }
+
+    activities = _strava_export.StravaExport(settings).fetch_activities()
+    monkeypatch.setattr(_strava_export, "parse_track", mock.Mock())
+    reloaded = _strava_export.StravaExport(settings).fetch_activities()
+
+    assert [activity.id for activity in activities] == [103, 102, 101]
+    watch_run, evening_run, morning_run = activities
+    assert morning_run.distance == 5012.3  # noqa: PLR2004
+    assert morning_run.moving_time == 1800  # noqa: PLR2004
+    assert morning_run.start_date == datetime(2023, 10, 30, 0, 2, 49)
+    assert morning_run.start_date_local == datetime(2023, 10, 30, 9, 2, 49)
+    assert morning_run.timezone == zoneinfo.ZoneInfo("Asia/Tokyo")
+    assert polyline.decode(morning_run.map.route_polyline) == [
+        (35.0, 139.0),
+        (35.01, 139.0),
+        (35.01, 139.01),
+    ]
+    assert polyline.decode(evening_run.map.route_polyline) == [
+        (35.5, 139.5),
+        (35.52, 139.5),
+    ]
+    assert not watch_run.map.route_polyline
+    assert reloaded == activities
+    _strava_export.parse_track.assert_not_called()
+
+
+def test_strava_export_reparses_only_changed_tracks(tmp_path):
+    export_path = _write_strava_export(tmp_path, zipped=False)
+    settings = {"EXPORT_PATH": export_path, "CACHE_DIR": tmp_path / "cache"}
+    _strava_export.StravaExport(settings).fetch_activities()
+    cache = json.loads((tmp_path / "cache" / _strava_export.CACHE_FILENAME).read_text())
+    # New tracks are hashed by the parser, rather than before it.
+    assert all(
+        track["hash"].startswith("sha256:") for track in cache["tracks"].values()
+    )
+    # Touched, but unchanged, so its content hash still matches.
+    os.utime(export_path / "activities/101.gpx", ns=(0, 0))
+    (export_path / "activities/102.tcx.gz").write_bytes(
+        gzip.compress(EXPORT_TCX.replace("35.52", "35.53").encode())
+    )
+
+    with mock.patch.object(
+        _strava_export, "parse_track", wraps=_strava_export.parse_track
+    ) as parse_track:
+        activities = _strava_export.StravaExport(settings).fetch_activities()
+
+    assert [call.args[1] for call in parse_track.call_args_list] == [
+        "activities/102.tcx.gz"
+    ]
+    assert polyline.decode(activities[1].map.route_polyline)[-1] == (35.53, 139.5)
+
+
+def test_activity_archive_reloads_routes_without_decoding(tmp_path):
+    activities = [
+        _strava_interface.StravaRouteData.from_strava_data(activity)
+        for activity in _synthetic.synthetic_activities(20, points=(20, 30))
+    ]
+    _activity_archive.ActivityArchive().configure(tmp_path)
+    archive = _activity_archive.ActivityArchive()
+    archive.configure(tmp_path)
+    archive.save(activities)
+    written_at = (tmp_path / _activity_archive.ARCHIVE_FILENAME).stat().st_mtime_ns
+
+    reloaded = _activity_archive.ActivityArchive()
+    reloaded.configure(tmp_path)
+    with mock.patch.object(
+        _activity_archive, "decode_coords", side_effect=AssertionError
+    ):
+        routes = [reloaded.route_coords(activity) for activity in activities]
+        reloaded.save(activities)
+    edited = dataclasses.replace(
+        activities[0],
+        map=dataclasses.replace(
+            activities[0].map, summary_polyline=polyline.encode([(35.0, 139.0)])
+        ),
+    )
+
+    assert len(reloaded) == len(activities)
+    for activity, route in zip(activities, routes):
+        assert isinstance(route, memoryview)
+        assert list(route) == pytest.approx(
+            [
+                value
+                for point in polyline.decode(activity.map.route_polyline)
+                for value in point
+            ],
+            abs=1e-5,
+        )
+    assert (
+        tmp_path / _activity_archive.ARCHIVE_FILENAME
+    ).stat().st_mtime_ns == written_at
+    assert list(reloaded.route_coords(edited)) == pytest.approx([35.0, 139.0])
+
+
+def test_activity_archive_saves_and_reads_across_threads(tmp_path):
+    activities = [
+        _strava_interface.StravaRouteData.from_strava_data(activity)
+        for activity in _synthetic.synthetic_activities(40, points=(20, 30))
+    ]
+    archive = _activity_archive.ActivityArchive()
+    archive.configure(tmp_path)
+    histories = [activities[: 10 + index] for index in range(20)]
+    errors = []
+
+    def _save(histories):
+        try:
+            for history in histories:
+                archive.save(history)
+        except Exception as e:  # noqa: BLE001
+            errors.append(e)
+
+    savers = [
+        threading.Thread(target=_save, args=(histories[start::2],))
+        for start in range(2)
+    ]
+    for saver in savers:
+        saver.start()
+    while any(saver.is_alive() for saver in savers):
+        for activity in activities:
+            assert len(archive.route_coords(activity))
+    for saver in savers:
+        saver.join()
+
+    assert not errors
+    assert not list(tmp_path.glob("*.tmp"))
+    reloaded = _activity_archive.ActivityArchive()
+    reloaded.configure(tmp_path)
+    assert len(reloaded) == len(archive) in {len(history) for history in histories}
+
+
+def test_archived_routes_are_drawn_without_decoding(
+    monkeypatch, tmp_path, strava_activities
+):
+    pytest.importorskip("numpy")
+    monkeypatch.setitem(strava_runmap.STRAVA_RUNMAP_SETTINGS, "ARCHIVE", "1")
+    monkeypatch.setitem(strava_runmap.STRAVA_RUNMAP_SETTINGS, "HEATMAP", "1")
+    monkeypatch.setattr(
+        _strava_interface.StravaAPI,
+        "iter_activities",
+        lambda self: iter([strava_activities]),
+    )
+    archive = _activity_archive.ActivityArchive()
+    archive.configure(tmp_path)
+    monkeypatch.setattr(strava_runmap, "ACTIVITY_ARCHIVE", archive)
+    monkeypatch.setattr(strava_runmap, "RENDER_CACHE", _render_cache.RenderCache())
+    run_history = strava_runmap._create_run_images()
+
+    archive.configure(tmp_path)
+    monkeypatch.setattr(strava_runmap, "RENDER_CACHE", _render_cache.RenderCache())
+    monkeypatch.setattr(
+        _svg_interface, "decode_polyline_array", mock.Mock(side_effect=AssertionError)
+    )
+    monkeypatch.setattr(_svg_interface.polyline, "decode", mock.Mock())
+    submit = _svg_interface.SvgRenderer.submit
+    submitted_routes = []
+
+    def _submit(renderer, routes, options):
+        submitted_routes.extend(routes)
+        return submit(renderer, routes, options)
+
+    monkeypatch.setattr(_svg_interface.SvgRenderer, "submit", _submit)
+    mapped_activities = []
+    rebuilt_run_history = strava_runmap._create_run_images(mapped_activities)
+    heatmaps = strava_runmap._build_runmap_content(
+        rebuilt_run_history, mapped_activities, DEFAULT_CONFIG
+    )
+
+    assert rebuilt_run_history == run_history
+    # Nothing was cached, so every route was drawn, and from the archive.
+    assert len(submitted_routes) == len(mapped_activities)
+    assert all(isinstance(route, memoryview) for route in submitted_routes)
+    assert "<img" in heatmaps[0]["content"]
+    _svg_interface.polyline.decode.assert_not_called()
+
+
 @pytest.mark.skip("Not implemented")
 def test_activity_svg_data_converts_to_svg(activity_svg_data):
     # Arrange
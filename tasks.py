@@ -32,6 +32,28 @@ def tests(c, deprecations=False):
     c.run(f"{CMD_PREFIX}pytest {deprecations_flag}", pty=PTY)
 
 
+@task
+def benchmark(c, sizes="100,1000,10000,50000", output="benchmark.json"):
+    """Time each stage of a build over synthetic histories of the given `sizes`."""
+    sizes_flag = " ".join(sizes.split(","))
+    c.run(
+        f"{CMD_PREFIX}python -m pelican.plugins.{PKG_NAME}._benchmark "
+        f"--sizes {sizes_flag} --output {output}",
+        pty=PTY,
+    )
+
+
+@task
+def standin(c, activities=1000, port=8000, error_rate=0.0, drop_rate=0.0):
+    """Serve a local stand-in for the Strava API with synthetic `activities`."""
+    c.run(
+        f"{CMD_PREFIX}python -m pelican.plugins.{PKG_NAME}._standin_server "
+        f"--activities {activities} --port {port} "
+        f"--error-rate {error_rate} --drop-rate {drop_rate}",
+        pty=PTY,
+    )
+
+
 @task
 def black(c, check=False, diff=False):
     """Run Black auto-formatter, optionally with `--check` or `--diff`."""